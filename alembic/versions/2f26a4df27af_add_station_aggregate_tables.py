@@ -0,0 +1,58 @@
+"""add station aggregate tables
+
+Revision ID: 2f26a4df27af
+Revises: 1d549c1d6cfe
+Create Date: 2015-03-10 11:24:06.192851
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f26a4df27af'
+down_revision = '1d549c1d6cfe'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def aggregate_columns():
+    return [
+        sa.Column('new_measures', sa.dialects.mysql.INTEGER(unsigned=True)),
+        sa.Column('lat_sum', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+        sa.Column('lon_sum', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+        sa.Column('max_lat', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+        sa.Column('min_lat', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+        sa.Column('max_lon', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+        sa.Column('min_lon', sa.dialects.mysql.DOUBLE(asdecimal=False)),
+    ]
+
+
+def upgrade():
+    op.create_table(
+        'cell_aggregate',
+        sa.Column('radio', sa.dialects.mysql.TINYINT,
+                  autoincrement=False, primary_key=True),
+        sa.Column('mcc', sa.dialects.mysql.SMALLINT,
+                  autoincrement=False, primary_key=True),
+        sa.Column('mnc', sa.dialects.mysql.SMALLINT,
+                  autoincrement=False, primary_key=True),
+        sa.Column('lac', sa.dialects.mysql.SMALLINT(unsigned=True),
+                  autoincrement=False, primary_key=True),
+        sa.Column('cid', sa.dialects.mysql.INTEGER(unsigned=True),
+                  autoincrement=False, primary_key=True),
+        *aggregate_columns(),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+    op.create_table(
+        'wifi_aggregate',
+        sa.Column('key', sa.String(12), primary_key=True),
+        *aggregate_columns(),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8'
+    )
+
+
+def downgrade():
+    op.drop_table('wifi_aggregate')
+    op.drop_table('cell_aggregate')
@@ -0,0 +1,59 @@
+"""partition observation tables
+
+Revision ID: fbb0a6f63340
+Revises: 2f26a4df27af
+Create Date: 2015-03-12 15:41:02.518324
+
+Partitioning rebuilds the observation tables, so it is optional and
+only done if requested via:
+
+    alembic -x partition_observations=true upgrade head
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'fbb0a6f63340'
+down_revision = '2f26a4df27af'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+# Same as the size of the observation archival blocks
+PARTITION_SIZE = 100000
+TABLES = ('cell_measure', 'wifi_measure')
+
+
+def is_partitioned(bind, table):
+    stmt = sa.text(
+        'SELECT count(*) FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = :table '
+        'AND partition_name IS NOT NULL')
+    return bool(bind.execute(stmt, table=table).scalar())
+
+
+def upgrade():
+    options = context.get_x_argument(as_dictionary=True)
+    if options.get('partition_observations') not in ('1', 'true'):
+        return
+
+    bind = op.get_bind()
+    for table in TABLES:
+        if is_partitioned(bind, table):
+            continue
+        max_id = bind.execute(
+            sa.text('SELECT max(id) FROM %s' % table)).scalar() or 0
+        # All existing rows go into one partition, the partitions for
+        # new rows are split off the last one by a periodic task.
+        upper = (max_id // PARTITION_SIZE + 1) * PARTITION_SIZE
+        op.execute(
+            'ALTER TABLE %s PARTITION BY RANGE (id) ('
+            'PARTITION p%d VALUES LESS THAN (%d), '
+            'PARTITION pmax VALUES LESS THAN MAXVALUE)' % (
+                table, upper, upper))
+
+
+def downgrade():
+    bind = op.get_bind()
+    for table in TABLES:
+        if is_partitioned(bind, table):
+            op.execute('ALTER TABLE %s REMOVE PARTITIONING' % table)
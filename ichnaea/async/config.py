@@ -23,6 +23,19 @@ CELERY_QUEUES = (
     Queue('celery_upload', routing_key='celery_upload'),
 )
 EXPORT_QUEUE_PREFIX = 'queue_export_'
+INSERT_QUEUE_PREFIX = 'queue_insert_'
+# Redis hash of the last measured length of each queue
+QUEUE_LENGTH_KEY = 'monitor:queue_length'
+# Redis sorted set of removed cell keys, scored by their removal time
+DELETED_CELLS_KEY = 'export:cell:deleted'
+# Redis hash describing the last full cell export
+CELL_SNAPSHOT_KEY = 'export:cell:snapshot'
+# Redis hash of the estimated station update backlog, per station type
+STATION_BACKLOG_KEY = 'update:backlog:%s'
+# Redis lock of a shard of a location update band, per station type
+STATION_LEASE_KEY = 'update:lease:%s:%s:%d'
+# Redis hash of the progress of an OpenCellID import, per file name
+OCID_IMPORT_KEY = 'import:ocid:%s'
 
 register('internal_json', customjson.kombu_dumps, customjson.kombu_loads,
          content_type='application/x-internaljson',
@@ -74,6 +87,22 @@ def init_worker(celery_app, app_config,
     for value in data_queues.values():
         all_queues.add(value)
 
+    # optional staging queues for incoming observations, partitioned
+    # by a hash of the station key
+    celery_app.insert_queues = insert_queues = {}
+    partitions = int(app_config.get('ichnaea', 'insert_partitions') or 0)
+    if partitions > 0:
+        for station_type in ('cell', 'wifi'):
+            names = [INSERT_QUEUE_PREFIX + '%s_%d' % (station_type, i)
+                     for i in range(partitions)]
+            insert_queues[station_type] = names
+            all_queues.update(names)
+
+    # optionally keep running aggregates of the new observations of
+    # each station, so station updates don't re-read the observations
+    celery_app.station_aggregates = bool(int(
+        app_config.get('ichnaea', 'station_aggregates') or 0))
+
     celery_app.export_queues = export_queues = {}
     for section_name in app_config.sections():
         if section_name.startswith('export:'):
@@ -85,7 +114,7 @@ def init_worker(celery_app, app_config,
             }
             all_queues.add(queue_name)
             for key, value in section.items():
-                if key == 'batch':
+                if key in ('batch', 'concurrency'):
                     export_queues[name][key] = int(value)
                 else:
                     export_queues[name][key] = value
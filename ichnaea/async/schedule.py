@@ -28,43 +28,20 @@ CELERYBEAT_SCHEDULE = {
         'options': {'expires': 570},
     },
 
-    # Continuous location update tasks
+    # Continuous observation insert tasks
 
-    'location-update-cell-1': {
-        'task': 'ichnaea.data.tasks.location_update_cell',
-        'schedule': timedelta(seconds=29),
-        'args': (1, 10, 4000),
-        'options': {'expires': 25},
-    },
-    'location-update-cell-10': {
-        'task': 'ichnaea.data.tasks.location_update_cell',
-        'schedule': timedelta(seconds=149),
-        'args': (10, 1000, 1000),
-        'options': {'expires': 120},
-    },
-    'location-update-cell-1000': {
-        'task': 'ichnaea.data.tasks.location_update_cell',
-        'schedule': timedelta(seconds=311),
-        'args': (1000, 1000000, 100),
-        'options': {'expires': 300},
+    'schedule-staged-inserts': {
+        'task': 'ichnaea.data.tasks.schedule_staged_inserts',
+        'schedule': timedelta(seconds=17),
+        'options': {'expires': 15},
     },
-    'location-update-wifi-1': {
-        'task': 'ichnaea.data.tasks.location_update_wifi',
-        'schedule': timedelta(seconds=31),
-        'args': (1, 10, 4000),
-        'options': {'expires': 25},
-    },
-    'location-update-wifi-10': {
-        'task': 'ichnaea.data.tasks.location_update_wifi',
-        'schedule': timedelta(seconds=151),
-        'args': (10, 1000, 1000),
-        'options': {'expires': 120},
-    },
-    'location-update-wifi-1000': {
-        'task': 'ichnaea.data.tasks.location_update_wifi',
-        'schedule': timedelta(seconds=313),
-        'args': (1000, 1000000, 100),
-        'options': {'expires': 300},
+
+    # Continuous location update tasks
+
+    'schedule-location-updates': {
+        'task': 'ichnaea.data.tasks.schedule_location_updates',
+        'schedule': timedelta(seconds=13),
+        'options': {'expires': 11},
     },
     'continuous-cell-scan-areas': {
         'task': 'ichnaea.data.tasks.scan_areas',
@@ -140,6 +117,22 @@ CELERYBEAT_SCHEDULE = {
         'options': {'expires': 43200},
     },
 
+    # Pre-create partitions of the observation tables, if they are
+    # partitioned, using the same size as the archival blocks
+
+    'create-cellobservation-partitions': {
+        'task': 'ichnaea.backup.tasks.create_cellmeasure_partitions',
+        'args': (100000, 100),
+        'schedule': crontab(minute=37),
+        'options': {'expires': 3000},
+    },
+    'create-wifiobservation-partitions': {
+        'task': 'ichnaea.backup.tasks.create_wifimeasure_partitions',
+        'args': (100000, 100),
+        'schedule': crontab(minute=47),
+        'options': {'expires': 3000},
+    },
+
     # OCID cell import task
 
     'ocid-hourly-cell-delta-import': {
@@ -160,6 +153,7 @@ CELERYBEAT_SCHEDULE = {
     's3-daily-cell-full-export': {
         'task': 'ichnaea.export.tasks.export_modified_cells',
         'args': (False, ),
+        'kwargs': {'parallel': True, 'incremental': True, 'columnar': True},
         'schedule': crontab(hour=0, minute=13),
         'options': {'expires': 39600},
     },
@@ -0,0 +1,136 @@
+"""
+A write-only zip archive, which can be streamed into a sink.
+
+The standard library :class:`zipfile.ZipFile` needs to seek back into
+the file to fill in the checksum and sizes of each member. Instead the
+members are written with a trailing data descriptor holding these
+values, which all zip readers support.
+"""
+
+from binascii import crc32
+import struct
+import time
+import zipfile
+import zlib
+
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+DATA_DESCRIPTOR_SIGNATURE = 'PK\x07\x08'
+FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_VERSION = 20
+# unix, like the zipfile module uses on all but Windows
+CREATE_SYSTEM = 3
+
+
+def _dos_date_time(date_time):
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    return dosdate, dostime
+
+
+class StreamingZipMember(object):
+    """
+    A single deflated member of a :class:`StreamingZipFile`.
+    """
+
+    def __init__(self, archive, name, date_time):
+        self.archive = archive
+        self.name = name
+        self.dosdate, self.dostime = _dos_date_time(date_time)
+        self.header_offset = archive.offset
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        archive._write(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader,
+            ZIP_VERSION, 0, FLAG_DATA_DESCRIPTOR, zipfile.ZIP_DEFLATED,
+            self.dostime, self.dosdate, 0, 0, 0, len(name), 0))
+        archive._write(name)
+
+    def _write_compressed(self, data):
+        if data:
+            self.compress_size += len(data)
+            self.archive._write(data)
+
+    def write(self, data):
+        self.crc = crc32(data, self.crc) & 0xffffffff
+        self.file_size += len(data)
+        if self.file_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Zip64 extensions are not supported')
+        self._write_compressed(self.compressor.compress(data))
+
+    def close(self):
+        self._write_compressed(self.compressor.flush())
+        self.archive._write(DATA_DESCRIPTOR.pack(
+            DATA_DESCRIPTOR_SIGNATURE, self.crc,
+            self.compress_size, self.file_size))
+        self.archive.members.append(self)
+        self.archive.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class StreamingZipFile(object):
+    """
+    A write-only zip archive, writing its data sequentially into
+    the file-like ``fileobj``, which only needs a ``write`` method.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.members = []
+        self.current = None
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def open(self, name, date_time=None):
+        """
+        Start a new member and return it. The member needs to be
+        closed before the next one can be started.
+        """
+        if self.current is not None:  # pragma: no cover
+            raise ValueError('The previous member has not been closed.')
+        if date_time is None:
+            date_time = time.localtime(time.time())[:6]
+        self.current = StreamingZipMember(self, name, date_time)
+        return self.current
+
+    def writestr(self, name, data, date_time=None):
+        with self.open(name, date_time=date_time) as member:
+            member.write(data)
+
+    def close(self):
+        start = self.offset
+        for member in self.members:
+            self._write(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                ZIP_VERSION, CREATE_SYSTEM, ZIP_VERSION, 0,
+                FLAG_DATA_DESCRIPTOR, zipfile.ZIP_DEFLATED,
+                member.dostime, member.dosdate, member.crc,
+                member.compress_size, member.file_size,
+                len(member.name), 0, 0, 0, 0, 0o600 << 16,
+                member.header_offset))
+            self._write(member.name)
+        size = self.offset - start
+        if start > zipfile.ZIP64_LIMIT:  # pragma: no cover
+            raise zipfile.LargeZipFile('Zip64 extensions are not supported')
+        self._write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, len(self.members), len(self.members), size, start, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,133 @@
+"""
+Optional range partitions of the observation tables.
+
+The observation tables can be partitioned by ranges of their id column,
+with a catch-all last partition for all ids beyond the highest bound.
+Archival blocks are scheduled to never span a partition boundary, so
+once all blocks of a partition are archived, their rows are removed by
+dropping the partition instead of deleting them row by row.
+
+All functions also work for tables which aren't partitioned.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.sql import (
+    func,
+    select,
+)
+
+PARTITIONS_QUERY = text(
+    'SELECT partition_name, partition_description '
+    'FROM information_schema.partitions '
+    'WHERE table_schema = DATABASE() AND table_name = :table '
+    'AND partition_name IS NOT NULL '
+    'ORDER BY partition_ordinal_position')
+
+
+def partition_name(upper):
+    return 'p%d' % upper
+
+
+def table_partitions(session, table):
+    """
+    Return the range partitions of the table, as a list of
+    ``(name, lower, upper)`` tuples in id order. The upper bound of
+    the catch-all partition is None.
+
+    Returns an empty list if the table isn't partitioned.
+    """
+    result = []
+    lower = 0
+    for name, description in session.execute(
+            PARTITIONS_QUERY, {'table': table.name}):
+        upper = None
+        if description != 'MAXVALUE':
+            upper = int(description)
+        result.append((name, lower, upper))
+        lower = upper
+    return result
+
+
+def next_bound(partitions, id_):
+    """
+    Return the smallest partition bound above the given id, or None.
+    """
+    for name, lower, upper in partitions:
+        if upper is not None and upper > id_:
+            return upper
+    return None
+
+
+def new_bounds(partitions, max_id, size, ahead):
+    """
+    Return the upper bounds of the partitions, which need to be split
+    off the catch-all partition so that the bounded partitions cover
+    at least ``ahead`` partitions of ``size`` ids beyond ``max_id``.
+    """
+    upper = 0
+    if len(partitions) > 1:
+        upper = partitions[-2][2]
+    bounds = []
+    while upper < max_id + size * ahead:
+        upper = (upper // size + 1) * size
+        bounds.append(upper)
+    return bounds
+
+
+def add_partitions(session, table, size, ahead):
+    """
+    Pre-create empty partitions for the next ids of the table, by
+    splitting them off the catch-all partition.
+
+    Returns the upper bounds of the new partitions.
+    """
+    partitions = table_partitions(session, table)
+    if not partitions or partitions[-1][2] is not None:
+        return []
+
+    max_id = session.execute(select([func.max(table.c.id)])).scalar()
+    bounds = new_bounds(partitions, max_id or 0, size, ahead)
+    if bounds:
+        last = partitions[-1][0]
+        definitions = [
+            'PARTITION %s VALUES LESS THAN (%d)' % (partition_name(bound),
+                                                    bound)
+            for bound in bounds]
+        definitions.append('PARTITION %s VALUES LESS THAN MAXVALUE' % last)
+        session.execute('ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s)' % (
+            table.name, last, ', '.join(definitions)))
+    return bounds
+
+
+def plan_block_delete(partitions, start_id, end_id):
+    """
+    Split the id range of an archived block into the partitions lying
+    completely inside of it, and the remaining id ranges.
+
+    Returns a list of partition names, which can be dropped, and a
+    list of ``(start, end)`` id ranges, whose rows need to be deleted.
+    """
+    drop = []
+    ranges = []
+    position = start_id
+    for name, lower, upper in partitions:
+        if upper is None or lower < start_id or upper > end_id:
+            continue
+        if lower > position:
+            ranges.append((position, lower))
+        drop.append(name)
+        position = upper
+    if position < end_id:
+        ranges.append((position, end_id))
+    return drop, ranges
+
+
+def drop_partitions(session, table, names):
+    """
+    Drop the given partitions of the table.
+
+    This implicitly commits the current transaction.
+    """
+    if names:
+        session.execute('ALTER TABLE %s DROP PARTITION %s' % (
+            table.name, ', '.join(names)))
@@ -1,19 +1,8 @@
-import boto
 import hashlib
-import os
-import shutil
-import tempfile
 
+from ichnaea.storage import configure_storage
 
-def compute_hash(zip_path):
-    sha = hashlib.sha1()
-    with open(zip_path, 'rb') as file_in:
-        while True:
-            data = file_in.read(16384)
-            if not data:
-                break
-            sha.update(data)
-    return sha.digest()
+BACKUP_PREFIX = 'backups/'
 
 
 class S3Backend(object):
@@ -21,38 +10,20 @@ class S3Backend(object):
     def __init__(self, backup_bucket, raven_client):
         self.raven_client = raven_client
         self.backup_bucket = backup_bucket
+        self.storage = configure_storage(backup_bucket)
 
-    def check_archive(self, expected_sha, s3_key):  # pragma: no cover
-        short_fname = os.path.split(s3_key)[-1]
-
-        tmpdir = tempfile.mkdtemp()
-        s3_copy = os.path.join(tmpdir, short_fname + ".s3")
-
+    def check_archive(self, expected_sha, s3_key):
         try:
-            conn = boto.connect_s3()
-            bucket = conn.get_bucket(self.backup_bucket, validate=False)
-            k = boto.s3.key.Key(bucket)
-            k.key = 'backups/' + s3_key
-            k.get_contents_to_filename(s3_copy)
-
-            # Compare
-            s3_hash = compute_hash(s3_copy)
-            return s3_hash == expected_sha
+            sha = hashlib.sha1()
+            for data in self.storage.read(BACKUP_PREFIX + s3_key):
+                sha.update(data)
+            return sha.digest() == expected_sha
         except Exception:
             self.raven_client.captureException()
             return False
-        finally:
-            if os.path.exists(tmpdir):
-                shutil.rmtree(tmpdir)
 
-    def backup_archive(self, s3_key, fname, delete_on_write=False):
-        try:
-            conn = boto.connect_s3()
-            bucket = conn.get_bucket(self.backup_bucket)
-            k = boto.s3.key.Key(bucket)
-            k.key = 'backups/' + s3_key
-            k.set_contents_from_filename(fname)
-            return True
-        except Exception:  # pragma: no cover
-            self.raven_client.captureException()
-            return False
+    def backup_sink(self, s3_key):
+        """
+        Return a sink writing a new backup archive.
+        """
+        return self.storage.sink(BACKUP_PREFIX + s3_key)
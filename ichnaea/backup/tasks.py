@@ -1,17 +1,20 @@
-from contextlib import contextmanager
 from datetime import timedelta
-from zipfile import ZipFile, ZIP_DEFLATED
 import csv
-import os
-import shutil
-import tempfile
 
 import pytz
 from sqlalchemy import func
 
 from ichnaea.async.app import celery_app
 from ichnaea.async.task import DatabaseTask
-from ichnaea.backup.s3 import S3Backend, compute_hash
+from ichnaea.backup.archive import StreamingZipFile
+from ichnaea.backup.partition import (
+    add_partitions,
+    drop_partitions,
+    next_bound,
+    plan_block_delete,
+    table_partitions,
+)
+from ichnaea.backup.s3 import S3Backend
 from ichnaea.models import (
     OBSERVATION_TYPE_META,
     ObservationBlock,
@@ -20,76 +23,35 @@ from ichnaea.models import (
 from ichnaea import util
 
 
-@contextmanager
-def selfdestruct_tempdir(s3_key):
-    """
-    We need two temp directories to do this properly.
-
-    The base_path is a temp directory that holds all the content that
-    will go into our zip file. This is effectively a working
-    directory that gets immediately deleted once the zip file is
-    ready.
-
-    The zip_path is the filename of the zip file that will get
-    uploaded into S3. It is the responsibility of the caller of
-    selfdestruct_tempdir to remove the zip_path and parent directory.
-    """
-    short_name = os.path.split(s3_key)[-1]
-
-    base_path = tempfile.mkdtemp()
-    s3_path = os.path.join(tempfile.mkdtemp(), short_name)
-    try:
-        zip_path = os.path.join(base_path, s3_path)
-        yield base_path, zip_path
-    finally:
-        try:
-            z = ZipFile(zip_path, "w", ZIP_DEFLATED)
-            try:
-                for root, dirs, files in os.walk(base_path):
-                    for fn in files:
-                        absfn = os.path.join(root, fn)
-                        zip_fn = absfn[len(base_path) + len(os.sep):]
-                        z.write(absfn, zip_fn)
-            finally:
-                z.close()
-        finally:
-            shutil.rmtree(base_path)
-
-
 @celery_app.task(base=DatabaseTask, bind=True)
 def write_cellmeasure_s3_backups(self,
                                  limit=100,
                                  batch=10000,
-                                 countdown=300,
-                                 cleanup_zip=True):
+                                 countdown=300):
     return write_observation_s3_backups(self,
                                         ObservationType.cell,
                                         limit=limit,
                                         batch=batch,
-                                        countdown=countdown,
-                                        cleanup_zip=cleanup_zip)
+                                        countdown=countdown)
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
 def write_wifimeasure_s3_backups(self,
                                  limit=100,
                                  batch=10000,
-                                 countdown=300,
-                                 cleanup_zip=True):
+                                 countdown=300):
     return write_observation_s3_backups(self,
                                         ObservationType.wifi,
                                         limit=limit,
                                         batch=batch,
-                                        countdown=countdown,
-                                        cleanup_zip=cleanup_zip)
+                                        countdown=countdown)
 
 
 def write_observation_s3_backups(self,
                                  observation_type,
                                  limit=100,
                                  batch=10000,
-                                 countdown=300,
-                                 cleanup_zip=True):
+                                 countdown=300):
     """
     Iterate over each of the observation block records that aren't
     backed up yet and back them up.
@@ -105,13 +67,13 @@ def write_observation_s3_backups(self,
         for block in query:
             write_block_to_s3.apply_async(
                 args=[block.id],
-                kwargs={'batch': batch, 'cleanup_zip': cleanup_zip},
+                kwargs={'batch': batch},
                 countdown=c)
             c += countdown
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
-def write_block_to_s3(self, block_id, batch=10000, cleanup_zip=True):
+def write_block_to_s3(self, block_id, batch=10000):
     with self.db_session() as session:
         block = session.query(ObservationBlock).filter(
             ObservationBlock.id == block_id).first()
@@ -136,52 +98,36 @@ def write_block_to_s3(self, block_id, batch=10000, cleanup_zip=True):
                                       start_id,
                                       end_id)
 
-        with selfdestruct_tempdir(s3_key) as (tmp_path, zip_path):
-            with open(os.path.join(tmp_path,
-                                   'alembic_revision.txt'), 'w') as f:
-                f.write('%s\n' % alembic_rev)
-
-            # avoid ORM session overhead
-            table = obs_cls.__table__
-
-            cm_fname = os.path.join(tmp_path, csv_name)
-            with open(cm_fname, 'w') as f:
-                csv_out = csv.writer(f, dialect='excel')
-                columns = table.c.keys()
-                csv_out.writerow(columns)
-                for this_start in range(start_id,
-                                        end_id,
-                                        batch):
-                    this_end = min(this_start + batch, end_id)
-
-                    query = table.select().where(
-                        table.c.id >= this_start).where(
-                        table.c.id < this_end)
-
-                    rproxy = session.execute(query)
-                    csv_out.writerows(rproxy)
-
-        archive_sha = compute_hash(zip_path)
-
-        try:
-            success = s3_backend.backup_archive(s3_key, zip_path)
-            if not success:  # pragma: no cover
-                return
-            self.stats_client.incr('s3.backup.%s' % observation_type.name,
-                                   (end_id - start_id))
-        finally:
-            if cleanup_zip:
-                if os.path.exists(zip_path):  # pragma: no cover
-                    zip_dir, zip_file = os.path.split(zip_path)
-                    if os.path.exists(zip_dir):
-                        shutil.rmtree(zip_dir)
-            else:
-                # Test-only mechanism
-                self.raven_client.capture(
-                    'raven.events.Message', message='s3.backup:%s' % zip_path)
+        # stream the zip archive straight into the backup sink, which
+        # computes its checksum along the way
+        with s3_backend.backup_sink(s3_key) as sink:
+            with StreamingZipFile(sink) as archive:
+                archive.writestr('alembic_revision.txt', '%s\n' % alembic_rev)
+
+                # avoid ORM session overhead
+                table = obs_cls.__table__
+
+                with archive.open(csv_name) as member:
+                    csv_out = csv.writer(member, dialect='excel')
+                    columns = table.c.keys()
+                    csv_out.writerow(columns)
+                    for this_start in range(start_id,
+                                            end_id,
+                                            batch):
+                        this_end = min(this_start + batch, end_id)
+
+                        query = table.select().where(
+                            table.c.id >= this_start).where(
+                            table.c.id < this_end)
+
+                        rproxy = session.execute(query)
+                        csv_out.writerows(rproxy)
+
+        self.stats_client.incr('s3.backup.%s' % observation_type.name,
+                               (end_id - start_id))
 
         # only set archive_sha / s3_key if upload was successful
-        block.archive_sha = archive_sha
+        block.archive_sha = sink.digest
         block.s3_key = s3_key
         session.commit()
 
@@ -211,6 +157,8 @@ def schedule_observation_archival(self, observation_type,
             # no data in the table
             return blocks
 
+        partitions = table_partitions(session, obs_cls.__table__)
+
         query = session.query(ObservationBlock.end_id).filter(
             ObservationBlock.measure_type == observation_type).order_by(
             ObservationBlock.end_id.desc())
@@ -220,18 +168,20 @@ def schedule_observation_archival(self, observation_type,
         else:
             min_id = table_min_id
 
-        max_id = table_max_id
-        if max_id - min_id < batch - 1:
-            # Not enough to fill a block
-            return blocks
-
         # We're using half-open ranges, so we need to bump the max_id
-        max_id += 1
+        max_id = table_max_id + 1
+
+        while len(blocks) < limit:
+            this_max_id = min_id + batch
+            # Blocks never span a partition boundary, so partitions
+            # can be dropped once all their blocks are archived.
+            bound = next_bound(partitions, min_id)
+            if bound is not None:
+                this_max_id = min(this_max_id, bound)
+            if this_max_id > max_id:
+                # Not enough to fill a block
+                break
 
-        this_max_id = min_id + batch
-
-        i = 0
-        while i < limit and (this_max_id - min_id) == batch:
             cm_blk = ObservationBlock(start_id=min_id,
                                       end_id=this_max_id,
                                       measure_type=observation_type)
@@ -239,8 +189,6 @@ def schedule_observation_archival(self, observation_type,
             session.add(cm_blk)
 
             min_id = this_max_id
-            this_max_id = min(batch + this_max_id, max_id)
-            i += 1
         session.commit()
     return blocks
 
@@ -276,14 +224,16 @@ def delete_observation_records(self,
             ObservationBlock.end_id.asc()).limit(limit)
         c = 0
         for block in query.all():
-            # Note that 'created' is indexed for both CellObservation
-            # and WifiObservation
+            # Only look at the rows of the block itself, found via
+            # the primary key.
             obs_cls = OBSERVATION_TYPE_META[observation_type]['class']
             tbl = obs_cls.__table__
             qry = session.query(func.max(tbl.c.created)).filter(
+                tbl.c.id >= block.start_id,
                 tbl.c.id < block.end_id)
-            max_created = qry.first()[0].replace(tzinfo=pytz.UTC).date()
-            if min_age < max_created:
+            max_created = qry.first()[0]
+            if (max_created is not None and
+                    min_age < max_created.replace(tzinfo=pytz.UTC).date()):
                 # Skip this block from deletion, it's not old
                 # enough
                 continue
@@ -320,14 +270,31 @@ def verified_delete(self, block_id, batch=10000):
             ObservationBlock.id == block_id).first()
         observation_type = block.measure_type
         obs_cls = OBSERVATION_TYPE_META[observation_type]['class']
+        table = obs_cls.__table__
 
-        for start in range(block.start_id, block.end_id, batch):
-            end = min(block.end_id, start + batch)
-            q = session.query(obs_cls).filter(
-                obs_cls.id >= start,
-                obs_cls.id < end)
-            q.delete()
-            session.flush()
+        # Drop the partitions lying completely inside the block. The
+        # partition holding the start of the block can be dropped as
+        # well, if its rows before the block were deleted already.
+        start_id = block.start_id
+        partitions = table_partitions(session, table)
+        for name, lower, upper in partitions:
+            if upper is not None and lower < start_id < upper:
+                if session.query(obs_cls.id).filter(
+                        obs_cls.id >= lower,
+                        obs_cls.id < start_id).first() is None:
+                    start_id = lower
+                break
+        drop, ranges = plan_block_delete(partitions, start_id, block.end_id)
+        drop_partitions(session, table, drop)
+
+        for range_start, range_end in ranges:
+            for start in range(range_start, range_end, batch):
+                end = min(range_end, start + batch)
+                q = session.query(obs_cls).filter(
+                    obs_cls.id >= start,
+                    obs_cls.id < end)
+                q.delete()
+                session.flush()
         block.archive_date = utcnow
         session.commit()
 
@@ -354,3 +321,23 @@ def delete_wifimeasure_records(self, limit=100, days_old=7,
         days_old=days_old,
         countdown=countdown,
         batch=batch)
+
+
+def create_observation_partitions(self, observation_type, size, ahead):
+    obs_cls = OBSERVATION_TYPE_META[observation_type]['class']
+    with self.db_session() as session:
+        bounds = add_partitions(session, obs_cls.__table__, size, ahead)
+        session.commit()
+    return bounds
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def create_cellmeasure_partitions(self, size=100000, ahead=100):
+    return create_observation_partitions(
+        self, ObservationType.cell, size, ahead)
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def create_wifimeasure_partitions(self, size=100000, ahead=100):
+    return create_observation_partitions(
+        self, ObservationType.wifi, size, ahead)
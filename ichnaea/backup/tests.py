@@ -2,14 +2,23 @@ from contextlib import contextmanager
 import datetime
 from datetime import timedelta
 import hashlib
+import os
+import shutil
+import tempfile
 from zipfile import ZipFile
 
 import boto
 from mock import MagicMock, patch
 import pytz
 
+from ichnaea.backup.partition import (
+    new_bounds,
+    next_bound,
+    plan_block_delete,
+)
 from ichnaea.backup.s3 import S3Backend
 from ichnaea.backup.tasks import (
+    create_cellmeasure_partitions,
     delete_cellmeasure_records,
     delete_wifimeasure_records,
     schedule_cellmeasure_archival,
@@ -23,7 +32,10 @@ from ichnaea.models import (
     ObservationType,
     WifiObservation,
 )
-from ichnaea.tests.base import CeleryTestCase
+from ichnaea.tests.base import (
+    CeleryTestCase,
+    TestCase,
+)
 from ichnaea.tests.factories import (
     CellObservationFactory,
     ObservationBlockFactory,
@@ -41,16 +53,44 @@ def mock_s3():
             yield mock_key
 
 
+@contextmanager
+def local_backups(settings):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with patch.dict(settings, {'s3_backup_bucket': 'file://' + temp_dir}):
+            yield temp_dir
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def backup_files(temp_dir):
+    return [os.path.join(root, name)
+            for root, dirs, files in os.walk(temp_dir)
+            for name in files]
+
+
 class TestBackup(CeleryTestCase):
 
     def test_backup(self):
         with mock_s3() as mock_key:
             s3 = S3Backend('localhost.bucket', self.raven_client)
-            s3.backup_archive('some_key', '/tmp/not_a_real_file.zip')
+            with s3.backup_sink('some_key') as sink:
+                sink.write('some data')
             self.assertEquals(mock_key.key, 'backups/some_key')
-            method = mock_key.set_contents_from_filename
-            self.assertEquals(method.call_args[0][0],
-                              '/tmp/not_a_real_file.zip')
+            method = mock_key.set_contents_from_string
+            self.assertEquals(method.call_args[0][0], 'some data')
+            self.assertEquals(sink.digest,
+                              hashlib.sha1('some data').digest())
+
+    def test_check_archive(self):
+        settings = self.celery_app.settings['ichnaea']
+        with local_backups(settings) as temp_dir:
+            s3 = S3Backend('file://' + temp_dir, self.raven_client)
+            with s3.backup_sink('201501/some_key') as sink:
+                sink.write('some data')
+            self.assertTrue(s3.check_archive(sink.digest, '201501/some_key'))
+            self.assertFalse(s3.check_archive('wrong', '201501/some_key'))
+            self.assertFalse(s3.check_archive(sink.digest, 'missing'))
 
 
 class TestObservationsDump(CeleryTestCase):
@@ -118,33 +158,36 @@ class TestObservationsDump(CeleryTestCase):
         block = blocks[0]
         self.assertEquals(block, (start_id, start_id + batch_size))
 
-        with mock_s3():
-            with patch.object(S3Backend,
-                              'backup_archive', lambda x, y, z: True):
-                write_cellmeasure_s3_backups.delay(cleanup_zip=False).get()
-
-                raven_msgs = self.raven_client.msgs
-                fname = [m['message'].split(':')[1] for m in raven_msgs
-                         if m['message'].startswith('s3.backup:')][0]
-                myzip = ZipFile(fname)
-                try:
-                    contents = set(myzip.namelist())
-                    expected_contents = set(['alembic_revision.txt',
-                                             'cell_measure.csv'])
-                    self.assertEquals(expected_contents, contents)
-                finally:
-                    myzip.close()
+        settings = self.celery_app.settings['ichnaea']
+        with local_backups(settings) as temp_dir:
+            write_cellmeasure_s3_backups.delay().get()
+
+            fnames = backup_files(temp_dir)
+            self.assertEquals(len(fnames), 1)
+            fname = fnames[0]
+            myzip = ZipFile(fname)
+            try:
+                contents = set(myzip.namelist())
+                expected_contents = set(['alembic_revision.txt',
+                                         'cell_measure.csv'])
+                self.assertEquals(expected_contents, contents)
+                rows = myzip.read('cell_measure.csv').splitlines()
+                self.assertEquals(len(rows), batch_size + 1)
+            finally:
+                myzip.close()
+
+            actual_sha = hashlib.sha1()
+            actual_sha.update(open(fname, 'rb').read())
 
         blocks = self.session.query(ObservationBlock).all()
 
         self.assertEquals(len(blocks), 1)
         block = blocks[0]
 
-        actual_sha = hashlib.sha1()
-        actual_sha.update(open(fname, 'rb').read())
         self.assertEquals(block.archive_sha, actual_sha.digest())
         self.assertTrue(block.s3_key is not None)
         self.assertTrue('/cell_' in block.s3_key)
+        self.assertTrue(fname.endswith(block.s3_key))
         self.assertTrue(block.archive_date is None)
 
     def test_backup_wifi_to_s3(self):
@@ -158,33 +201,36 @@ class TestObservationsDump(CeleryTestCase):
         block = blocks[0]
         self.assertEquals(block, (start_id, start_id + batch_size))
 
-        with mock_s3():
-            with patch.object(S3Backend,
-                              'backup_archive', lambda x, y, z: True):
-                write_wifimeasure_s3_backups.delay(cleanup_zip=False).get()
-
-                raven_msgs = self.raven_client.msgs
-                fname = [m['message'].split(':')[1] for m in raven_msgs
-                         if m['message'].startswith('s3.backup:')][0]
-                myzip = ZipFile(fname)
-                try:
-                    contents = set(myzip.namelist())
-                    expected_contents = set(['alembic_revision.txt',
-                                             'wifi_measure.csv'])
-                    self.assertEquals(expected_contents, contents)
-                finally:
-                    myzip.close()
+        settings = self.celery_app.settings['ichnaea']
+        with local_backups(settings) as temp_dir:
+            write_wifimeasure_s3_backups.delay().get()
+
+            fnames = backup_files(temp_dir)
+            self.assertEquals(len(fnames), 1)
+            fname = fnames[0]
+            myzip = ZipFile(fname)
+            try:
+                contents = set(myzip.namelist())
+                expected_contents = set(['alembic_revision.txt',
+                                         'wifi_measure.csv'])
+                self.assertEquals(expected_contents, contents)
+                rows = myzip.read('wifi_measure.csv').splitlines()
+                self.assertEquals(len(rows), batch_size + 1)
+            finally:
+                myzip.close()
+
+            actual_sha = hashlib.sha1()
+            actual_sha.update(open(fname, 'rb').read())
 
         blocks = self.session.query(ObservationBlock).all()
 
         self.assertEquals(len(blocks), 1)
         block = blocks[0]
 
-        actual_sha = hashlib.sha1()
-        actual_sha.update(open(fname, 'rb').read())
         self.assertEquals(block.archive_sha, actual_sha.digest())
         self.assertTrue(block.s3_key is not None)
         self.assertTrue('/wifi_' in block.s3_key)
+        self.assertTrue(fname.endswith(block.s3_key))
         self.assertTrue(block.archive_date is None)
 
     def test_delete_cell_observations(self):
@@ -273,3 +319,47 @@ class TestObservationsDump(CeleryTestCase):
         _delete(days=0)
         self.assertEquals(session.query(CellObservation).count(), 0)
         self.assertEqual(_archived_blocks(), 5)
+
+
+class TestPartition(TestCase):
+
+    partitions = [
+        ('p10', 0, 10),
+        ('p20', 10, 20),
+        ('p30', 20, 30),
+        ('pmax', 30, None),
+    ]
+
+    def test_next_bound(self):
+        self.assertEqual(next_bound(self.partitions, 0), 10)
+        self.assertEqual(next_bound(self.partitions, 10), 20)
+        self.assertEqual(next_bound(self.partitions, 25), 30)
+        self.assertEqual(next_bound(self.partitions, 30), None)
+        self.assertEqual(next_bound([], 5), None)
+
+    def test_new_bounds(self):
+        self.assertEqual(new_bounds(self.partitions, 25, 10, 1), [40])
+        self.assertEqual(new_bounds(self.partitions, 25, 10, 2), [40, 50])
+        self.assertEqual(new_bounds(self.partitions, 5, 10, 2), [])
+        self.assertEqual(new_bounds([('pmax', 0, None)], 0, 10, 1), [10])
+
+    def test_plan_block_delete(self):
+        self.assertEqual(plan_block_delete(self.partitions, 10, 30),
+                         (['p20', 'p30'], []))
+        self.assertEqual(plan_block_delete(self.partitions, 5, 25),
+                         (['p20'], [(5, 10), (20, 25)]))
+        self.assertEqual(plan_block_delete(self.partitions, 12, 18),
+                         ([], [(12, 18)]))
+        self.assertEqual(plan_block_delete(self.partitions, 30, 40),
+                         ([], [(30, 40)]))
+        self.assertEqual(plan_block_delete([], 5, 25),
+                         ([], [(5, 25)]))
+
+
+class TestPartitionTasks(CeleryTestCase):
+
+    def test_create_partitions_unpartitioned(self):
+        CellObservationFactory.create_batch(3)
+        self.session.commit()
+        self.assertEqual(
+            create_cellmeasure_partitions.delay(size=10, ahead=2).get(), [])
@@ -1,57 +1,333 @@
+import time
+
+from sqlalchemy import (
+    Column,
+    MetaData,
+    PrimaryKeyConstraint,
+    Table,
+)
+from sqlalchemy.dialects.mysql import (
+    DOUBLE as Double,
+    INTEGER as Integer,
+    SMALLINT as SmallInteger,
+    TINYINT as TinyInteger,
+)
+from sqlalchemy.sql import (
+    and_,
+    func,
+    literal,
+    or_,
+    select,
+)
+
 from ichnaea.customjson import (
     kombu_dumps,
     kombu_loads,
 )
 from ichnaea.data.base import DataTask
-from ichnaea.geocalc import centroid, range_to_points
+from ichnaea.geocalc import (
+    EARTH_RADIUS,
+    centroid,
+    range_to_points,
+)
 from ichnaea.models import (
     Cell,
     CellArea,
     OCIDCell,
     OCIDCellArea,
+    Radio,
+)
+from ichnaea.models.constants import (
+    MAX_LAT,
+    MAX_LON,
+    MIN_LAT,
+    MIN_LON,
 )
 from ichnaea import util
 
+AREA_KEY_FIELDS = ('radio', 'mcc', 'mnc', 'lac')
+
+# Temporary tables used by the CellAreaRebuilder
+_stage_metadata = MetaData()
+
+area_key_stage = Table(
+    'area_key_stage', _stage_metadata,
+    Column('radio', TinyInteger(), autoincrement=False),
+    Column('mcc', SmallInteger(), autoincrement=False),
+    Column('mnc', SmallInteger(), autoincrement=False),
+    Column('lac', SmallInteger(unsigned=True), autoincrement=False),
+    PrimaryKeyConstraint(*AREA_KEY_FIELDS),
+    prefixes=['TEMPORARY'],
+)
+
+area_stage = Table(
+    'area_stage', _stage_metadata,
+    Column('radio', TinyInteger(), autoincrement=False),
+    Column('mcc', SmallInteger(), autoincrement=False),
+    Column('mnc', SmallInteger(), autoincrement=False),
+    Column('lac', SmallInteger(unsigned=True), autoincrement=False),
+    Column('lat', Double(asdecimal=False)),
+    Column('lon', Double(asdecimal=False)),
+    Column('min_lat', Double(asdecimal=False)),
+    Column('min_lon', Double(asdecimal=False)),
+    Column('max_lat', Double(asdecimal=False)),
+    Column('max_lon', Double(asdecimal=False)),
+    Column('avg_cell_range', Integer()),
+    Column('num_cells', Integer(unsigned=True)),
+    PrimaryKeyConstraint(*AREA_KEY_FIELDS),
+    prefixes=['TEMPORARY'],
+)
+
+
+def _bound(low, value, high):
+    return func.greatest(low, func.least(value, high))
+
+
+def _distance(lat1, lon1, lat2, lon2):
+    # The SQL version of :func:`ichnaea.geocalc.distance`.
+    dlat = func.radians(lat2 - lat1)
+    dlon = func.radians(lon2 - lon1)
+    a = (func.pow(func.sin(dlat / 2.0), 2) +
+         func.cos(func.radians(lat1)) * func.cos(func.radians(lat2)) *
+         func.pow(func.sin(dlon / 2.0), 2))
+    return 2 * EARTH_RADIUS * func.asin(func.least(1, func.sqrt(a)))
+
 
 def enqueue_areas(session, redis_client, area_keys,
-                  pipeline_key, expire=86400, batch=100):
+                  pipeline_key, expire=86400, batch=100, stats_client=None):
+    """
+    Queue the given areas for an update.
+
+    The queue is a sorted set of JSON encoded area keys, scored by the
+    time each area was first queued. Areas which are already queued
+    keep their place, so each area is updated at most once per scan.
+
+    Returns the number of newly queued areas.
+    """
+    area_json = sorted(set([str(kombu_dumps(area)) for area in area_keys]))
+    if not area_json:
+        return 0
+
     pipe = redis_client.pipeline()
-    area_json = [str(kombu_dumps(area)) for area in area_keys]
+    for member in area_json:
+        pipe.zscore(pipeline_key, member)
+    # An area dequeued after this check is updated after our
+    # transaction was committed, so it is safe to skip it.
+    new_json = [member for member, score in zip(area_json, pipe.execute())
+                if score is None]
 
-    while area_json:
-        pipe.lpush(pipeline_key, *area_json[:batch])
-        area_json = area_json[batch:]
+    now = time.time()
+    pipe = redis_client.pipeline()
+    for i in range(0, len(new_json), batch):
+        args = []
+        for member in new_json[i:i + batch]:
+            args.extend([now, member])
+        pipe.zadd(pipeline_key, *args)
 
     # Expire key after 24 hours
     pipe.expire(pipeline_key, expire)
     pipe.execute()
 
+    if stats_client is not None:
+        stats_client.incr('items.area_queue.enqueued', len(area_json))
+        stats_client.incr('items.area_queue.coalesced',
+                          len(area_json) - len(new_json))
+    return len(new_json)
+
 
 def dequeue_areas(redis_client, pipeline_key, batch=100):
     pipe = redis_client.pipeline()
     pipe.multi()
-    pipe.lrange(pipeline_key, 0, batch - 1)
-    pipe.ltrim(pipeline_key, batch, -1)
+    pipe.zrange(pipeline_key, 0, batch - 1)
+    pipe.zremrangebyrank(pipeline_key, 0, batch - 1)
     return [kombu_loads(item) for item in pipe.execute()[0]]
 
 
+class CellAreaRebuilder(DataTask):
+    """
+    Recompute many areas at once, with the same result as calling
+    :meth:`CellAreaUpdater.update` for each of them.
+
+    A single grouped aggregate query over the cell table fills a
+    temporary staging table, which then replaces the affected rows
+    of the area table: Areas without any cells left are deleted and
+    all others are inserted or updated in one statement.
+    """
+
+    cell_model = Cell
+    cell_area_model = CellArea
+
+    def __init__(self, task, session):
+        DataTask.__init__(self, task, session)
+        self.utcnow = util.utcnow()
+
+    def bbox_columns(self, cell):
+        return [func.min(cell.c.min_lat), func.min(cell.c.min_lon),
+                func.max(cell.c.max_lat), func.max(cell.c.max_lon)]
+
+    def rebuild(self, area_keys, batch=10000):
+        """
+        Recompute the given areas, in batches of area keys.
+
+        Returns the number of areas recomputed.
+        """
+        area_keys = list(area_keys)
+        for i in range(0, len(area_keys), batch):
+            keys = area_keys[i:i + batch]
+            self._create(area_key_stage)
+            self.session.execute(area_key_stage.insert().values([
+                dict([(field, int(getattr(key, field)))
+                      for field in AREA_KEY_FIELDS]) for key in keys]))
+            self._rebuild(key_table=area_key_stage)
+            self._drop(area_key_stage)
+        return len(area_keys)
+
+    def rebuild_mcc(self, mcc):
+        """
+        Recompute all areas of the given mobile country code.
+
+        Returns the number of areas with cells in the country.
+        """
+        return self._rebuild(mcc=mcc)
+
+    def _match(self, table, other):
+        return and_(*[getattr(table.c, field) == getattr(other.c, field)
+                      for field in AREA_KEY_FIELDS])
+
+    def _mcc_condition(self, table, mcc):
+        # Restricting the leading radio column lets MySQL use
+        # the primary key indices.
+        return and_(table.c.radio.in_(list(Radio)), table.c.mcc == mcc)
+
+    def _create(self, table):
+        self._drop(table)
+        table.create(self.session.connection())
+
+    def _drop(self, table):
+        # DROP TABLE without the TEMPORARY keyword would implicitly
+        # commit the current transaction.
+        self.session.execute('DROP TEMPORARY TABLE IF EXISTS %s' % table.name)
+
+    def _rebuild(self, key_table=None, mcc=None):
+        cell = self.cell_model.__table__
+        area = self.cell_area_model.__table__
+        stage = area_stage.c
+        session = self.session
+        self._create(area_stage)
+
+        if key_table is not None:
+            cells = cell.join(key_table, self._match(cell, key_table))
+            cell_condition = None
+            # areas which might have lost all their cells
+            candidates = key_table
+            candidate_condition = None
+        else:
+            cells = cell
+            cell_condition = self._mcc_condition(cell, mcc)
+            candidates = area
+            candidate_condition = self._mcc_condition(area, mcc)
+
+        keys = [getattr(cell.c, field) for field in AREA_KEY_FIELDS]
+        query = select(keys + [
+            func.avg(cell.c.lat),
+            func.avg(cell.c.lon),
+        ] + self.bbox_columns(cell) + [
+            func.truncate(func.avg(cell.c.range), 0),
+            func.count(),
+        ]).select_from(cells).where(and_(
+            cell.c.lat.isnot(None), cell.c.lon.isnot(None))).group_by(*keys)
+        if cell_condition is not None:
+            query = query.where(cell_condition)
+        session.execute(area_stage.insert().from_select(
+            [column.name for column in area_stage.c], query))
+
+        # Delete the areas without any cells left
+        query = select([getattr(candidates.c, field)
+                        for field in AREA_KEY_FIELDS]).select_from(
+            candidates.outerjoin(area_stage,
+                                 self._match(candidates, area_stage))
+        ).where(stage.radio.is_(None))
+        if candidate_condition is not None:
+            query = query.where(candidate_condition)
+        gone = session.execute(query).fetchall()
+        if gone:
+            session.execute(area.delete().where(or_(*[
+                and_(*[getattr(area.c, field) == value
+                       for field, value in zip(AREA_KEY_FIELDS, row)])
+                for row in gone])))
+
+        corners = [(stage.min_lat, stage.min_lon),
+                   (stage.min_lat, stage.max_lon),
+                   (stage.max_lat, stage.min_lon),
+                   (stage.max_lat, stage.max_lon)]
+        area_range = func.round(1000.0 * func.greatest(*[
+            _distance(stage.lat, stage.lon, lat, lon)
+            for lat, lon in corners]))
+        ins = area.insert(on_duplicate=(
+            'modified = values(modified), '
+            'lat = values(lat), '
+            'lon = values(lon), '
+            '`range` = values(`range`), '
+            'avg_cell_range = values(avg_cell_range), '
+            'num_cells = values(num_cells)'))
+        session.execute(ins.from_select(
+            list(AREA_KEY_FIELDS) + [
+                'created', 'modified', 'lat', 'lon', 'range',
+                'avg_cell_range', 'num_cells'],
+            select([getattr(stage, field) for field in AREA_KEY_FIELDS] + [
+                literal(self.utcnow, type_=area.c.created.type),
+                literal(self.utcnow, type_=area.c.modified.type),
+                stage.lat, stage.lon, area_range,
+                stage.avg_cell_range, stage.num_cells])))
+
+        length = session.execute(
+            select([func.count()]).select_from(area_stage)).scalar()
+        self._drop(area_stage)
+        return length
+
+
+class OCIDCellAreaRebuilder(CellAreaRebuilder):
+
+    cell_model = OCIDCell
+    cell_area_model = OCIDCellArea
+
+    def bbox_columns(self, cell):
+        # The SQL version of the OCIDCell min/max properties.
+        lat, lon, radius = cell.c.lat, cell.c.lon, cell.c.range
+        lat_delta = radius / 111111.0
+        lon_delta = radius / (func.cos(lat) * 111111.0)
+        return [
+            func.min(_bound(MIN_LAT, lat - lat_delta, MAX_LAT)),
+            func.min(_bound(MIN_LON, lon - lon_delta, MAX_LON)),
+            func.max(_bound(MIN_LAT, lat + lat_delta, MAX_LAT)),
+            func.max(_bound(MIN_LON, lon + lon_delta, MAX_LON)),
+        ]
+
+
 class CellAreaUpdater(DataTask):
 
     cell_model = Cell
     cell_area_model = CellArea
+    rebuilder = CellAreaRebuilder
 
     def __init__(self, task, session):
         DataTask.__init__(self, task, session)
         self.redis_key = self.task.app.data_queues['cell_area_update']
         self.utcnow = util.utcnow()
 
-    def scan(self, update_task, batch=100):
+    def scan(self, batch=100):
+        """
+        Recompute all distinct areas of a batch of queued area keys,
+        with one grouped aggregate query for the whole batch.
+
+        Returns the number of distinct areas.
+        """
         redis_areas = dequeue_areas(
             self.redis_client, self.redis_key, batch=batch)
 
         area_keys = set(redis_areas)
-        for area_key in area_keys:
-            update_task.delay(area_key)
+        if area_keys:
+            self.rebuilder(self.task, self.session).rebuild(area_keys)
         return len(area_keys)
 
     def update(self, area_key):
@@ -116,3 +392,4 @@ class OCIDCellAreaUpdater(CellAreaUpdater):
 
     cell_model = OCIDCell
     cell_area_model = OCIDCellArea
+    rebuilder = OCIDCellAreaRebuilder
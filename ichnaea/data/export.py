@@ -1,15 +1,122 @@
+import time
+import uuid
+
+from redis.exceptions import WatchError
 import requests
-from simplejson import dumps
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
-from ichnaea.customjson import kombu_loads
 from ichnaea.data.base import DataTask
 from ichnaea.util import encode_gzip
 
+# seconds after which a dequeued batch without a successful upload
+# is put back into its export queue
+PENDING_TIMEOUT = 3600
+
+# seconds a batch holds its upload slot, unless the upload finishes
+# or fails before
+UPLOAD_TIMEOUT = 300
+
+# retry uploads failing with these status codes or failing to connect
+# inside the upload task, waiting 0, 1 and 2 seconds before the retries
+UPLOAD_RETRY_STATUS = (500, 502, 503, 504)
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 0.5
+
+# one pooled session per export url and worker process
+_upload_sessions = {}
+
+
+def upload_backoff(retry):
+    # same as the urllib3 Retry backoff, no wait before the first retry
+    if retry <= 1:
+        return 0
+    return UPLOAD_BACKOFF * (2 ** (retry - 1))
+
+
+def upload_session(url):
+    session = _upload_sessions.get(url)
+    if session is None:
+        # Only retry failed connects, as the request wasn't sent yet.
+        # Uploads aren't idempotent, so read errors aren't retried, and
+        # 5xx responses are retried by the uploader, recording each one.
+        retries = Retry(
+            total=UPLOAD_RETRIES,
+            connect=UPLOAD_RETRIES,
+            read=False,
+            backoff_factor=UPLOAD_BACKOFF)
+        adapter = HTTPAdapter(pool_connections=1, max_retries=retries)
+        session = _upload_sessions[url] = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
 
 def queue_length(redis_client, redis_key):
     return redis_client.llen(redis_key)
 
 
+def pending_key(redis_key):
+    # sorted set of the dequeued batches, scored by dequeue time
+    return redis_key + ':pending'
+
+
+def uploads_key(redis_key):
+    # sorted set of the batches holding an upload slot, scored by the
+    # time their slot expires
+    return redis_key + ':uploads'
+
+
+def acknowledge_batch(redis_client, redis_key, batch_key):
+    pipe = redis_client.pipeline()
+    pipe.delete(batch_key)
+    pipe.zrem(pending_key(redis_key), batch_key)
+    pipe.zrem(uploads_key(redis_key), batch_key)
+    pipe.execute()
+
+
+def claim_upload(redis_client, redis_key, batch_key, pipe=None):
+    (pipe or redis_client).zadd(
+        uploads_key(redis_key), time.time() + UPLOAD_TIMEOUT, batch_key)
+
+
+def release_upload(redis_client, redis_key, batch_key):
+    redis_client.zrem(uploads_key(redis_key), batch_key)
+
+
+def active_uploads(redis_client, redis_key):
+    # Failed uploads release their slot right away, the slots of
+    # crashed workers expire on their own.
+    return redis_client.zcount(uploads_key(redis_key), time.time(), '+inf')
+
+
+def reclaim_batches(redis_client, redis_key, timeout=PENDING_TIMEOUT):
+    # Put the items of all batches pending for longer than the timeout,
+    # for example due to a crashed worker, back into the queue.
+    now = time.time()
+    redis_client.zremrangebyscore(uploads_key(redis_key), '-inf', now)
+    pending = pending_key(redis_key)
+    batch_keys = redis_client.zrangebyscore(pending, '-inf', now - timeout)
+    reclaimed = 0
+    for batch_key in batch_keys:
+        with redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(batch_key)
+                items = pipe.lrange(batch_key, 0, -1)
+                pipe.multi()
+                if items:
+                    # the tail of the queue is dequeued first
+                    pipe.rpush(redis_key, *items)
+                pipe.delete(batch_key)
+                pipe.zrem(pending, batch_key)
+                pipe.execute()
+            except WatchError:  # pragma: no cover
+                # the batch was acknowledged in the meantime
+                continue
+        reclaimed += len(items)
+    return reclaimed
+
+
 class ExportScheduler(DataTask):
 
     def __init__(self, task, session):
@@ -23,30 +130,61 @@ class ExportScheduler(DataTask):
         triggered = 0
         for name, settings in self.export_queues.items():
             redis_key = settings['redis_key']
-            if self.queue_length(redis_key) >= settings['batch']:
+            reclaimed = reclaim_batches(self.redis_client, redis_key)
+            if reclaimed:
+                self.stats_client.incr(
+                    'items.export.%s.reclaimed' % name, reclaimed)
+            # start as many exports as there are full batches and
+            # free upload slots for this export target
+            batches = self.queue_length(redis_key) // settings['batch']
+            slots = (settings.get('concurrency', 1) -
+                     active_uploads(self.redis_client, redis_key))
+            for i in range(min(batches, slots)):
                 export_task.delay(name)
                 triggered += 1
         return triggered
 
 
-class ReportExporter(DataTask):
+class ExportQueue(DataTask):
+    # the settings and state of one export target
 
     def __init__(self, task, session, export_name):
         DataTask.__init__(self, task, session)
         self.export_name = export_name
         self.settings = task.app.export_queues[self.export_name]
         self.batch = self.settings['batch']
+        self.concurrency = self.settings.get('concurrency', 1)
         self.redis_key = self.settings['redis_key']
 
     def queue_length(self):
         return queue_length(self.redis_client, self.redis_key)
 
+    def can_export(self):
+        # is there a full batch and a free upload slot
+        return (self.queue_length() >= self.batch and
+                active_uploads(self.redis_client, self.redis_key) <
+                self.concurrency)
+
+
+class ReportExporter(ExportQueue):
+
     def dequeue_reports(self):
+        # Atomically move a batch of the oldest items into a new list,
+        # registered as pending until its upload is acknowledged. Each
+        # item is handed to exactly one worker and survives the worker
+        # crashing, as pending batches are eventually reclaimed. The
+        # batch also claims an upload slot.
+        batch_key = '%s:batch:%s' % (self.redis_key, uuid.uuid4().hex)
         pipe = self.redis_client.pipeline()
-        pipe.multi()
-        pipe.lrange(self.redis_key, 0, self.batch - 1)
-        pipe.ltrim(self.redis_key, self.batch, -1)
-        return pipe.execute()[0]
+        for i in range(self.batch):
+            pipe.rpoplpush(self.redis_key, batch_key)
+        pipe.zadd(pending_key(self.redis_key), time.time(), batch_key)
+        claim_upload(self.redis_client, self.redis_key, batch_key, pipe=pipe)
+        queued_items = [item for item in pipe.execute()[:self.batch]
+                        if item is not None]
+        if not queued_items:  # pragma: no cover
+            acknowledge_batch(self.redis_client, self.redis_key, batch_key)
+        return (batch_key, queued_items)
 
     def export(self, export_task, upload_task):
         length = self.queue_length()
@@ -54,42 +192,61 @@ class ReportExporter(DataTask):
             # not enough to do, skip
             return 0
 
-        queued_items = self.dequeue_reports()
-        if queued_items and len(queued_items) < self.batch:  # pragma: no cover
-            # race condition, something emptied the queue in between
-            # our llen call and fetching the items, put them back
-            self.redis_client.lpush(self.redis_key, *queued_items)
+        batch_key, queued_items = self.dequeue_reports()
+        if not queued_items:  # pragma: no cover
+            # race condition, another worker emptied the queue in
+            # between our llen call and fetching the items
             return 0
 
-        # schedule the upload task
-        items = [kombu_loads(item) for item in queued_items]
-        # split out metadata
-        reports = [item['report'] for item in items]
-
-        upload_task.delay(self.export_name, dumps({'items': reports}))
+        # schedule the upload task, passing only a reference to the batch
+        upload_task.delay(self.export_name, batch_key)
 
         # check the queue at the end, if there's still enough to do
-        # immediately schedule another job
-        if self.queue_length() >= self.batch:
+        # and a free upload slot, immediately schedule another job
+        if self.can_export():
             export_task.apply_async(args=[self.export_name], expires=300)
 
         return len(queued_items)
 
 
-class ReportUploader(DataTask):
+class ReportUploader(ExportQueue):
 
     def __init__(self, task, session, export_name):
-        DataTask.__init__(self, task, session)
-        self.export_name = export_name
-        self.settings = task.app.export_queues[self.export_name]
+        ExportQueue.__init__(self, task, session, export_name)
         self.url = self.settings['url']
 
-    def upload(self, data):
-        if self.url is None:
+    def upload(self, batch_key, export_task=None):
+        # the batch items are encoded reports, join them into one document
+        queued_items = self.redis_client.lrange(batch_key, 0, -1)
+        if not queued_items:  # pragma: no cover
+            # the batch was already uploaded or reclaimed
             return False
-        return self.send(self.url, data)
 
-    def send(self, url, data):
+        result = False
+        if self.url is not None:
+            data = ['{"items": [']
+            for item in queued_items:
+                data.extend((item, ', '))
+            data[-1] = ']}'
+            # a retried upload claims a slot again
+            claim_upload(self.redis_client, self.redis_key, batch_key)
+            try:
+                result = self.send(self.url, data, len(queued_items))
+            except Exception:
+                # free the slot for other batches, while this one
+                # stays pending until it is retried or reclaimed
+                release_upload(self.redis_client, self.redis_key, batch_key)
+                raise
+
+        # the upload didn't raise, the batch can be dropped
+        acknowledge_batch(self.redis_client, self.redis_key, batch_key)
+
+        # the upload slot is free again, continue with the next batch
+        if export_task is not None and self.can_export():
+            export_task.apply_async(args=[self.export_name], expires=300)
+        return result
+
+    def send(self, url, data, reports):
         stats_client = self.stats_client
         stats_prefix = 'items.export.%s.' % self.export_name
 
@@ -99,21 +256,36 @@ class ReportUploader(DataTask):
             'User-Agent': 'ichnaea',
         }
 
-        with stats_client.timer(stats_prefix + 'upload'):
-            response = requests.post(
-                url,
-                data=encode_gzip(data),
-                headers=headers,
-                timeout=60.0,
-                verify=False,  # TODO switch this back on
-            )
-
-        # log upload_status and trigger exception for bad responses
-        # this causes the task to be re-tried
-        response_code = response.status_code
-        stats_client.incr('%supload_status.%s' % (stats_prefix, response_code))
+        # Compress the document chunk by chunk, without joining the
+        # uncompressed items. The compressed body is sent as one string
+        # with a Content-Length, so it can be sent again on retries.
+        data = encode_gzip(data)
+        session = upload_session(url)
+        for retry in range(UPLOAD_RETRIES + 1):
+            if retry:
+                time.sleep(upload_backoff(retry))
+            with stats_client.timer(stats_prefix + 'upload'):
+                response = session.post(
+                    url,
+                    data=data,
+                    headers=headers,
+                    timeout=60.0,
+                    verify=False,  # TODO switch this back on
+                )
+
+            # log upload_status of every response
+            response_code = response.status_code
+            stats_client.incr(
+                '%supload_status.%s' % (stats_prefix, response_code))
+            if response_code not in UPLOAD_RETRY_STATUS:
+                break
+
+        # trigger exception for bad responses, this causes the task
+        # to be re-tried
         response.raise_for_status()
 
         # only log successful uploads
         stats_client.incr(stats_prefix + 'batches')
+        stats_client.incr(stats_prefix + 'reports', reports)
+        stats_client.incr(stats_prefix + 'upload_bytes', len(data))
         return True
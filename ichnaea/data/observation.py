@@ -1,34 +1,122 @@
 from collections import defaultdict
+from zlib import crc32
 
+from redis.exceptions import LockError
 from sqlalchemy.orm import load_only
 
 from ichnaea.constants import (
     PERMANENT_BLACKLIST_THRESHOLD,
     TEMPORARY_BLACKLIST_DURATION,
 )
-from ichnaea.customjson import decode_radio_dict
+from ichnaea.customjson import (
+    decode_radio_dict,
+    encode_radio_dict,
+    kombu_dumps,
+    kombu_loads,
+)
 from ichnaea.data.base import DataTask
+from ichnaea.data.station import (
+    count_backlog_change,
+    update_backlog,
+)
 from ichnaea.models import (
     Cell,
+    CellAggregate,
     CellBlacklist,
     CellObservation,
     Score,
     ScoreKey,
     ValidCellKeySchema,
     Wifi,
+    WifiAggregate,
     WifiBlacklist,
     WifiObservation,
 )
 from ichnaea import util
 
+# Merge new observations into the running aggregates of a station
+AGGREGATE_ON_DUPLICATE = ', '.join([
+    'new_measures = new_measures + VALUES(new_measures)',
+    'lat_sum = lat_sum + VALUES(lat_sum)',
+    'lon_sum = lon_sum + VALUES(lon_sum)',
+    'max_lat = GREATEST(max_lat, VALUES(max_lat))',
+    'min_lat = LEAST(min_lat, VALUES(min_lat))',
+    'max_lon = GREATEST(max_lon, VALUES(max_lon))',
+    'min_lon = LEAST(min_lon, VALUES(min_lon))',
+])
+
+
+def station_partition(key, partitions):
+    # A stable hash of the station key, independent of the Python
+    # process and platform, so all observations for one station
+    # always end up in the same partition.
+    value = '|'.join([str(getattr(key, field, None))
+                      for field in key._fields])
+    return (crc32(value) & 0xffffffff) % partitions
+
+
+def enqueue_observations(redis_client, redis_keys, observation_model,
+                         observations, userid=None, expire=86400):
+    # group the observations by station key and push one item per
+    # station into the partition responsible for the station
+    stations = defaultdict(list)
+    for obs in observations:
+        stations[observation_model.to_hashkey(obs)].append(
+            encode_radio_dict(obs))
+
+    partitions = defaultdict(list)
+    for key, values in stations.items():
+        redis_key = redis_keys[station_partition(key, len(redis_keys))]
+        partitions[redis_key].append(str(kombu_dumps({
+            'userid': userid,
+            'observations': values,
+        })))
+
+    pipe = redis_client.pipeline()
+    for redis_key, items in partitions.items():
+        pipe.lpush(redis_key, *items)
+        # Expire key after 24 hours
+        pipe.expire(redis_key, expire)
+    pipe.execute()
+    return len(stations)
+
+
+def dequeue_observations(redis_client, redis_key, batch=100):
+    pipe = redis_client.pipeline()
+    pipe.multi()
+    pipe.lrange(redis_key, -batch, -1)
+    pipe.ltrim(redis_key, 0, -batch - 1)
+    # oldest items are at the end of the list
+    return pipe.execute()[0]
+
+
+class StagingScheduler(DataTask):
+
+    def __init__(self, task, session):
+        DataTask.__init__(self, task, session)
+        self.insert_queues = task.app.insert_queues
+
+    def schedule(self, insert_tasks):
+        triggered = 0
+        for station_type, redis_keys in self.insert_queues.items():
+            insert_task = insert_tasks[station_type]
+            for partition, redis_key in enumerate(redis_keys):
+                if self.redis_client.llen(redis_key):
+                    insert_task.delay(partition)
+                    triggered += 1
+        return triggered
+
 
 class ObservationQueue(DataTask):
 
+    staging_lock_timeout = 300
+
     def __init__(self, task, session, utcnow=None):
         DataTask.__init__(self, task, session)
         if utcnow is None:
             utcnow = util.utcnow()
         self.utcnow = utcnow
+        self.station_aggregates = task.app.station_aggregates
 
     def stat_count(self, action, what, count):
         if count != 0:
@@ -47,19 +135,22 @@ class ObservationQueue(DataTask):
 
     def insert(self, entries, userid=None):
         all_observations = []
+        aggregates = []
+        backlog = defaultdict(int)
         drop_counter = defaultdict(int)
         new_stations = 0
 
-        # Process entries and group by validated station key
-        station_observations = defaultdict(list)
+        # Validate all entries in one batch and group by station key
         for entry in entries:
             self.pre_process_entry(entry)
 
-            obs = self.observation_model.create(**entry)
-            if not obs:
-                drop_counter['malformed'] += 1
-                continue
+        observations, malformed = self.observation_model.create_batch(entries)
+        for reason, count in malformed.items():
+            drop_counter['malformed'] += count
+            drop_counter['malformed_' + reason] += count
 
+        station_observations = defaultdict(list)
+        for obs in observations:
             station_observations[obs.hashkey()].append(obs)
 
         # Process observations one station at a time
@@ -87,8 +178,22 @@ class ObservationQueue(DataTask):
             # Accept incomplete observations, just don't make stations for them
             # (station creation is a side effect of count-updating)
             if not incomplete and num > 0:
+                old = station.new_measures if station is not None else 0
+                count_backlog_change(backlog, old, old + num)
                 self.create_or_update_station(station, key, num,
                                               first_blacklisted)
+                if self.station_aggregates:
+                    aggregates.append(
+                        self.aggregate_values(key, observations))
+
+        if aggregates:
+            self.update_aggregates(aggregates)
+        if backlog:
+            self.session.on_post_commit(
+                update_backlog,
+                self.redis_client,
+                self.station_type,
+                backlog)
 
         # Credit the user with discovering any new stations.
         if userid is not None and new_stations > 0:
@@ -104,6 +209,79 @@ class ObservationQueue(DataTask):
         self.session.add_all(all_observations)
         return added
 
+    def aggregate_values(self, key, observations):
+        latitudes = [obs.lat for obs in observations]
+        longitudes = [obs.lon for obs in observations]
+        values = self.aggregate_model.to_hashkey(key).__dict__.copy()
+        values.update({
+            'new_measures': len(observations),
+            'lat_sum': sum(latitudes),
+            'lon_sum': sum(longitudes),
+            'max_lat': max(latitudes),
+            'min_lat': min(latitudes),
+            'max_lon': max(longitudes),
+            'min_lon': min(longitudes),
+        })
+        return values
+
+    def update_aggregates(self, aggregates):
+        # Add the new observations to the running aggregates of
+        # their stations, in one statement for all stations.
+        stmt = self.aggregate_model.__table__.insert(
+            on_duplicate=AGGREGATE_ON_DUPLICATE).values(aggregates)
+        self.session.execute(stmt)
+
+    def insert_staged(self, insert_task, partition=0, batch=100):
+        # Drain up to batch station groups from one staging partition.
+        # Small backlogs are processed immediately, large ones in
+        # batches of the maximum size, chaining more tasks as needed.
+        redis_key = self.task.app.insert_queues[self.station_type][partition]
+
+        # Only one task at a time may work on any given partition, so
+        # the same station is never updated by two workers in parallel.
+        lock = self.redis_client.lock(
+            redis_key + ':lock', timeout=self.staging_lock_timeout)
+        if not lock.acquire(blocking=False):
+            self.stat_count('staged', 'partition_busy', 1)
+            return 0
+
+        try:
+            queued_items = dequeue_observations(
+                self.redis_client, redis_key, batch=batch)
+            if not queued_items:
+                return 0
+
+            user_entries = defaultdict(list)
+            for queued_item in reversed(queued_items):
+                item = kombu_loads(queued_item)
+                user_entries[item['userid']].extend(item['observations'])
+
+            try:
+                added = 0
+                for userid, entries in user_entries.items():
+                    added += self.insert(entries, userid=userid)
+                self.session.commit()
+            except Exception:
+                # put the data back at the end of the queue, to be retried
+                self.redis_client.rpush(redis_key, *queued_items)
+                raise
+
+            self.stats_client.incr(
+                'items.staged.%s_%d' % (self.station_type, partition),
+                len(queued_items))
+        finally:
+            try:
+                lock.release()
+            except LockError:  # pragma: no cover
+                # the lock expired and another task might own it by now
+                pass
+
+        if self.redis_client.llen(redis_key) >= batch:
+            insert_task.apply_async(
+                args=[partition], kwargs={'batch': batch}, expires=300)
+
+        return added
+
     def blacklisted_station(self, key):
         query = (self.blacklist_model.querykey(self.session, key)
                                      .options(load_only('count', 'time')))
@@ -153,6 +331,7 @@ class CellObservationQueue(ObservationQueue):
     station_model = Cell
     observation_model = CellObservation
     blacklist_model = CellBlacklist
+    aggregate_model = CellAggregate
 
     def pre_process_entry(self, entry):
         ObservationQueue.pre_process_entry(self, entry)
@@ -176,3 +355,4 @@ class WifiObservationQueue(ObservationQueue):
     station_model = Wifi
     observation_model = WifiObservation
     blacklist_model = WifiBlacklist
+    aggregate_model = WifiAggregate
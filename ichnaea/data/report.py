@@ -2,13 +2,12 @@ from collections import defaultdict
 from random import random
 import uuid
 
+from simplejson import dumps
 from sqlalchemy.sql import and_, or_
 
-from ichnaea.customjson import (
-    encode_radio_dict,
-    kombu_dumps,
-)
+from ichnaea.customjson import encode_radio_dict
 from ichnaea.data.base import DataTask
+from ichnaea.data.observation import enqueue_observations
 from ichnaea.models import (
     CellObservation,
     CellReport,
@@ -35,6 +34,7 @@ class ReportQueueV1(DataTask):
         self.api_key_name = api_key_name
         self.insert_cell_task = insert_cell_task
         self.insert_wifi_task = insert_wifi_task
+        self.insert_queues = task.app.insert_queues
 
     def insert(self, reports, nickname='', email=''):
         length = len(reports)
@@ -75,6 +75,15 @@ class ReportQueueV1(DataTask):
                     'cell_observations' % self.api_key_name,
                     len(cell_observations))
 
+        if cell_observations and self.insert_queues.get('cell'):
+            # append observations to the staging queues, to be picked
+            # up by the scheduled insert_staged_cell tasks
+            enqueue_observations(self.redis_client,
+                                 self.insert_queues['cell'],
+                                 CellObservation,
+                                 cell_observations,
+                                 userid=userid)
+        elif cell_observations:
             cells = defaultdict(list)
             for obs in cell_observations:
                 cells[CellObservation.to_hashkey(obs)].append(obs)
@@ -109,6 +118,13 @@ class ReportQueueV1(DataTask):
                     'wifi_observations' % self.api_key_name,
                     len(wifi_observations))
 
+        if wifi_observations and self.insert_queues.get('wifi'):
+            enqueue_observations(self.redis_client,
+                                 self.insert_queues['wifi'],
+                                 WifiObservation,
+                                 wifi_observations,
+                                 userid=userid)
+        elif wifi_observations:
             wifis = defaultdict(list)
             for obs in wifi_observations:
                 wifis[WifiObservation.to_hashkey(obs)].append(obs)
@@ -269,21 +285,19 @@ class ReportQueueV2(DataTask):
         return len(reports)
 
     def queue_export(self, reports):
-        metadata = {
-            'api_key': self.api_key,
-            'email': self.email,
-            'nickname': self.nickname,
-        }
         # temporary export throttle
         throttle = float(self.redis_client.get('throttle_export') or 1.0)
+        # queue the reports as encoded JSON fragments, so the exporter
+        # can assemble batches without decoding and encoding them again
         data = []
         for report in reports:
             if random() <= throttle:
-                data.append(str(kombu_dumps({'report': report,
-                                             'metadata': metadata})))
+                data.append(dumps(report))
         if data:
+            pipe = self.redis_client.pipeline()
             for name, settings in self.export_queues.items():
                 redis_key = settings['redis_key']
                 source_apikey = settings.get('source_apikey', _sentinel)
                 if self.api_key != source_apikey:
-                    self.redis_client.lpush(redis_key, *data)
+                    pipe.lpush(redis_key, *data)
+            pipe.execute()
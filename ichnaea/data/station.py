@@ -1,39 +1,183 @@
-from sqlalchemy.orm import load_only
+from collections import defaultdict
+import random
+import time
+
+import numpy
+from redis.exceptions import LockError
+from sqlalchemy.sql import (
+    and_,
+    func,
+    literal,
+    or_,
+    select,
+    union_all,
+)
 
+from ichnaea.async.config import (
+    DELETED_CELLS_KEY,
+    STATION_BACKLOG_KEY,
+    STATION_LEASE_KEY,
+)
 from ichnaea.data.area import enqueue_areas
 from ichnaea.data.base import DataTask
-from ichnaea.geocalc import (
-    distance,
-    range_to_points,
-)
+from ichnaea.geocalc import distances
 from ichnaea.models import (
     Cell,
+    CellAggregate,
     CellArea,
     CellBlacklist,
     CellObservation,
     Wifi,
+    WifiAggregate,
     WifiBlacklist,
     WifiObservation,
 )
 from ichnaea import util
 
+# The location update bands, as the range of new observations per
+# station, the maximum batch size and the maximum number of seconds
+# between updates while the backlog is smaller than the batch size
+UPDATE_BANDS = (
+    (1, 10, 4000, 30),
+    (10, 1000, 1000, 150),
+    (1000, 1000000, 100, 310),
+)
+# Seconds after which a chain of update tasks is considered stalled
+UPDATE_CHAIN_TIMEOUT = 60
+# Number of shards of each band, which can be updated in parallel
+UPDATE_SHARDS = 4
+# Seconds after which the backlog estimates are counted again
+UPDATE_RECOUNT_INTERVAL = 600
+
+
+def backlog_band(new_measures):
+    # Return the name of the update band of a station with the given
+    # number of new observations, or None.
+    for min_new, max_new, batch, interval in UPDATE_BANDS:
+        if min_new <= new_measures < max_new:
+            return '%d_%d' % (min_new, max_new)
+    return None
+
+
+def count_backlog_change(changes, old, new):
+    # Track a station moving from one update band into another.
+    old_band = backlog_band(old)
+    new_band = backlog_band(new)
+    if old_band != new_band:
+        if old_band is not None:
+            changes[old_band] -= 1
+        if new_band is not None:
+            changes[new_band] += 1
+
+
+def update_backlog(redis_client, station_type, changes):
+    # Apply the changes to the backlog estimates.
+    redis_key = STATION_BACKLOG_KEY % station_type
+    pipe = redis_client.pipeline()
+    for band, change in changes.items():
+        if change:
+            pipe.hincrby(redis_key, band, change)
+    pipe.execute()
+
+
+def cell_export_key(key):
+    """
+    Return the key of a cell as a comma separated string of numbers,
+    or None if the key is incomplete.
+    """
+    key = Cell.to_hashkey(key)
+    values = (key.radio, key.mcc, key.mnc, key.lac, key.cid)
+    if None in values:
+        return None
+    return '%d,%d,%d,%d,%d' % tuple([int(value) for value in values])
+
+
+def record_deleted_cells(session, redis_client, cell_keys, expire=604800):
+    # Remember removed cells for the incremental cell export.
+    now = time.time()
+    args = []
+    for key in cell_keys:
+        member = cell_export_key(key)
+        if member is not None:
+            args.extend([now, member])
+    if not args:
+        return
+    pipe = redis_client.pipeline()
+    pipe.zadd(DELETED_CELLS_KEY, *args)
+    pipe.expire(DELETED_CELLS_KEY, expire)
+    pipe.execute()
+
+
+def _station_columns(stations, fields):
+    # Return one array per field, with the field values of all stations
+    # and NaN for missing values.
+    return numpy.array(
+        [[numpy.nan if value is None else value
+          for value in [getattr(station, field) for field in fields]]
+         for station in stations], dtype=numpy.double).reshape(
+        -1, len(fields)).T
+
+
+def summarize_observations(groups):
+    """
+    Summarize each of the given non-empty groups of observations.
+
+    Returns an array with one column per group, holding the number of
+    observations, the sums of their latitudes and longitudes, and
+    their min/max latitude and longitude. All groups are reduced at
+    once, as segments of a single array of all observations.
+    """
+    if not groups:
+        return numpy.zeros((7, 0))
+    lengths = numpy.array([len(group) for group in groups])
+    starts = numpy.cumsum(lengths) - lengths
+    lats = numpy.array([obs.lat for group in groups for obs in group],
+                       dtype=numpy.double)
+    lons = numpy.array([obs.lon for group in groups for obs in group],
+                       dtype=numpy.double)
+    return numpy.array([
+        lengths,
+        numpy.add.reduceat(lats, starts),
+        numpy.add.reduceat(lons, starts),
+        numpy.minimum.reduceat(lats, starts),
+        numpy.maximum.reduceat(lats, starts),
+        numpy.minimum.reduceat(lons, starts),
+        numpy.maximum.reduceat(lons, starts),
+    ], dtype=numpy.double)
+
+
+def summarize_aggregates(aggregates):
+    """
+    Summarize the observations of the given running aggregates, in the
+    same form as :func:`summarize_observations`.
+    """
+    return _station_columns(aggregates, (
+        'new_measures', 'lat_sum', 'lon_sum',
+        'min_lat', 'max_lat', 'min_lon', 'max_lon'))
+
 
 class StationRemover(DataTask):
 
+    # Number of stations removed with one statement
+    batch = 100
+
     def __init__(self, task, session):
         DataTask.__init__(self, task, session)
 
+    def delete_stations(self, model, keys):
+        keys = list(keys)
+        removed = 0
+        for i in range(0, len(keys), self.batch):
+            query = model.querykeys(self.session, keys[i:i + self.batch])
+            removed += query.delete(synchronize_session=False)
+        return removed
+
 
 class CellRemover(StationRemover):
 
     def remove(self, cell_keys):
-        cells_removed = 0
-        changed_areas = set()
-
-        for key in cell_keys:
-            query = Cell.querykey(self.session, key)
-            cells_removed += query.delete()
-            changed_areas.add(CellArea.to_hashkey(key))
+        cells_removed = self.delete_stations(Cell, cell_keys)
+        changed_areas = set([CellArea.to_hashkey(key) for key in cell_keys])
 
         if changed_areas:
             redis_key = self.task.app.data_queues['cell_area_update']
@@ -41,7 +185,14 @@ class CellRemover(StationRemover):
                 enqueue_areas,
                 self.redis_client,
                 changed_areas,
-                redis_key)
+                redis_key,
+                stats_client=self.stats_client)
+
+        if cells_removed:
+            self.session.on_post_commit(
+                record_deleted_cells,
+                self.redis_client,
+                cell_keys)
 
         return cells_removed
 
@@ -49,21 +200,121 @@ class CellRemover(StationRemover):
 class WifiRemover(StationRemover):
 
     def remove(self, wifi_keys):
-        query = Wifi.querykeys(self.session, wifi_keys)
-        length = query.delete(synchronize_session=False)
-        return length
+        return self.delete_stations(Wifi, wifi_keys)
+
+
+class UpdateScheduler(DataTask):
+    """
+    Schedule location update tasks for each band of stations, based on
+    estimates of the number of stations in each band. The estimates are
+    kept in Redis by the insert and update tasks and counted again every
+    ``UPDATE_RECOUNT_INTERVAL`` seconds.
+
+    Bands with a backlog of at least a full batch are updated by up to
+    ``UPDATE_SHARDS`` parallel chains of tasks, each scheduling the next
+    one right away. Smaller backlogs are updated at most every band
+    interval, by a single task sweeping all shards.
+    """
+
+    station_models = {
+        'cell': Cell,
+        'wifi': Wifi,
+    }
+
+    def recount(self, station_type, now):
+        model = self.station_models[station_type]
+        values = {'counted': now}
+        for min_new, max_new, batch, interval in UPDATE_BANDS:
+            query = (self.session.query(func.count())
+                                 .select_from(model)
+                                 .filter(model.new_measures >= min_new)
+                                 .filter(model.new_measures < max_new))
+            values['%d_%d' % (min_new, max_new)] = query.scalar()
+        self.redis_client.hmset(STATION_BACKLOG_KEY % station_type, values)
+        return values
+
+    def backlog(self, station_type, now):
+        values = self.redis_client.hgetall(STATION_BACKLOG_KEY % station_type)
+        counted = float(values.get('counted', 0))
+        if now - counted >= UPDATE_RECOUNT_INTERVAL:
+            values.update(self.recount(station_type, now))
+        return values
+
+    def schedule(self, update_tasks):
+        triggered = 0
+        now = time.time()
+        for station_type, update_task in sorted(update_tasks.items()):
+            redis_key = STATION_BACKLOG_KEY % station_type
+            backlog = self.backlog(station_type, now)
+            for min_new, max_new, batch, interval in UPDATE_BANDS:
+                band = '%d_%d' % (min_new, max_new)
+                count = max(int(backlog.get(band, 0)), 0)
+                self.stats_client.gauge(
+                    'task.data.location_update_%s.new_measures_%s' % (
+                        station_type, band),
+                    count)
+                if not count:
+                    continue
+
+                elapsed = now - float(backlog.get('last_' + band, 0))
+                if count >= batch:
+                    # restart stalled chains
+                    due = elapsed >= UPDATE_CHAIN_TIMEOUT
+                    chains = min(count // batch, UPDATE_SHARDS)
+                else:
+                    due = elapsed >= interval
+                    chains = 1
+                if not due:
+                    continue
+
+                # A single task for a small backlog sweeps all shards.
+                self.redis_client.hset(redis_key, 'last_' + band, now)
+                for i in range(chains):
+                    update_task.apply_async(
+                        args=[min_new, max_new, min(count, batch)],
+                        kwargs={'adaptive': True, 'shards': UPDATE_SHARDS,
+                                'sweep': count < batch},
+                        expires=interval)
+                triggered += chains
+        return triggered
+
+    def chain(self, update_task, station_type, min_new, max_new):
+        # Continue with the next batch while the backlog is large.
+        redis_key = STATION_BACKLOG_KEY % station_type
+        band = '%d_%d' % (min_new, max_new)
+        for band_min, band_max, batch, interval in UPDATE_BANDS:
+            if (band_min, band_max) == (min_new, max_new):
+                break
+        else:  # pragma: no cover
+            return False
+
+        count = int(self.redis_client.hget(redis_key, band) or 0)
+        if count < batch:
+            return False
+        self.redis_client.hset(redis_key, 'last_' + band, time.time())
+        update_task.apply_async(
+            args=[min_new, max_new, batch],
+            kwargs={'adaptive': True, 'shards': UPDATE_SHARDS},
+            expires=interval)
+        return True
 
 
 class StationUpdater(DataTask):
 
     MAX_OLD_OBSERVATIONS = 1000
+    # Number of stations whose observations are fetched in one query
+    OBSERVATION_BATCH = 100
+
+    lease_timeout = 300
 
     def __init__(self, task, session,
-                 min_new=10, max_new=100, remove_task=None):
+                 min_new=10, max_new=100, remove_task=None, shards=1):
         DataTask.__init__(self, task, session)
         self.min_new = min_new
         self.max_new = max_new
         self.remove_task = remove_task
+        self.shards = shards
+        self.station_aggregates = task.app.station_aggregates
         self.updated_areas = set()
 
     def emit_new_observation_metric(self):
@@ -73,114 +324,233 @@ class StationUpdater(DataTask):
                 self.task_shortname, self.min_new, self.max_new),
             num)
 
-    def station_query(self):
+    def leases(self, sweep=False):
+        """
+        Claim the shards of the update band, one at a time. Yields the
+        shard number while its lease is held, for only one free shard,
+        or for all free shards in turn if ``sweep`` is set.
+
+        The stations of a band are split into ``shards`` shards, so that
+        concurrent tasks each update their own set of stations.
+        """
+        band = '%d_%d' % (self.min_new, self.max_new)
+        offset = random.randrange(self.shards)
+        leased = False
+        for i in range(self.shards):
+            shard = (offset + i) % self.shards
+            lock = self.redis_client.lock(
+                STATION_LEASE_KEY % (self.station_type, band, shard),
+                timeout=self.lease_timeout)
+            if not lock.acquire(blocking=False):
+                continue
+            leased = True
+            try:
+                yield shard
+            finally:
+                try:
+                    lock.release()
+                except LockError:  # pragma: no cover
+                    # the lease expired and another task might own it
+                    pass
+            if not sweep:
+                break
+
+        if not leased:
+            self.stats_client.incr(
+                'items.update.%s_lease_busy' % self.station_type)
+
+    def run(self, batch=10, emit_metric=True, sweep=False):
+        """
+        Update up to ``batch`` stations of one free shard, or of all
+        free shards if ``sweep`` is set, committing each shard while
+        its lease is held.
+
+        Returns the number of updated and of moving stations.
+        """
+        stations = moving = 0
+        for shard in self.leases(sweep=sweep):
+            updated, moved = self.update(
+                batch=batch, emit_metric=emit_metric, shard=shard)
+            self.session.commit()
+            emit_metric = False
+            stations += updated
+            moving += moved
+        return (stations, moving)
+
+    def station_query(self, shard=None):
         model = self.station_model
         query = (self.session.query(model)
                              .filter(model.new_measures >= self.min_new)
                              .filter(model.new_measures < self.max_new))
+        if shard is not None and self.shards > 1:
+            column = getattr(model, self.shard_column)
+            query = query.filter(column % self.shards == shard)
         return query
 
-    def observation_query(self, station):
-        # only take the last X new_measures
+    def observation_query(self, station, index):
+        # only take the last X new_measures, tagged with the
+        # index of the station in the batch
         model = self.observation_model
-        query = (model.querykey(self.session, station)
-                      .options(load_only('lat', 'lon'))
-                      .order_by(model.created.desc())
-                      .limit(station.new_measures))
-        return query
-
-    def calculate_new_position(self, station, observations):
-        # This function returns True if the station was found to be moving.
-        length = len(observations)
-        latitudes = [obs.lat for obs in observations]
-        longitudes = [obs.lon for obs in observations]
-        new_lat = sum(latitudes) / length
-        new_lon = sum(longitudes) / length
-
-        if station.lat and station.lon:
-            latitudes.append(station.lat)
-            longitudes.append(station.lon)
-            existing_station = True
-        else:
-            station.lat = new_lat
-            station.lon = new_lon
-            existing_station = False
-
-        # calculate extremes of observations, existing location estimate
-        # and existing extreme values
-        def extreme(vals, attr, function):
-            new = function(vals)
-            old = getattr(station, attr, None)
-            if old is not None:
-                return function(new, old)
+        query = (select([literal(index).label('station'),
+                         model.lat, model.lon])
+                 .where(and_(*model.joinkey(station)))
+                 .order_by(model.created.desc())
+                 .limit(station.new_measures))
+        return query.alias().select()
+
+    def observations(self, stations):
+        """
+        Return a list of the new observations of each of the stations.
+
+        The observations of up to ``OBSERVATION_BATCH`` stations are
+        fetched in one query, a union of the per-station queries.
+        """
+        result = [[] for station in stations]
+        for start in range(0, len(stations), self.OBSERVATION_BATCH):
+            queries = []
+            for index in range(start, min(start + self.OBSERVATION_BATCH,
+                                          len(stations))):
+                queries.append(
+                    self.observation_query(stations[index], index))
+            if len(queries) > 1:
+                query = union_all(*queries)
             else:
-                return new
-
-        min_lat = extreme(latitudes, 'min_lat', min)
-        min_lon = extreme(longitudes, 'min_lon', min)
-        max_lat = extreme(latitudes, 'max_lat', max)
-        max_lon = extreme(longitudes, 'max_lon', max)
-
-        # calculate sphere-distance from opposite corners of
-        # bounding box containing current location estimate
-        # and new observations; if too big, station is moving
-        box_dist = distance(min_lat, min_lon, max_lat, max_lon)
-
-        if existing_station:
-
-            if box_dist > self.max_dist_km:
-                # Signal a moving station and return early without updating
-                # the station since it will be deleted by caller momentarily
-                return True
+                query = queries[0]
+            for row in self.session.execute(query):
+                result[row.station].append(row)
+        return result
+
+    def aggregates(self, stations):
+        # Return the running aggregates of the stations, keyed by
+        # station key, if aggregates are kept at all.
+        if not self.station_aggregates:
+            return {}
+        model = self.aggregate_model
+        keys = [model.to_hashkey(station) for station in stations]
+        return dict([(aggregate.hashkey(), aggregate) for aggregate in
+                     model.querykeys(self.session, keys)])
+
+    def remove_aggregates(self, consumed, stale):
+        # Remove the aggregates merged into their stations, unless new
+        # observations were added to them in the meantime, and remove
+        # aggregates which didn't match the new observations of their
+        # station. Those stations are updated from their observations
+        # until their aggregates are consistent again.
+        model = self.aggregate_model
+        criteria = []
+        for aggregate in consumed:
+            criteria.append(and_(model.new_measures == aggregate.new_measures,
+                                 *model.joinkey(aggregate.hashkey())))
+        for aggregate in stale:
+            criteria.append(and_(*model.joinkey(aggregate.hashkey())))
+        if criteria:
+            (self.session.query(model)
+                         .filter(or_(*criteria))
+                         .delete(synchronize_session=False))
+
+    def merge_positions(self, stations, summary):
+        """
+        Merge the new observations into the positions of all stations
+        of a batch at once.
+
+        ``summary`` holds one column per station, with the number of new
+        observations, the sums of their latitudes and longitudes, and
+        their min/max latitude and longitude, as returned by
+        :func:`summarize_observations`.
+
+        Returns a list telling whether or not each station was found
+        to be moving. Moving stations aren't updated.
+        """
+        length, lat_sum, lon_sum, min_lat, max_lat, min_lon, max_lon = summary
+        old_lat, old_lon, old_min_lat, old_max_lat, \
+            old_min_lon, old_max_lon, total = _station_columns(stations, (
+                'lat', 'lon', 'min_lat', 'max_lat', 'min_lon', 'max_lon',
+                'total_measures'))
+        existing = numpy.array([bool(station.lat and station.lon)
+                                for station in stations], dtype=bool)
+
+        new_lat = lat_sum / length
+        new_lon = lon_sum / length
+
+        with numpy.errstate(invalid='ignore'):
+            # calculate extremes of observations, existing location
+            # estimate and existing extreme values
+            min_lat = numpy.where(existing,
+                                  numpy.fmin(min_lat, old_lat), min_lat)
+            min_lon = numpy.where(existing,
+                                  numpy.fmin(min_lon, old_lon), min_lon)
+            max_lat = numpy.where(existing,
+                                  numpy.fmax(max_lat, old_lat), max_lat)
+            max_lon = numpy.where(existing,
+                                  numpy.fmax(max_lon, old_lon), max_lon)
+            min_lat = numpy.fmin(min_lat, old_min_lat)
+            min_lon = numpy.fmin(min_lon, old_min_lon)
+            max_lat = numpy.fmax(max_lat, old_max_lat)
+            max_lon = numpy.fmax(max_lon, old_max_lon)
+
+            # calculate sphere-distance from opposite corners of
+            # bounding box containing current location estimate
+            # and new observations; if too big, station is moving
+            box_dist = distances(min_lat, min_lon, max_lat, max_lon)
+            moving = existing & (box_dist > self.max_dist_km)
 
             # limit the maximum weight of the old station estimate
-            old_weight = min(station.total_measures - length,
-                             self.MAX_OLD_OBSERVATIONS)
+            old_weight = numpy.minimum(total - length,
+                                       self.MAX_OLD_OBSERVATIONS)
             new_weight = old_weight + length
+            lat = numpy.where(
+                existing,
+                (old_lat * old_weight + new_lat * length) / new_weight,
+                new_lat)
+            lon = numpy.where(
+                existing,
+                (old_lon * old_weight + new_lon * length) / new_weight,
+                new_lon)
+
+            # give radio-range estimate between extreme values and centroid
+            corners = [(min_lat, min_lon),
+                       (min_lat, max_lon),
+                       (max_lat, min_lon),
+                       (max_lat, max_lon)]
+            station_range = numpy.max(
+                [distances(lat, lon, corner_lat, corner_lon)
+                 for corner_lat, corner_lon in corners], axis=0) * 1000.0
 
-            station.lat = ((station.lat * old_weight) +
-                           (new_lat * length)) / new_weight
-            station.lon = ((station.lon * old_weight) +
-                           (new_lon * length)) / new_weight
-
-        # decrease new counter, total is already correct
-        station.new_measures = station.new_measures - length
-
-        # update max/min lat/lon columns
-        station.min_lat = min_lat
-        station.min_lon = min_lon
-        station.max_lat = max_lat
-        station.max_lon = max_lon
-
-        # give radio-range estimate between extreme values and centroid
-        ctr = (station.lat, station.lon)
-        points = [(min_lat, min_lon),
-                  (min_lat, max_lon),
-                  (max_lat, min_lon),
-                  (max_lat, max_lon)]
-
-        station.range = range_to_points(ctr, points) * 1000.0
-        station.modified = util.utcnow()
+        utcnow = util.utcnow()
+        moving = moving.tolist()
+        values = numpy.array([lat, lon, min_lat, max_lat, min_lon, max_lon,
+                              station_range]).T.tolist()
+        for station, station_moving, station_length, row in zip(
+                stations, moving, length.tolist(), values):
+            if station_moving:
+                # Leave moving stations alone, they will be deleted
+                # by the caller momentarily
+                continue
+            # decrease new counter, total is already correct
+            station.new_measures = station.new_measures - int(station_length)
+            (station.lat, station.lon, station.min_lat, station.max_lat,
+             station.min_lon, station.max_lon, station.range) = row
+            station.modified = utcnow
+        return moving
 
     def blacklist_stations(self, stations):
+        # Add or update the blacklist entries of all moving stations
+        # with one statement.
         moving_keys = []
+        values = []
         utcnow = util.utcnow()
         for station in stations:
             station_key = self.blacklist_model.to_hashkey(station)
-            query = self.blacklist_model.querykey(self.session, station_key)
-            blacklisted_station = query.first()
             moving_keys.append(station_key)
-            if blacklisted_station:
-                blacklisted_station.time = utcnow
-                blacklisted_station.count += 1
-            else:
-                blacklisted_station = self.blacklist_model(
-                    time=utcnow,
-                    count=1,
-                    **station_key.__dict__)
-                self.session.add(blacklisted_station)
+            value = station_key.__dict__.copy()
+            value.update({'time': utcnow, 'count': 1})
+            values.append(value)
 
         if moving_keys:
+            stmt = self.blacklist_model.__table__.insert(
+                on_duplicate='time = VALUES(time), count = count + 1'
+            ).values(values)
+            self.session.execute(stmt)
             self.stats_client.incr(
                 "items.blacklisted.%s_moving" % self.station_type,
                 len(moving_keys))
@@ -192,24 +562,71 @@ class StationUpdater(DataTask):
     def queue_area_updates(self):
         pass
 
-    def update(self, batch=10):
-        self.emit_new_observation_metric()
+    def track_backlog(self, stations, before, moving_stations):
+        changes = defaultdict(int)
+        for station in stations:
+            if station in moving_stations:
+                count_backlog_change(changes, before[station], 0)
+            else:
+                count_backlog_change(
+                    changes, before[station], station.new_measures)
+        if changes:
+            self.session.on_post_commit(
+                update_backlog,
+                self.redis_client,
+                self.station_type,
+                changes)
+
+    def update(self, batch=10, emit_metric=True, shard=None):
+        if emit_metric:
+            self.emit_new_observation_metric()
 
-        stations = self.station_query().limit(batch).all()
+        stations = self.station_query(shard=shard).limit(batch).all()
         if not stations:
             return (0, 0)
-
-        moving_stations = set()
+        before = dict([(station, station.new_measures)
+                       for station in stations])
+
+        # Use the running aggregates of the stations if they cover
+        # exactly the new observations, otherwise fetch the observations.
+        aggregates = self.aggregates(stations)
+        merged = {}
+        stale = []
+        pending = []
         for station in stations:
-            observations = self.observation_query(station).all()
-            if observations:
-                moving = self.calculate_new_position(station, observations)
-                if moving:
+            key = self.aggregate_model.to_hashkey(station)
+            aggregate = aggregates.get(key)
+            if aggregate is None:
+                pending.append(station)
+            elif aggregate.new_measures == station.new_measures:
+                merged[station] = aggregate
+            else:
+                stale.append(aggregate)
+                pending.append(station)
+        observations = dict(zip(pending, self.observations(pending)))
+
+        # Merge the new observations of all stations at once.
+        aggregated = [station for station in stations if station in merged]
+        observed = [station for station in pending if observations[station]]
+        updated = aggregated + observed
+        moving_stations = set()
+        if updated:
+            summary = numpy.hstack([
+                summarize_aggregates(
+                    [merged[station] for station in aggregated]),
+                summarize_observations(
+                    [observations[station] for station in observed]),
+            ])
+            moving = self.merge_positions(updated, summary)
+            for station, station_moving in zip(updated, moving):
+                if station_moving:
                     moving_stations.add(station)
 
                 # track potential updates to dependent areas
                 self.add_area_update(station)
 
+        self.remove_aggregates(merged.values(), stale)
+        self.track_backlog(stations, before, moving_stations)
         self.queue_area_updates()
 
         if moving_stations:
@@ -220,9 +637,11 @@ class StationUpdater(DataTask):
 
 class CellUpdater(StationUpdater):
 
+    aggregate_model = CellAggregate
     blacklist_model = CellBlacklist
     max_dist_km = 150
     observation_model = CellObservation
+    shard_column = 'cid'
     station_model = Cell
     station_type = 'cell'
 
@@ -236,13 +655,16 @@ class CellUpdater(StationUpdater):
                 enqueue_areas,
                 self.redis_client,
                 self.updated_areas,
-                redis_key)
+                redis_key,
+                stats_client=self.stats_client)
 
 
 class WifiUpdater(StationUpdater):
 
+    aggregate_model = WifiAggregate
     blacklist_model = WifiBlacklist
     max_dist_km = 5
     observation_model = WifiObservation
+    shard_column = 'id'
     station_model = Wifi
     station_type = 'wifi'
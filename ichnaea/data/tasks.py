@@ -2,7 +2,9 @@ from ichnaea.async.app import celery_app
 from ichnaea.async.task import DatabaseTask
 from ichnaea.customjson import kombu_loads
 from ichnaea.data.area import (
+    CellAreaRebuilder,
     CellAreaUpdater,
+    OCIDCellAreaRebuilder,
     OCIDCellAreaUpdater,
 )
 from ichnaea.data.export import (
@@ -12,6 +14,7 @@ from ichnaea.data.export import (
 )
 from ichnaea.data.observation import (
     CellObservationQueue,
+    StagingScheduler,
     WifiObservationQueue,
 )
 from ichnaea.data.report import (
@@ -21,6 +24,7 @@ from ichnaea.data.report import (
 from ichnaea.data.station import (
     CellRemover,
     CellUpdater,
+    UpdateScheduler,
     WifiRemover,
     WifiUpdater,
 )
@@ -62,29 +66,76 @@ def insert_measures_wifi(self, entries, userid=None, utcnow=None):
     return length
 
 
+@celery_app.task(base=DatabaseTask, bind=True, queue='celery_insert')
+def schedule_staged_inserts(self):
+    scheduler = StagingScheduler(self, None)
+    return scheduler.schedule({
+        'cell': insert_staged_cell,
+        'wifi': insert_staged_wifi,
+    })
+
+
+@celery_app.task(base=DatabaseTask, bind=True, queue='celery_insert')
+def insert_staged_cell(self, partition, batch=1000):
+    with self.db_session() as session:
+        queue = CellObservationQueue(self, session)
+        length = queue.insert_staged(
+            insert_staged_cell, partition=partition, batch=batch)
+    return length
+
+
+@celery_app.task(base=DatabaseTask, bind=True, queue='celery_insert')
+def insert_staged_wifi(self, partition, batch=1000):
+    with self.db_session() as session:
+        queue = WifiObservationQueue(self, session)
+        length = queue.insert_staged(
+            insert_staged_wifi, partition=partition, batch=batch)
+    return length
+
+
 @celery_app.task(base=DatabaseTask, bind=True)
-def location_update_cell(self, min_new=10, max_new=100, batch=10):
+def schedule_location_updates(self):
+    with self.db_session() as session:
+        scheduler = UpdateScheduler(self, session)
+        return scheduler.schedule({
+            'cell': location_update_cell,
+            'wifi': location_update_wifi,
+        })
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def location_update_cell(self, min_new=10, max_new=100, batch=10,
+                         adaptive=False, shards=1, sweep=False):
     with self.db_session() as session:
         updater = CellUpdater(
             self, session,
             min_new=min_new,
             max_new=max_new,
-            remove_task=remove_cell)
-        cells, moving = updater.update(batch=batch)
-        session.commit()
+            remove_task=remove_cell,
+            shards=shards)
+        cells, moving = updater.run(
+            batch=batch, emit_metric=not adaptive, sweep=sweep)
+    if adaptive and cells >= batch:
+        UpdateScheduler(self, None).chain(
+            location_update_cell, 'cell', min_new, max_new)
     return (cells, moving)
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
-def location_update_wifi(self, min_new=10, max_new=100, batch=10):
+def location_update_wifi(self, min_new=10, max_new=100, batch=10,
+                         adaptive=False, shards=1, sweep=False):
     with self.db_session() as session:
         updater = WifiUpdater(
             self, session,
             min_new=min_new,
             max_new=max_new,
-            remove_task=remove_wifi)
-        wifis, moving = updater.update(batch=batch)
-        session.commit()
+            remove_task=remove_wifi,
+            shards=shards)
+        wifis, moving = updater.run(
+            batch=batch, emit_metric=not adaptive, sweep=sweep)
+    if adaptive and wifis >= batch:
+        UpdateScheduler(self, None).chain(
+            location_update_wifi, 'wifi', min_new, max_new)
     return (wifis, moving)
 
 
@@ -112,9 +163,9 @@ def queue_reports(self, reports=(), api_key=None, email=None, nickname=None):
 
 
 @celery_app.task(base=DatabaseTask, bind=True, queue='celery_upload')
-def upload_reports(self, export_name, data):
+def upload_reports(self, export_name, batch_key):
     uploader = ReportUploader(self, None, export_name)
-    return uploader.upload(data)
+    return uploader.upload(batch_key, export_task=export_reports)
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
@@ -135,8 +186,21 @@ def remove_wifi(self, wifi_keys):
 
 @celery_app.task(base=DatabaseTask, bind=True)
 def scan_areas(self, batch=100):
-    updater = CellAreaUpdater(self, None)
-    length = updater.scan(update_area, batch=batch)
+    with self.db_session() as session:
+        length = CellAreaUpdater(self, session).scan(batch=batch)
+        session.commit()
+    return length
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def rebuild_areas(self, mcc, cell_type='cell'):
+    with self.db_session() as session:
+        if cell_type == 'ocid':
+            rebuilder = OCIDCellAreaRebuilder(self, session)
+        else:
+            rebuilder = CellAreaRebuilder(self, session)
+        length = rebuilder.rebuild_mcc(mcc)
+        session.commit()
     return length
 
 
@@ -1,18 +1,30 @@
+from mock import patch
+
 from ichnaea.data.area import enqueue_areas
 from ichnaea.data.tasks import (
     location_update_cell,
+    rebuild_areas,
     remove_cell,
     scan_areas,
+    update_area,
 )
 from ichnaea.models import (
     Cell,
     CellArea,
     CellObservation,
+    OCIDCellArea,
     Radio,
 )
-from ichnaea.tests.base import CeleryTestCase
+from ichnaea.tests.base import (
+    CeleryTestCase,
+    GB_MCC,
+    GB_MNC,
+)
 from ichnaea.tests.factories import (
     CellAreaFactory,
+    CellFactory,
+    OCIDCellAreaFactory,
+    OCIDCellFactory,
 )
 from ichnaea import util
 
@@ -204,6 +216,65 @@ class TestArea(CeleryTestCase):
         areas = session.query(CellArea).all()
         self.assertEqual(areas, [])
 
+    def test_scan_areas_batch(self):
+        session = self.session
+        redis_client = self.redis_client
+        keys = []
+        for lac in (1, 2):
+            for i in range(3):
+                lat = lon = lac + i * 0.1
+                CellFactory(lac=lac, cid=i + 1, lat=lat, lon=lon,
+                            min_lat=lat - 0.01, max_lat=lat + 0.01,
+                            min_lon=lon - 0.01, max_lon=lon + 0.01,
+                            range=1000 * lac)
+            keys.append(CellArea.to_hashkey(
+                radio=Radio.gsm, mcc=GB_MCC, mnc=GB_MNC, lac=lac))
+        orphan = CellAreaFactory(lac=3)
+        session.flush()
+        redis_key = self.celery_app.data_queues['cell_area_update']
+        enqueue_areas(session, redis_client,
+                      keys + [keys[0], orphan.hashkey()], redis_key)
+
+        # all distinct areas are handled by one task
+        with patch.object(update_area, 'delay') as update_task:
+            self.assertEqual(scan_areas.delay().get(), 3)
+            self.assertFalse(update_task.called)
+        self.assertEqual(redis_client.zcard(redis_key), 0)
+
+        areas = session.query(CellArea).order_by(CellArea.lac).all()
+        self.assertEqual([area.lac for area in areas], [1, 2])
+        for area in areas:
+            self.assertAlmostEqual(area.lat, area.lac + 0.1, 7)
+            self.assertAlmostEqual(area.lon, area.lac + 0.1, 7)
+            self.assertEqual(area.avg_cell_range, 1000 * area.lac)
+            self.assertEqual(area.num_cells, 3)
+
+    def test_enqueue_areas_coalesce(self):
+        redis_client = self.redis_client
+        redis_key = self.celery_app.data_queues['cell_area_update']
+        keys = [CellArea.to_hashkey(radio=Radio.gsm, mcc=GB_MCC,
+                                    mnc=GB_MNC, lac=lac) for lac in (1, 2)]
+
+        self.assertEqual(enqueue_areas(
+            None, redis_client, keys[:1], redis_key,
+            stats_client=self.stats_client), 1)
+        first = redis_client.zrange(redis_key, 0, -1, withscores=True)
+
+        # an already queued area keeps its place in the queue
+        self.assertEqual(enqueue_areas(
+            None, redis_client, keys + keys, redis_key,
+            stats_client=self.stats_client), 1)
+        queued = redis_client.zrange(redis_key, 0, -1, withscores=True)
+        self.assertEqual(len(queued), 2)
+        self.assertEqual(queued[0], first[0])
+
+        self.check_stats(counter=[
+            ('items.area_queue.enqueued', 1, 1),
+            ('items.area_queue.enqueued', 1, 2),
+            ('items.area_queue.coalesced', 1, 0),
+            ('items.area_queue.coalesced', 1, 1),
+        ])
+
     def test_scan_areas_update(self):
         session = self.session
         self.add_line_of_cells_and_scan_lac()
@@ -223,3 +294,51 @@ class TestArea(CeleryTestCase):
         self.assertEqual(lac.created.date(), today)
         self.assertEqual(lac.modified.date(), today)
         self.assertEqual(lac.num_cells, 10)
+
+    def test_rebuild_areas(self):
+        session = self.session
+        self.add_line_of_cells_and_scan_lac()
+        # an orphaned area in the same country
+        CellAreaFactory(radio=Radio.cdma, mcc=1, mnc=1, lac=2)
+        session.flush()
+
+        self.assertEqual(rebuild_areas.delay(1).get(), 1)
+        areas = session.query(CellArea).all()
+        self.assertEqual(len(areas), 1)
+        self.assertEqual(areas[0].lat, 4.5)
+        self.assertEqual(areas[0].lon, 4.5)
+        self.assertEqual(areas[0].range, 723001)
+        self.assertEqual(areas[0].num_cells, 10)
+
+    def test_rebuild_ocid_areas(self):
+        session = self.session
+        for i in range(5):
+            OCIDCellFactory(lac=1, cid=i + 1,
+                            lat=51.0 + i * 0.01, range=1000 + i)
+            OCIDCellFactory(lac=2, cid=i + 1,
+                            lon=-0.1 - i * 0.01, range=2000)
+        OCIDCellAreaFactory(lac=3)
+        session.flush()
+
+        for lac in (1, 2):
+            update_area.delay(OCIDCellArea.to_hashkey(
+                radio=Radio.gsm, mcc=GB_MCC, mnc=GB_MNC, lac=lac),
+                cell_type='ocid')
+        expected = [(area.lac, area.lat, area.lon, area.range,
+                     area.avg_cell_range, area.num_cells)
+                    for area in session.query(OCIDCellArea)
+                                       .filter(OCIDCellArea.lac != 3)
+                                       .order_by(OCIDCellArea.lac)]
+
+        self.assertEqual(rebuild_areas.delay(
+            GB_MCC, cell_type='ocid').get(), 2)
+        session.expire_all()
+        areas = session.query(OCIDCellArea).order_by(OCIDCellArea.lac).all()
+        self.assertEqual(len(areas), 2)
+        for area, values in zip(areas, expected):
+            self.assertEqual(area.lac, values[0])
+            self.assertAlmostEqual(area.lat, values[1], 7)
+            self.assertAlmostEqual(area.lon, values[2], 7)
+            self.assertEqual(area.range, values[3])
+            self.assertEqual(area.avg_cell_range, values[4])
+            self.assertEqual(area.num_cells, values[5])
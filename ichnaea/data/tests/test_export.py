@@ -1,14 +1,28 @@
+import BaseHTTPServer
 import json
+import SocketServer
+import threading
 import time
 
 from celery.exceptions import Retry
+from mock import patch
+from requests.exceptions import HTTPError
 import requests_mock
 
 from ichnaea.async.config import EXPORT_QUEUE_PREFIX
-from ichnaea.data.export import queue_length
+from ichnaea.data.export import (
+    pending_key,
+    queue_length,
+    ReportExporter,
+    ReportUploader,
+    upload_session,
+    uploads_key,
+)
 from ichnaea.data.tasks import (
+    export_reports,
     schedule_export_reports,
     queue_reports,
+    upload_reports,
 )
 from ichnaea.tests.base import CeleryTestCase
 from ichnaea.tests.factories import (
@@ -119,6 +133,30 @@ class TestExporter(BaseTest, CeleryTestCase):
         schedule_export_reports.delay().get()
         self.assertEqual(self.queue_length(EXPORT_QUEUE_PREFIX + 'test'), 1)
 
+    def test_batches_acknowledged(self):
+        self.add_reports(6)
+        schedule_export_reports.delay().get()
+        redis_key = EXPORT_QUEUE_PREFIX + 'test'
+        self.assertEqual(self.queue_length(redis_key), 0)
+        self.assertEqual(self.redis_client.zcard(pending_key(redis_key)), 0)
+        self.assertEqual(self.redis_client.keys(redis_key + ':batch:*'), [])
+
+    def test_reclaim_batches(self):
+        # simulate a worker crashing after dequeuing a batch
+        redis_key = EXPORT_QUEUE_PREFIX + 'test'
+        batch_key = redis_key + ':batch:crashed'
+        self.add_reports(3)
+        self.redis_client.rename(redis_key, batch_key)
+        self.redis_client.zadd(
+            pending_key(redis_key), time.time() - 7200, batch_key)
+
+        triggered = schedule_export_reports.delay().get()
+        self.assertEqual(triggered, 1)
+        self.assertEqual(self.queue_length(redis_key), 0)
+        self.assertFalse(self.redis_client.exists(batch_key))
+        self.assertEqual(self.redis_client.zcard(pending_key(redis_key)), 0)
+        self.check_stats(counter=[('items.export.test.reclaimed', 1, 3)])
+
 
 class TestUploader(BaseTest, CeleryTestCase):
 
@@ -194,3 +232,129 @@ class TestUploader(BaseTest, CeleryTestCase):
                      ('items.export.test.upload_status.500', 1)],
             timer=[('items.export.test.upload', 3)],
         )
+
+    def test_upload_retries_exhausted(self):
+        self.add_reports(3)
+        exporter = ReportExporter(export_reports, None, 'test')
+        batch_key, items = exporter.dequeue_reports()
+
+        uploader = ReportUploader(upload_reports, None, 'test')
+        with requests_mock.Mocker() as mock:
+            mock.register_uri('POST', requests_mock.ANY,
+                              text='', status_code=503)
+            with patch('time.sleep') as sleep:
+                self.assertRaises(HTTPError, uploader.upload, batch_key)
+
+        self.assertEqual(mock.call_count, 4)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [0, 1.0, 2.0])
+        self.check_stats(
+            counter=[('items.export.test.upload_status.503', 4)],
+            timer=[('items.export.test.upload', 4)],
+        )
+
+    def test_upload_failed(self):
+        # a failed upload frees its slot, but its batch stays pending
+        redis_key = EXPORT_QUEUE_PREFIX + 'test'
+        self.add_reports(3)
+        exporter = ReportExporter(export_reports, None, 'test')
+        batch_key, items = exporter.dequeue_reports()
+        self.assertEqual(len(items), 3)
+        self.assertFalse(exporter.can_export())
+        self.add_reports(3)
+        self.assertFalse(exporter.can_export())
+
+        uploader = ReportUploader(upload_reports, None, 'test')
+        with requests_mock.Mocker() as mock:
+            mock.register_uri('POST', requests_mock.ANY,
+                              text='{}', status_code=404)
+            self.assertRaises(HTTPError, uploader.upload, batch_key)
+
+        self.assertTrue(exporter.can_export())
+        self.assertEqual(self.redis_client.zcard(uploads_key(redis_key)), 0)
+        self.assertEqual(
+            self.redis_client.zrange(pending_key(redis_key), 0, -1),
+            [batch_key])
+        self.assertEqual(self.redis_client.llen(batch_key), 3)
+
+        with requests_mock.Mocker() as mock:
+            mock.register_uri('POST', requests_mock.ANY, text='{}')
+            self.assertEqual(schedule_export_reports.delay().get(), 1)
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(self.queue_length(redis_key), 0)
+        self.assertEqual(self.redis_client.zcard(pending_key(redis_key)), 1)
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.responses.pop(0)
+        self.server.uploads.append(
+            (self.client_address, status, json.loads(decode_gzip(body))))
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class UploadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestUploadServer(BaseTest, CeleryTestCase):
+
+    def setUp(self):
+        super(TestUploadServer, self).setUp()
+        self.server = UploadServer(('127.0.0.1', 0), UploadHandler)
+        self.server.responses = []
+        self.server.uploads = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.celery_app.export_queues = {
+            'test': {
+                'url': 'http://127.0.0.1:%s/' % self.server.server_port,
+                'batch': 3,
+                'concurrency': 2,
+                'redis_key': EXPORT_QUEUE_PREFIX + 'test',
+            },
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestUploadServer, self).tearDown()
+
+    def test_upload(self):
+        self.server.responses = [503, 200, 200]
+        self.add_reports(6)
+        with patch('ichnaea.data.export.UPLOAD_BACKOFF', 0.01):
+            triggered = schedule_export_reports.delay().get()
+        self.assertEqual(triggered, 2)
+        self.assertEqual(self.queue_length(EXPORT_QUEUE_PREFIX + 'test'), 0)
+
+        uploads = self.server.uploads
+        self.assertEqual([status for addr, status, data in uploads],
+                         [503, 200, 200])
+        self.assertEqual(len(uploads[1][2]['items']), 3)
+        self.assertEqual(len(uploads[2][2]['items']), 3)
+        # the pooled connection was kept alive and reused
+        self.assertEqual(uploads[1][0], uploads[2][0])
+
+        self.check_stats(
+            counter=[('items.export.test.batches', 2),
+                     ('items.export.test.reports', 2, 3),
+                     ('items.export.test.upload_status.200', 2),
+                     ('items.export.test.upload_status.503', 1),
+                     ('items.export.test.upload_bytes', 2)],
+            timer=[('items.export.test.upload', 3)],
+        )
+
+    def test_upload_session(self):
+        url = 'http://127.0.0.1:9/'
+        self.assertTrue(upload_session(url) is upload_session(url))
@@ -6,9 +6,14 @@ from sqlalchemy import text
 from ichnaea.constants import (
     TEMPORARY_BLACKLIST_DURATION,
 )
+from ichnaea.customjson import kombu_dumps
+from ichnaea.data.observation import station_partition
 from ichnaea.data.tasks import (
+    insert_measures,
     insert_measures_cell,
     insert_measures_wifi,
+    insert_staged_wifi,
+    schedule_staged_inserts,
 )
 from ichnaea.models import (
     constants,
@@ -328,6 +333,92 @@ class TestWifi(CeleryTestCase):
         self.assertEqual(len(observations), 8)
 
 
+class TestStaging(CeleryTestCase):
+
+    def setUp(self):
+        super(TestStaging, self).setUp()
+        self.insert_queues = self.celery_app.insert_queues
+        self.celery_app.insert_queues = {
+            'cell': ['queue_insert_cell_0', 'queue_insert_cell_1'],
+            'wifi': ['queue_insert_wifi_0', 'queue_insert_wifi_1'],
+        }
+
+    def tearDown(self):
+        self.celery_app.insert_queues = self.insert_queues
+        super(TestStaging, self).tearDown()
+
+    def queue_lengths(self, station_type):
+        return [self.redis_client.llen(name)
+                for name in self.celery_app.insert_queues[station_type]]
+
+    def test_station_partition(self):
+        keys = [WifiObservation.to_hashkey(key='ab12345678%02d' % i)
+                for i in range(20)]
+        partitions = [station_partition(key, 4) for key in keys]
+        self.assertEqual(partitions,
+                         [station_partition(key, 4) for key in keys])
+        self.assertTrue(len(set(partitions)) > 1)
+        self.assertTrue(all([0 <= p < 4 for p in partitions]))
+
+    def test_staged_insert(self):
+        session = self.session
+        reports = []
+        for i in range(3):
+            reports.append({
+                'lat': PARIS_LAT, 'lon': PARIS_LON,
+                'cell': [{'radio': 'gsm', 'mcc': FRANCE_MCC, 'mnc': 2,
+                          'lac': 3, 'cid': 4 + i}],
+                'wifi': [{'key': 'ab12345678%02d' % j} for j in range(5)],
+            })
+        insert_measures.delay(items=kombu_dumps(reports)).get()
+
+        # nothing has been inserted yet, only staged
+        self.assertEqual(session.query(CellObservation).count(), 0)
+        self.assertEqual(session.query(WifiObservation).count(), 0)
+        self.assertEqual(sum(self.queue_lengths('cell')), 3)
+        self.assertEqual(sum(self.queue_lengths('wifi')), 5)
+
+        self.assertEqual(schedule_staged_inserts.delay().get(), 4)
+        self.assertEqual(self.queue_lengths('cell'), [0, 0])
+        self.assertEqual(self.queue_lengths('wifi'), [0, 0])
+
+        self.assertEqual(session.query(CellObservation).count(), 3)
+        self.assertEqual(session.query(WifiObservation).count(), 15)
+        cells = session.query(Cell).all()
+        self.assertEqual(set([c.cid for c in cells]), set([4, 5, 6]))
+        wifis = session.query(Wifi).all()
+        self.assertEqual(len(wifis), 5)
+        self.assertEqual(set([w.new_measures for w in wifis]), set([3]))
+
+        # nothing left to do
+        self.assertEqual(schedule_staged_inserts.delay().get(), 0)
+
+    def test_partition_busy(self):
+        session = self.session
+        redis_key = self.celery_app.insert_queues['wifi'][0]
+        self.redis_client.lpush(redis_key, kombu_dumps({
+            'userid': None,
+            'observations': [{'key': 'ab1234567890', 'lat': 1.0, 'lon': 2.0}],
+        }))
+
+        # another worker is processing this partition
+        lock = self.redis_client.lock(redis_key + ':lock', timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertEqual(insert_staged_wifi.delay(0).get(), 0)
+        self.assertEqual(self.redis_client.llen(redis_key), 1)
+        self.assertEqual(session.query(WifiObservation).count(), 0)
+
+        lock.release()
+        self.assertEqual(insert_staged_wifi.delay(0).get(), 1)
+        self.assertEqual(self.redis_client.llen(redis_key), 0)
+        self.assertEqual(session.query(WifiObservation).count(), 1)
+
+        self.check_stats(counter=[
+            'items.staged.wifi_partition_busy',
+            ('items.staged.wifi_0', 1, 1),
+        ])
+
+
 class TestSubmitErrors(CeleryTestCase):
     # this is a standalone class to ensure DB isolation for dropping tables
 
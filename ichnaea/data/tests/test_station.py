@@ -1,29 +1,48 @@
 from datetime import timedelta
 
+from mock import patch
+
 from ichnaea.constants import (
     PERMANENT_BLACKLIST_THRESHOLD,
 )
+from ichnaea.async.config import (
+    STATION_BACKLOG_KEY,
+    STATION_LEASE_KEY,
+)
+from ichnaea.data.station import (
+    CellRemover,
+    CellUpdater,
+    WifiUpdater,
+    summarize_observations,
+)
 from ichnaea.data.tasks import (
     insert_measures_cell,
     insert_measures_wifi,
     location_update_cell,
     location_update_wifi,
+    remove_cell,
     remove_wifi,
     scan_areas,
+    schedule_location_updates,
 )
 from ichnaea.models import (
     Cell,
+    CellAggregate,
     CellArea,
     CellBlacklist,
     CellObservation,
     Radio,
     ValidCellKeySchema,
     Wifi,
+    WifiAggregate,
     WifiBlacklist,
     WifiObservation,
 )
 from ichnaea.tests.base import (
     CeleryTestCase,
+    FRANCE_MCC,
+    PARIS_LAT,
+    PARIS_LON,
     USA_MCC, ATT_MNC,
 )
 from ichnaea.tests.factories import (
@@ -282,6 +301,40 @@ class TestCell(CeleryTestCase):
                 self.assertAlmostEqual(cell.lat, expected_lat, 7)
                 self.assertAlmostEqual(cell.lon, expected_lon, 7)
 
+    def test_location_update_cell_batches(self):
+        obs_factory = CellObservationFactory
+        cells = [CellFactory(cid=i, new_measures=2, total_measures=2)
+                 for i in range(1000, 1005)]
+        for cell in cells:
+            key = dict(lac=cell.lac, cid=cell.cid)
+            obs_factory(lat=cell.lat + 0.002, lon=cell.lon, **key)
+            obs_factory(lat=cell.lat + 0.004, lon=cell.lon, **key)
+        self.session.commit()
+        expected = dict([(cell.hashkey(), cell.lat + 0.003)
+                         for cell in cells])
+
+        with patch.object(CellUpdater, 'OBSERVATION_BATCH', 2):
+            result = location_update_cell.delay(min_new=1)
+            self.assertEqual(result.get(), (5, 0))
+
+        cells = self.session.query(Cell).all()
+        self.assertEqual(len(cells), 5)
+        for cell in cells:
+            self.assertEqual(cell.new_measures, 0)
+            self.assertAlmostEqual(cell.lat, expected[cell.hashkey()], 7)
+
+    def test_remove_cells(self):
+        cells = [CellFactory(cid=i) for i in range(1000, 1005)]
+        other = CellFactory(cid=2000)
+        self.session.commit()
+
+        keys = [Cell.to_hashkey(cell) for cell in cells]
+        with patch.object(CellRemover, 'batch', 2):
+            self.assertEqual(remove_cell.delay(keys).get(), 5)
+
+        self.assertEqual([cell.hashkey() for cell in
+                          self.session.query(Cell).all()], [other.hashkey()])
+
     def test_max_min_range_update(self):
         session = self.session
 
@@ -615,3 +668,249 @@ class TestWifi(CeleryTestCase):
 
         wifis = self.session.query(Wifi).all()
         self.assertEqual(len(wifis), 0)
+
+
+class TestAggregates(CeleryTestCase):
+
+    def setUp(self):
+        super(TestAggregates, self).setUp()
+        self.celery_app.station_aggregates = True
+
+    def tearDown(self):
+        self.celery_app.station_aggregates = False
+        super(TestAggregates, self).tearDown()
+
+    def test_cell(self):
+        lat, lon = (PARIS_LAT, PARIS_LON)
+        k1 = dict(radio=Radio.gsm, mcc=FRANCE_MCC, mnc=2, lac=3, cid=4)
+        self.session.add(Cell(lat=lat, lon=lon,
+                              max_lat=lat, min_lat=lat,
+                              max_lon=lon, min_lon=lon,
+                              new_measures=0, total_measures=2, **k1))
+        self.session.commit()
+
+        entries = [
+            dict(lat=lat + 0.002, lon=lon + 0.004, **k1),
+            dict(lat=lat + 0.004, lon=lon - 0.002, **k1),
+        ]
+        for entry in entries:
+            entry['radio'] = int(Radio.gsm)
+        insert_measures_cell.delay(entries[:1]).get()
+        insert_measures_cell.delay(entries[1:]).get()
+
+        aggregate = self.session.query(CellAggregate).one()
+        self.assertEqual(aggregate.new_measures, 2)
+        self.assertAlmostEqual(aggregate.lat_sum, 2 * lat + 0.006, 7)
+        self.assertAlmostEqual(aggregate.lon_sum, 2 * lon + 0.002, 7)
+        self.assertEqual((aggregate.min_lat, aggregate.max_lat),
+                         (lat + 0.002, lat + 0.004))
+        self.assertEqual((aggregate.min_lon, aggregate.max_lon),
+                         (lon - 0.002, lon + 0.004))
+
+        # the observations aren't read again
+        self.session.query(CellObservation).delete()
+        self.session.commit()
+
+        result = location_update_cell.delay(min_new=1)
+        self.assertEqual(result.get(), (1, 0))
+
+        cell = self.session.query(Cell).one()
+        self.assertEqual(cell.new_measures, 0)
+        self.assertAlmostEqual(cell.lat, lat + 0.0015, 7)
+        self.assertAlmostEqual(cell.lon, lon + 0.0005, 7)
+        self.assertEqual((cell.min_lat, cell.max_lat), (lat, lat + 0.004))
+        self.assertEqual((cell.min_lon, cell.max_lon),
+                         (lon - 0.002, lon + 0.004))
+        self.assertEqual(self.session.query(CellAggregate).count(), 0)
+
+    def test_wifi_moving(self):
+        key = 'ab1234567890'
+        self.session.add(Wifi(key=key, lat=1.0, lon=1.0,
+                              new_measures=0, total_measures=1))
+        self.session.commit()
+
+        insert_measures_wifi.delay([
+            dict(key=key, lat=1.0, lon=1.0),
+            dict(key=key, lat=1.1, lon=1.0),
+        ]).get()
+        self.assertEqual(self.session.query(WifiAggregate).count(), 1)
+
+        result = location_update_wifi.delay(min_new=1)
+        self.assertEqual(result.get(), (1, 1))
+        self.assertEqual(self.session.query(WifiAggregate).count(), 0)
+        self.assertEqual(self.session.query(WifiBlacklist).count(), 1)
+
+    def test_stale_aggregate(self):
+        k1 = dict(radio=Radio.gsm, mcc=USA_MCC, mnc=ATT_MNC, lac=3, cid=4)
+        self.session.add_all([
+            Cell(lat=1.0, lon=1.0, new_measures=1, total_measures=2, **k1),
+            CellObservation(lat=1.002, lon=1.0, **k1),
+            CellAggregate(new_measures=5, lat_sum=5.0, lon_sum=5.0,
+                          min_lat=1.0, max_lat=1.0,
+                          min_lon=1.0, max_lon=1.0, **k1),
+        ])
+        self.session.commit()
+
+        result = location_update_cell.delay(min_new=1)
+        self.assertEqual(result.get(), (1, 0))
+
+        cell = self.session.query(Cell).one()
+        self.assertAlmostEqual(cell.lat, 1.001, 7)
+        self.assertEqual(self.session.query(CellAggregate).count(), 0)
+
+
+class TestMergePositions(CeleryTestCase):
+
+    def test_batch(self):
+        stations = [
+            Wifi(key='ab0000000001', new_measures=2, total_measures=2),
+            Wifi(key='ab0000000002', lat=2.0, lon=2.0,
+                 new_measures=2, total_measures=4),
+            Wifi(key='ab0000000003', lat=1.0, lon=1.0,
+                 new_measures=1, total_measures=3),
+        ]
+        observations = [
+            [WifiObservation(lat=1.0, lon=1.0),
+             WifiObservation(lat=1.002, lon=1.004)],
+            [WifiObservation(lat=2.002, lon=2.0),
+             WifiObservation(lat=2.002, lon=2.0)],
+            [WifiObservation(lat=1.1, lon=1.0)],
+        ]
+        summary = summarize_observations(observations)
+        self.assertEqual(summary[:, 0].tolist(),
+                         [2, 2.002, 2.004, 1.0, 1.002, 1.0, 1.004])
+
+        updater = WifiUpdater(location_update_wifi, self.session)
+        moving = updater.merge_positions(stations, summary)
+        self.assertEqual(moving, [False, False, True])
+
+        new, existing, moved = stations
+        self.assertAlmostEqual(new.lat, 1.001, 7)
+        self.assertAlmostEqual(new.lon, 1.002, 7)
+        self.assertEqual((new.min_lat, new.max_lat), (1.0, 1.002))
+        self.assertEqual((new.min_lon, new.max_lon), (1.0, 1.004))
+        self.assertEqual(new.new_measures, 0)
+        self.assertTrue(new.range > 0)
+
+        self.assertAlmostEqual(existing.lat, 2.001, 7)
+        self.assertAlmostEqual(existing.lon, 2.0, 7)
+        self.assertEqual((existing.min_lat, existing.max_lat), (2.0, 2.002))
+        self.assertEqual(existing.new_measures, 0)
+
+        # moving stations are left alone
+        self.assertEqual((moved.lat, moved.lon), (1.0, 1.0))
+        self.assertEqual(moved.new_measures, 1)
+        self.assertEqual(moved.range, None)
+
+
+class TestUpdateScheduler(CeleryTestCase):
+
+    def backlog(self, station_type):
+        return self.redis_client.hgetall(STATION_BACKLOG_KEY % station_type)
+
+    def add_cells(self, count):
+        for cid in range(count):
+            key = dict(radio=Radio.cdma, mcc=1, mnc=2, lac=3, cid=cid)
+            self.session.add_all([
+                Cell(lat=1.0, lon=1.0, new_measures=2, total_measures=2,
+                     **key),
+                CellObservation(lat=1.001, lon=1.0, **key),
+                CellObservation(lat=1.003, lon=1.0, **key),
+            ])
+        self.session.commit()
+
+    def test_backlog_estimates(self):
+        key = 'ab1234567890'
+        insert_measures_wifi.delay([
+            dict(key=key, lat=1.0, lon=1.0),
+            dict(key=key, lat=1.0, lon=1.0),
+        ]).get()
+        self.assertEqual(self.backlog('wifi'), {'1_10': '1'})
+
+        insert_measures_wifi.delay([
+            dict(key=key, lat=1.0, lon=1.0) for i in range(8)]).get()
+        self.assertEqual(self.backlog('wifi'), {'1_10': '0', '10_1000': '1'})
+
+        location_update_wifi.delay(min_new=10, max_new=1000).get()
+        self.assertEqual(self.backlog('wifi'), {'1_10': '0', '10_1000': '0'})
+
+    def test_schedule(self):
+        self.add_cells(1)
+
+        self.assertEqual(schedule_location_updates.delay().get(), 1)
+        cell = self.session.query(Cell).one()
+        self.assertEqual(cell.new_measures, 0)
+        self.assertAlmostEqual(cell.lat, 1.002, 7)
+        self.assertEqual(self.backlog('cell')['1_10'], '0')
+
+        # the recent count is used, nothing is left to do
+        self.assertEqual(schedule_location_updates.delay().get(), 0)
+        self.check_stats(
+            timer=[('task.data.location_update_cell', 1)],
+            gauge=[('task.data.location_update_cell.new_measures_1_10', 2),
+                   ('task.data.location_update_wifi.new_measures_1_10', 2)])
+
+    def test_chain(self):
+        self.add_cells(3)
+
+        bands = ((1, 10, 1, 30), )
+        with patch('ichnaea.data.station.UPDATE_BANDS', bands):
+            with patch('ichnaea.data.station.UPDATE_SHARDS', 1):
+                self.assertEqual(schedule_location_updates.delay().get(), 1)
+
+        cells = self.session.query(Cell).all()
+        self.assertEqual([cell.new_measures for cell in cells], [0, 0, 0])
+        self.assertEqual(self.backlog('cell')['1_10'], '0')
+        self.check_stats(timer=[('task.data.location_update_cell', 3)])
+
+    def test_schedule_sweep(self):
+        # a backlog below the batch size is updated in one run,
+        # even though its stations are spread over all shards
+        self.add_cells(6)
+
+        self.assertEqual(schedule_location_updates.delay().get(), 1)
+        cells = self.session.query(Cell).all()
+        self.assertEqual([cell.new_measures for cell in cells], [0] * 6)
+        self.assertEqual(self.backlog('cell')['1_10'], '0')
+        self.check_stats(timer=[('task.data.location_update_cell', 1)])
+
+    def test_sweep_lease_busy(self):
+        self.add_cells(4)
+        lease = self.redis_client.lock(STATION_LEASE_KEY % ('cell', '1_10', 1))
+        self.assertTrue(lease.acquire(blocking=False))
+        try:
+            result = location_update_cell.delay(
+                min_new=1, max_new=10, shards=2, sweep=True)
+            self.assertEqual(result.get(), (2, 0))
+        finally:
+            lease.release()
+
+        cells = self.session.query(Cell).order_by(Cell.cid).all()
+        self.assertEqual([cell.new_measures for cell in cells], [0, 2, 0, 2])
+
+    def test_lease_busy(self):
+        self.add_cells(1)
+        lease = self.redis_client.lock(STATION_LEASE_KEY % ('cell', '1_10', 0))
+        self.assertTrue(lease.acquire(blocking=False))
+        try:
+            result = location_update_cell.delay(min_new=1, max_new=10)
+            self.assertEqual(result.get(), (0, 0))
+        finally:
+            lease.release()
+
+        self.assertEqual(self.session.query(Cell).one().new_measures, 2)
+        self.check_stats(counter=['items.update.cell_lease_busy'])
+
+    def test_lease_shards(self):
+        self.add_cells(4)
+        lease = self.redis_client.lock(STATION_LEASE_KEY % ('cell', '1_10', 0))
+        self.assertTrue(lease.acquire(blocking=False))
+        try:
+            result = location_update_cell.delay(
+                min_new=1, max_new=10, shards=2)
+            self.assertEqual(result.get(), (2, 0))
+        finally:
+            lease.release()
+
+        cells = self.session.query(Cell).order_by(Cell.cid).all()
+        self.assertEqual([cell.new_measures for cell in cells], [2, 0, 2, 0])
@@ -0,0 +1,140 @@
+"""
+A compact columnar format for the cell export.
+
+The file starts with the magic bytes ``MLSC``, a one byte version
+number, a four byte length and a JSON header of that length, listing
+the name and NumPy dtype of each column. It is followed by chunks of
+rows, each consisting of a four byte row count and for each column a
+four byte length followed by the zlib compressed fixed-width column
+values. A chunk with a row count of zero marks the end of the file.
+All numbers are little-endian.
+
+This module only depends on NumPy and the standard library, so
+consumers of the export can copy it to read the files.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy
+
+MAGIC = b'MLSC'
+VERSION = 1
+# Number of rows in each chunk
+CHUNK_ROWS = 2 ** 16
+
+# The name and dtype of each column, radio uses the numeric values
+# 0 (GSM), 1 (CDMA), 2 (UMTS) and 3 (LTE).
+COLUMNS = [
+    ('radio', '|u1'),
+    ('mcc', '<u2'),
+    ('mnc', '<u2'),
+    ('lac', '<u2'),
+    ('cid', '<u4'),
+    ('psc', '<i2'),
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('range', '<i4'),
+    ('samples', '<u4'),
+    ('created', '<u4'),
+    ('updated', '<u4'),
+]
+
+# Missing values are stored as -1 for psc and 0 for all other columns
+MISSING = {'psc': -1}
+
+_HEADER = struct.Struct('<4sBI')
+_LENGTH = struct.Struct('<I')
+
+
+class ColumnarWriter(object):
+    """
+    Write columns into a file-like object, given rows of values in
+    the order of ``fields``. The values may be numbers or strings.
+    ``radio_values`` maps the radio values of the rows to numbers.
+    """
+
+    def __init__(self, fileobj, fields, radio_values,
+                 chunk_rows=CHUNK_ROWS):
+        self.fileobj = fileobj
+        self.indices = [fields.index(name) for name, dtype in COLUMNS]
+        self.radio_values = radio_values
+        self.chunk_rows = chunk_rows
+        self.rows = []
+
+        header = json.dumps({'columns': COLUMNS})
+        fileobj.write(_HEADER.pack(MAGIC, VERSION, len(header)))
+        fileobj.write(header)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self._write_chunk()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _column(self, name, dtype, values):
+        if name == 'radio':
+            values = [self.radio_values[value] for value in values]
+        else:
+            missing = MISSING.get(name, 0)
+            values = [value if value not in ('', None) else missing
+                      for value in values]
+        return numpy.array(values).astype(dtype)
+
+    def _write_chunk(self):
+        if not self.rows:
+            return
+        write = self.fileobj.write
+        write(_LENGTH.pack(len(self.rows)))
+        for (name, dtype), index in zip(COLUMNS, self.indices):
+            array = self._column(name, dtype,
+                                 [row[index] for row in self.rows])
+            data = zlib.compress(array.tostring())
+            write(_LENGTH.pack(len(data)))
+            write(data)
+        self.rows = []
+
+    def close(self):
+        self._write_chunk()
+        self.fileobj.write(_LENGTH.pack(0))
+
+
+def _read(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of file.')
+    return data
+
+
+def read_columns(fileobj):
+    """
+    Read a columnar cell export from a file-like object and return
+    a dict mapping column names to NumPy arrays.
+    """
+    magic, version, length = _HEADER.unpack(_read(fileobj, _HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported file format.')
+    columns = [(str(name), str(dtype)) for name, dtype in
+               json.loads(_read(fileobj, length))['columns']]
+
+    chunks = dict([(name, []) for name, dtype in columns])
+    while True:
+        rows, = _LENGTH.unpack(_read(fileobj, _LENGTH.size))
+        if not rows:
+            break
+        for name, dtype in columns:
+            length, = _LENGTH.unpack(_read(fileobj, _LENGTH.size))
+            data = zlib.decompress(_read(fileobj, length))
+            chunks[name].append(numpy.frombuffer(data, dtype=dtype))
+
+    result = {}
+    for name, dtype in columns:
+        if chunks[name]:
+            result[name] = numpy.concatenate(chunks[name])
+        else:
+            result[name] = numpy.zeros(0, dtype=dtype)
+    return result
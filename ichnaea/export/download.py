@@ -0,0 +1,190 @@
+"""
+Pipelined and resumable downloads.
+
+A :class:`ChunkPipe` reads the chunks of a download in a background
+thread into a bounded buffer, so the network transfer overlaps with
+the processing of the chunks received so far. A
+:class:`ResumableDownload` keeps a local copy of the downloaded data,
+so a later attempt only needs to request the remainder of the file.
+"""
+
+from contextlib import closing
+import os
+import Queue
+import threading
+
+import requests
+
+# Size of the chunks read from the network
+CHUNK_SIZE = 2 ** 20
+# Number of chunks buffered between the download and processing
+PIPE_SIZE = 8
+
+_DONE = object()
+
+
+class ChunkPipe(object):
+    """
+    Iterate over the chunks of ``chunks``, which are read ahead by
+    a background thread into a buffer of at most ``size`` chunks.
+
+    Exceptions raised while reading the chunks are raised again
+    once the consumer has reached them.
+    """
+
+    def __init__(self, chunks, size=PIPE_SIZE):
+        self.queue = Queue.Queue(size)
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(chunks, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        # Wait for room in the buffer, unless the consumer stopped.
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as exc:
+            self.error = exc
+        self._put(_DONE)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ResumableDownload(object):
+    """
+    Download a file from ``url``, keeping a local copy in ``path``.
+
+    If ``path`` already holds the start of the file from an earlier
+    attempt, only the remainder is requested with a range request.
+    The ``If-Range`` header makes the server send the complete file
+    instead, if it changed since the earlier attempt, as identified by
+    its ``version``, the ETag or Last-Modified header of the response.
+    """
+
+    def __init__(self, url, path, params=None, version=None,
+                 chunk_size=CHUNK_SIZE, timeout=60):
+        self.url = url
+        self.path = path
+        self.params = params
+        self.version = version
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.offset = 0
+        self.size = 0
+        self.response = None
+
+    @property
+    def resumed(self):
+        return self.offset > 0
+
+    def start(self):
+        """
+        Send the request and decide how much of the local copy to use.
+        """
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        headers = {}
+        offset = 0
+        if self.version and os.path.exists(self.path):
+            offset = os.path.getsize(self.path)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = self.version
+
+        response = requests.get(self.url, params=self.params,
+                                headers=headers, stream=True,
+                                timeout=self.timeout)
+        if offset and response.status_code == 416:
+            # The local copy is already complete.
+            response.close()
+            response = None
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            self.version = (response.headers.get('ETag') or
+                            response.headers.get('Last-Modified'))
+
+        self.offset = offset
+        self.response = response
+
+    def _local_chunks(self):
+        if not self.offset:
+            return
+        with open(self.path, 'rb') as fd:
+            remaining = self.offset
+            while remaining:
+                chunk = fd.read(min(self.chunk_size, remaining))
+                if not chunk:  # pragma: no cover
+                    raise IOError('The local copy is incomplete.')
+                remaining -= len(chunk)
+                yield chunk
+
+    def _remote_chunks(self):
+        expected = self.response.headers.get('Content-Length')
+        received = 0
+        with closing(self.response):
+            with open(self.path, 'ab' if self.offset else 'wb') as fd:
+                for chunk in self.response.iter_content(self.chunk_size):
+                    fd.write(chunk)
+                    received += len(chunk)
+                    yield chunk
+        if expected is not None and received < int(expected):
+            raise IOError('Incomplete download, received %s of %s bytes.' % (
+                received, expected))
+
+    def chunks(self):
+        """
+        Yield the chunks of the complete file, starting with
+        the reused part of the local copy. :meth:`start` needs to be
+        called first.
+        """
+        for chunk in self._local_chunks():
+            self.size += len(chunk)
+            yield chunk
+        if self.response is not None:
+            for chunk in self._remote_chunks():
+                self.size += len(chunk)
+                yield chunk
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+    def remove(self):
+        """
+        Remove the local copy.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
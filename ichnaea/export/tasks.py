@@ -1,21 +1,32 @@
 from contextlib import contextmanager, closing
+import cPickle
 import csv
 from datetime import datetime, timedelta
 import gzip
+import heapq
 import os
 import shutil
 import tempfile
+import time
+import zlib
 
-import boto
+from celery import chord
 import requests
 from pytz import UTC
+from redis.exceptions import LockError
 from sqlalchemy.sql import (
     and_,
     func,
+    or_,
     select,
 )
 
 from ichnaea.async.app import celery_app
+from ichnaea.async.config import (
+    CELL_SNAPSHOT_KEY,
+    DELETED_CELLS_KEY,
+    OCID_IMPORT_KEY,
+)
 from ichnaea.async.task import DatabaseTask
 from ichnaea.models import (
     Cell,
@@ -23,7 +34,14 @@ from ichnaea.models import (
     Radio,
     OCIDCell,
 )
-from ichnaea.data.tasks import update_area
+from ichnaea.models.batch import OCIDCellColumnValidator
+from ichnaea.data.area import OCIDCellAreaRebuilder
+from ichnaea.export.columnar import ColumnarWriter
+from ichnaea.export.download import (
+    ChunkPipe,
+    ResumableDownload,
+)
+from ichnaea.storage import configure_storage
 from ichnaea import util
 
 
@@ -41,6 +59,98 @@ CELL_HEADER_DICT['lac'] = 'area'
 CELL_HEADER_DICT['cid'] = 'cell'
 CELL_HEADER_DICT['psc'] = 'unit'
 
+# Map the public radio names back to their internal values
+RADIO_EXPORT_VALUES = dict([(radio.name.upper(), int(radio))
+                            for radio in Radio])
+
+# Seconds after which the incremental full export falls back to a
+# full table scan, this needs to be shorter than the expiry time
+# of the deleted cells set
+FULL_SCAN_INTERVAL = 6 * 86400
+
+# Seconds the incremental full export looks back before the time of the
+# previous export, to include cells modified before it but committed
+# only after it was read
+INCREMENTAL_OVERLAP = 600
+
+# Number of modified rows sorted in memory at a time, before they are
+# written to a temporary file, to be merged with the other sorted runs
+MODIFIED_RUN_SIZE = 50000
+
+# zlib window bits, accepting gzip headers
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Key prefix for the exported files
+EXPORT_PREFIX = 'export/'
+# File suffixes of the csv and columnar exports
+CSV_SUFFIX = '.csv.gz'
+COLUMNAR_SUFFIX = '.mlsc'
+# Key prefix for the gzip members of a parallel full export
+SHARD_PREFIX = EXPORT_PREFIX + 'shards/%s/'
+
+# Number of rows of an OpenCellID file imported in one transaction
+OCID_IMPORT_BATCH = 100000
+# Seconds to keep the progress of a failed OpenCellID import
+OCID_IMPORT_EXPIRE = 86400
+# Seconds an OpenCellID import may go without a checkpoint, before
+# another worker may take over its file
+OCID_IMPORT_LOCK_TIMEOUT = 3600
+# Directory holding the partial downloads of OpenCellID files
+OCID_DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), 'ichnaea_ocid')
+# Map the OpenCellID field names to the OCIDCell column names
+OCID_IMPORT_NAMES = {'samples': 'total_measures', 'updated': 'modified'}
+# The columns of the OCID import staging table, except its id
+OCID_IMPORT_COLUMNS = [
+    'radio', 'mcc', 'mnc', 'lac', 'cid', 'psc', 'lat', 'lon',
+    'range', 'total_measures', 'changeable', 'created', 'modified']
+
+OCID_CELL_ON_DUPLICATE = (
+    'changeable = values(changeable), '
+    'modified = values(modified), '
+    'total_measures = values(total_measures), '
+    'lat = values(lat), '
+    'lon = values(lon), '
+    'psc = values(psc), '
+    '`range` = values(`range`)')
+
+# The staging table holds one batch of rows in the order of the file,
+# with unix timestamps for the created and modified columns.
+OCID_IMPORT_CREATE = """\
+CREATE TEMPORARY TABLE IF NOT EXISTS ocid_cell_import (
+`id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+`radio` tinyint(4) NOT NULL,
+`mcc` smallint(6) NOT NULL,
+`mnc` smallint(6) NOT NULL,
+`lac` smallint(5) unsigned NOT NULL,
+`cid` int(10) unsigned NOT NULL,
+`psc` smallint(6) DEFAULT NULL,
+`lat` double DEFAULT NULL,
+`lon` double DEFAULT NULL,
+`range` int(11) DEFAULT NULL,
+`total_measures` int(11) DEFAULT NULL,
+`changeable` tinyint(1) DEFAULT NULL,
+`created` bigint(20) DEFAULT NULL,
+`modified` bigint(20) DEFAULT NULL,
+PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+# PyMySQL turns an executemany of this statement into multi-row inserts
+OCID_IMPORT_INSERT = 'INSERT INTO ocid_cell_import (%s) VALUES (%s)' % (
+    ', '.join(['`%s`' % name for name in OCID_IMPORT_COLUMNS]),
+    ', '.join(['%s'] * len(OCID_IMPORT_COLUMNS)))
+
+# Rows later in the file win over earlier rows for the same cell
+OCID_IMPORT_UPSERT = (
+    'INSERT INTO ocid_cell (%s) '
+    'SELECT %s, '
+    "DATE_ADD('1970-01-01', INTERVAL created SECOND), "
+    "DATE_ADD('1970-01-01', INTERVAL modified SECOND) "
+    'FROM ocid_cell_import ORDER BY id '
+    'ON DUPLICATE KEY UPDATE %s') % (
+    ', '.join(['`%s`' % name for name in OCID_IMPORT_COLUMNS]),
+    ', '.join(['`%s`' % name for name in OCID_IMPORT_COLUMNS[:-2]]),
+    OCID_CELL_ON_DUPLICATE)
+
 # The list of cell columns, we actually need for the export
 CELL_COLUMN_NAMES = [
     'created', 'modified', 'lat', 'lon',
@@ -85,31 +195,20 @@ class GzipFile(gzip.GzipFile):
         self.close()
 
 
-def make_cell_export_dict(row):
-    d = {
-        'changeable': 1,
-        'averageSignal': '',
-    }
-    ix = CELL_COLUMN_NAME_INDICES
-
-    for field in CELL_FIELDS:
-        pos = ix.get(field, None)
-        if pos is not None:
-            d[field] = row[pos]
-
-    # Fix up specific entry formatting
-    radio = row[ix['radio']]
+def make_cell_export_row(row):
+    """
+    Turn a row of :data:`CELL_COLUMNS` into a tuple of values
+    in the order of :data:`CELL_FIELDS`.
+    """
+    (created, modified, lat, lon, radio, mcc, mnc, lac, cid, psc,
+     range_, total_measures) = row[:len(CELL_COLUMNS)]
 
-    psc = row[ix['psc']]
     if psc is None or psc == -1:
         psc = ''
 
-    d['radio'] = radio.name.upper()
-    d['created'] = row[ix['created']]
-    d['updated'] = row[ix['modified']]
-    d['samples'] = row[ix['total_measures']]
-    d['psc'] = psc
-    return d
+    return (radio.name.upper(), mcc, mnc, lac, cid, psc,
+            lon, lat, range_, total_measures, 1,
+            created, modified, '')
 
 
 def make_ocid_cell_import_dict(row):
@@ -146,40 +245,276 @@ def make_ocid_cell_import_dict(row):
     return OCIDCell.validate(d)
 
 
-def write_stations_to_csv(session, table, columns,
-                          cond, path, make_dict, fields):
-    with GzipFile(path, 'wb') as f:
-        w = csv.DictWriter(f, fields, extrasaction='ignore')
-        limit = 10000
-        offset = 0
-        # Write header row
-        w.writerow(CELL_HEADER_DICT)
-        while True:
-            query = (select(columns=columns).where(cond)
-                                            .limit(limit)
-                                            .offset(offset)
-                                            .order_by(table.c.created))
-            rows = session.execute(query).fetchall()
-            if rows:
-                w.writerows([make_dict(r) for r in rows])
-                offset += limit
-            else:
+def keyset_condition(columns, values):
+    """
+    Return a condition selecting all rows sorting after the given
+    values of the given columns, in the order of the columns.
+
+    The condition is written in a form which lets MySQL use a range
+    scan over an index on the columns, unlike a row constructor.
+    """
+    condition = columns[-1] > values[-1]
+    for column, value in reversed(list(zip(columns[:-1], values[:-1]))):
+        condition = and_(column >= value, or_(column > value, condition))
+    return condition
+
+
+def write_csv_header(sink, fields):
+    """
+    Write a gzip member into the sink, only containing the header row.
+    """
+    with GzipFile(fileobj=sink, mode='wb') as f:
+        csv.writer(f).writerow([CELL_HEADER_DICT[field] for field in fields])
+
+
+def _with_key_columns(columns, key_columns):
+    # Return the columns extended by any missing key columns, and the
+    # indices of the key columns in them.
+    columns = list(columns)
+    key_indices = []
+    for key_column in key_columns:
+        for i, column in enumerate(columns):
+            if column is key_column:
+                key_indices.append(i)
                 break
+        else:
+            key_indices.append(len(columns))
+            columns.append(key_column)
+    return (columns, key_indices)
+
+
+def _iter_pages(session, columns, cond, order_columns, order_indices, batch):
+    # Yield pages of rows in the order of the given columns, continuing
+    # each page after the last values of the previous one.
+    last_values = None
+    while True:
+        query = select(columns=columns).where(cond)
+        if last_values is not None:
+            query = query.where(
+                keyset_condition(order_columns, last_values))
+        query = query.order_by(*order_columns).limit(batch)
+        rows = session.execute(query).fetchall()
+        yield rows
+        if len(rows) < batch:
+            break
+        last_values = [rows[-1][i] for i in order_indices]
+
+
+def iter_stations(session, table, columns, cond, make_row, batch=10000):
+    """
+    Yield all rows of the table matching the condition, each turned
+    into a tuple of values by ``make_row``.
+
+    The rows are paged through in primary key order, continuing each
+    page after the last key of the previous one.
+    """
+    key_columns = list(table.primary_key.columns)
+    columns, key_indices = _with_key_columns(columns, key_columns)
+    for rows in _iter_pages(session, columns, cond,
+                            key_columns, key_indices, batch):
+        for row in rows:
+            yield make_row(row)
+
+
+def _spill_run(run):
+    # Write a sorted run into a temporary file, which is removed
+    # once it is closed.
+    fd = tempfile.TemporaryFile()
+    for item in run:
+        cPickle.dump(item, fd, cPickle.HIGHEST_PROTOCOL)
+    fd.seek(0)
+    return fd
+
+
+def _read_run(fd):
+    while True:
+        try:
+            yield cPickle.load(fd)
+        except EOFError:
+            break
+
+
+def iter_modified_stations(session, table, columns, since, make_row,
+                           batch=10000, run_size=MODIFIED_RUN_SIZE):
+    """
+    Yield all rows of the table modified since the given time, each
+    turned into a tuple of values by ``make_row``, in primary key order.
+
+    The rows are paged through in the order of the index on the
+    modified column, which includes the primary key. Runs of up to
+    ``run_size`` rows are sorted by their primary key in memory and
+    written to temporary files, which are merged in the end.
+    """
+    order_columns = [table.c.modified] + list(table.primary_key.columns)
+    columns, order_indices = _with_key_columns(columns, order_columns)
+    key_indices = order_indices[1:]
+    run = []
+    runs = []
+    try:
+        for page in _iter_pages(session, columns, table.c.modified >= since,
+                                order_columns, order_indices, batch):
+            for row in page:
+                run.append((tuple([row[i] for i in key_indices]),
+                            make_row(row)))
+            if len(run) >= run_size:
+                run.sort()
+                runs.append(_spill_run(run))
+                run = []
+        # the last run stays in memory
+        run.sort()
+        merged = heapq.merge(*([_read_run(fd) for fd in runs] + [run]))
+        for key, row in merged:
+            yield row
+    finally:
+        for fd in runs:
+            fd.close()
 
 
-def write_stations_to_s3(path, bucketname):
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(bucketname)
-    k = boto.s3.key.Key(bucket)
-    k.key = 'export/' + os.path.split(path)[-1]
-    k.set_contents_from_filename(path, reduced_redundancy=True)
+def write_stations_to_csv(session, table, columns,
+                          cond, sink, make_row, fields,
+                          batch=10000, header=True):
+    """
+    Write all rows of the table matching the condition as a gzipped
+    csv file into the sink, optionally starting with a header row.
+    The rows are written in primary key order, see
+    :func:`iter_stations`.
+    """
+    with GzipFile(fileobj=sink, mode='wb') as f:
+        w = csv.writer(f)
+        if header:
+            w.writerow([CELL_HEADER_DICT[field] for field in fields])
+        w.writerows(iter_stations(
+            session, table, columns, cond, make_row, batch=batch))
+
+
+def iter_gzip_lines(chunks):
+    """
+    Yield the lines of a gzip file given as chunks of compressed data.
+    The file may consist of multiple concatenated gzip members.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = ''
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        while decompressor.unused_data:
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            data += decompressor.decompress(rest)
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def cell_row_key(row):
+    """
+    Return the key of a cell export row, as a tuple of numbers
+    sorting like the primary key of the cell table.
+    """
+    return (RADIO_EXPORT_VALUES[row[0]],
+            int(row[1]), int(row[2]), int(row[3]), int(row[4]))
+
+
+def _keyed_rows(rows, source):
+    for row in rows:
+        yield (cell_row_key(row), source, row)
+
+
+def merge_cell_rows(snapshot_rows, changed_rows, deleted_keys):
+    """
+    Merge the rows of a previous cell export with the rows of all
+    cells changed since, both in key order.
+
+    Changed rows replace the snapshot rows with the same key, changed
+    cells without a position and deleted cells are left out.
+    """
+    lat_index = CELL_FIELD_INDICES['lat']
+    last_key = None
+    # changed rows sort before snapshot rows with the same key
+    for key, source, row in heapq.merge(_keyed_rows(changed_rows, 0),
+                                        _keyed_rows(snapshot_rows, 1)):
+        if key == last_key:
+            continue
+        last_key = key
+        if source == 0:
+            if row[lat_index] is None:
+                continue
+        elif key in deleted_keys:
+            continue
+        yield row
+
+
+def write_incremental_cell_export(session, storage, snapshot_key,
+                                  since, deleted_keys, sink):
+    """
+    Write a full cell export into the sink, based on a previous full
+    export and all cells modified since the given time.
+    """
+    changed_rows = iter_modified_stations(
+        session, Cell.__table__, CELL_COLUMNS, since, make_cell_export_row)
+    snapshot_rows = csv.reader(iter_gzip_lines(storage.read(snapshot_key)))
+    # skip the header row
+    next(snapshot_rows, None)
+
+    with GzipFile(fileobj=sink, mode='wb') as f:
+        w = csv.writer(f)
+        w.writerow([CELL_HEADER_DICT[field] for field in CELL_FIELDS])
+        w.writerows(merge_cell_rows(snapshot_rows, changed_rows,
+                                    deleted_keys))
+
+
+def cell_snapshot(redis_client):
+    """
+    Return the key name, data time and time of the last full table
+    scan of the last full cell export, or None.
+    """
+    snapshot = redis_client.hgetall(CELL_SNAPSHOT_KEY)
+    if not snapshot:
+        return None
+    return (snapshot['key'], int(snapshot['time']), int(snapshot['scanned']))
+
+
+def record_cell_snapshot(redis_client, key_name, snapshot_time, scanned):
+    pipe = redis_client.pipeline()
+    pipe.hmset(CELL_SNAPSHOT_KEY, {
+        'key': key_name,
+        'time': snapshot_time,
+        'scanned': scanned,
+    })
+    # cells deleted before the snapshot time are no longer part of it
+    pipe.zremrangebyscore(DELETED_CELLS_KEY, '-inf', '(%s' % snapshot_time)
+    pipe.execute()
+
+
+def deleted_cell_keys(redis_client):
+    members = redis_client.zrange(DELETED_CELLS_KEY, 0, -1)
+    return set([tuple([int(value) for value in member.split(',')])
+                for member in members])
+
+
+def cell_export_shards(session, cond):
+    """
+    Return a list of all distinct (radio, mcc) pairs of the cells
+    matching the condition, in primary key order.
+    """
+    table = Cell.__table__
+    query = (select(columns=[table.c.radio, table.c.mcc])
+             .where(cond)
+             .distinct()
+             .order_by(table.c.radio, table.c.mcc))
+    return [(int(radio), mcc)
+            for radio, mcc in session.execute(query).fetchall()]
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
-def export_modified_cells(self, hourly=True, bucket=None):
+def export_modified_cells(self, hourly=True, bucket=None,
+                          parallel=False, incremental=False, columnar=False):
     if bucket is None:  # pragma: no cover
         bucket = self.app.settings['ichnaea']['s3_assets_bucket']
     now = util.utcnow()
+    snapshot_time = int(time.time())
 
     if hourly:
         end_time = now.replace(minute=0, second=0)
@@ -197,29 +532,123 @@ def export_modified_cells(self, hourly=True, bucket=None):
     filename = 'MLS-%s-cell-export-' % file_type
     filename = filename + file_time.strftime('%Y-%m-%dT%H0000.csv.gz')
 
-    with selfdestruct_tempdir() as d:
-        path = os.path.join(d, filename)
+    storage = configure_storage(bucket)
+    key_name = EXPORT_PREFIX + filename
+    if incremental and not hourly:
+        snapshot = cell_snapshot(self.redis_client)
+        if (snapshot is not None and
+                snapshot_time - snapshot[2] < FULL_SCAN_INTERVAL):
+            snapshot_key, since, scanned = snapshot
+            since = datetime.utcfromtimestamp(
+                since - INCREMENTAL_OVERLAP).replace(tzinfo=UTC)
+            try:
+                with storage.sink(key_name, reduced_redundancy=True) as sink:
+                    with self.db_session() as session:
+                        write_incremental_cell_export(
+                            session, storage, snapshot_key, since,
+                            deleted_cell_keys(self.redis_client), sink)
+            except Exception:
+                # fall back to a full table scan
+                self.raven_client.captureException()
+            else:
+                record_cell_snapshot(
+                    self.redis_client, key_name, snapshot_time, scanned)
+                if columnar:
+                    export_cell_columns.delay(bucket, key_name)
+                return
+
+    if parallel and not hourly:
+        # Export each (radio, mcc) shard in a separate task into its
+        # own gzip member, and concatenate the members afterwards.
+        with self.db_session() as session:
+            shards = cell_export_shards(session, cond)
+        if not shards:
+            concat_cell_export.delay(
+                [], filename, bucket, snapshot_time, columnar)
+            return
+        header = [export_cell_shard.s(filename, radio, mcc, bucket)
+                  for radio, mcc in shards]
+        chord(header)(concat_cell_export.s(
+            filename, bucket, snapshot_time, columnar))
+        return
+
+    with storage.sink(key_name, reduced_redundancy=True) as sink:
         with self.db_session() as session:
             write_stations_to_csv(session, Cell.__table__, CELL_COLUMNS, cond,
-                                  path, make_cell_export_dict, CELL_FIELDS)
-        write_stations_to_s3(path, bucket)
+                                  sink, make_cell_export_row, CELL_FIELDS)
+
+    if not hourly:
+        record_cell_snapshot(
+            self.redis_client, key_name, snapshot_time, snapshot_time)
+    if columnar:
+        export_cell_columns.delay(bucket, key_name)
+
+
+@celery_app.task(base=DatabaseTask, bind=True, ignore_result=False)
+def export_cell_shard(self, filename, radio, mcc, bucket):
+    table = Cell.__table__
+    cond = and_(table.c.lat.isnot(None),
+                table.c.radio == Radio(radio),
+                table.c.mcc == mcc)
+    key_name = SHARD_PREFIX % filename + '%s-%s.csv.gz' % (radio, mcc)
+    with configure_storage(bucket).sink(key_name) as sink:
+        with self.db_session() as session:
+            write_stations_to_csv(session, table, CELL_COLUMNS, cond,
+                                  sink, make_cell_export_row, CELL_FIELDS,
+                                  header=False)
+    return key_name
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def concat_cell_export(self, shard_keys, filename, bucket,
+                       snapshot_time=None, columnar=False):
+    # A concatenation of gzip members is itself a valid gzip file,
+    # so the shards can be appended as-is after the header member.
+    storage = configure_storage(bucket)
+    key_name = EXPORT_PREFIX + filename
+    with storage.sink(key_name, reduced_redundancy=True) as sink:
+        write_csv_header(sink, CELL_FIELDS)
+        for shard_key in shard_keys:
+            for data in storage.read(shard_key):
+                sink.write(data)
+    storage.delete(shard_keys)
+
+    if snapshot_time is not None:
+        record_cell_snapshot(
+            self.redis_client, key_name, snapshot_time, snapshot_time)
+    if columnar:
+        export_cell_columns.delay(bucket, key_name)
+
+
+@celery_app.task(base=DatabaseTask, bind=True)
+def export_cell_columns(self, bucket, key_name):
+    # Convert a finished csv export into the columnar format.
+    storage = configure_storage(bucket)
+    rows = csv.reader(iter_gzip_lines(storage.read(key_name)))
+    # skip the header row
+    next(rows, None)
+
+    columns_key = key_name[:-len(CSV_SUFFIX)] + COLUMNAR_SUFFIX
+    with storage.sink(columns_key, reduced_redundancy=True) as sink:
+        writer = ColumnarWriter(sink, CELL_FIELDS, RADIO_EXPORT_VALUES)
+        writer.writerows(rows)
+        writer.close()
 
 
 def import_stations(session, filename, fields):
+    """
+    Import the cells of a gzipped OpenCellID csv file row by row.
+
+    This is the slower predecessor of :func:`bulk_import_stations`,
+    kept to compare the two. Returns the set of area keys of all
+    imported cells.
+    """
     with GzipFile(filename, 'rb') as zip_file:
         csv_reader = csv.DictReader(zip_file, fields)
         batch = 10000
         rows = []
         area_keys = set()
-        ins = OCIDCell.__table__.insert(
-            on_duplicate=((
-                'changeable = values(changeable), '
-                'modified = values(modified), '
-                'total_measures = values(total_measures), '
-                'lat = values(lat), '
-                'lon = values(lon), '
-                'psc = values(psc), '
-                '`range` = values(`range`)')))
+        ins = OCIDCell.__table__.insert(on_duplicate=OCID_CELL_ON_DUPLICATE)
 
         for row in csv_reader:
             # skip any header row
@@ -241,8 +670,203 @@ def import_stations(session, filename, fields):
             session.execute(ins, rows)
             session.commit()
 
-        for area_key in area_keys:
-            update_area.delay(area_key, cell_type='ocid')
+    return area_keys
+
+
+def _bulk_import_batch(session, validator, names, rows, load=True):
+    columns = dict(zip(names, [list(column) for column in zip(*rows)]))
+    batch = validator.validate_batch(columns)
+    dropped = sum(batch.dropped.values())
+
+    values = batch.valid_columns(OCID_IMPORT_COLUMNS)
+    area_keys = set(zip(*values[:4]))
+    if not load:
+        return 0, 0, area_keys
+
+    values[0] = [int(radio) for radio in values[0]]
+    rows = list(zip(*values))
+    if rows:
+        session.execute(OCID_IMPORT_CREATE)
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.executemany(OCID_IMPORT_INSERT, rows)
+        finally:
+            cursor.close()
+        session.execute(OCID_IMPORT_UPSERT)
+        session.execute('DROP TEMPORARY TABLE ocid_cell_import')
+        session.commit()
+    return len(rows), dropped, area_keys
+
+
+def _import_batches(rows, width, batch, skip):
+    # Yield batches of rows padded to the given width, together with
+    # a flag telling if the batch lies within the first skipped rows.
+    # Skips any header row.
+    chunk = []
+    count = 0
+    for row in rows:
+        if not count and not chunk and row and row[0] == 'radio':
+            continue
+        if len(row) != width:
+            row = (row + [''] * width)[:width]
+        chunk.append(row)
+        if len(chunk) == batch or count + len(chunk) == skip:
+            count += len(chunk)
+            yield chunk, count <= skip
+            chunk = []
+    if chunk:
+        yield chunk, False
+
+
+def bulk_import_rows(session, rows, fields, batch=OCID_IMPORT_BATCH,
+                     skip=0, checkpoint=None):
+    """
+    Import OpenCellID cells given as an iterable of csv rows, whose
+    columns are given by ``fields``, into the ocid_cell table.
+
+    The rows are validated column by column in batches, bulk inserted
+    into a temporary staging table and merged into the ocid_cell table
+    with a single statement per batch.
+
+    The first ``skip`` rows were already imported by an earlier
+    attempt and are only validated to find their area keys. After
+    each batch, ``checkpoint`` is called with the number of rows
+    imported or skipped so far.
+
+    Returns the number of imported rows, the number of dropped rows
+    and the set of area keys of all imported cells.
+    """
+    validator = OCIDCellColumnValidator(OCIDCell._valid_schema())
+    names = [OCID_IMPORT_NAMES.get(field, field) for field in fields]
+    imported = dropped = done = 0
+    area_keys = set()
+
+    for chunk, skipped in _import_batches(rows, len(fields), batch, skip):
+        result = _bulk_import_batch(
+            session, validator, names, chunk, load=not skipped)
+        imported += result[0]
+        dropped += result[1]
+        area_keys.update(result[2])
+        done += len(chunk)
+        if checkpoint is not None and not skipped:
+            checkpoint(done)
+
+    area_keys = set([CellArea.to_hashkey(radio=radio, mcc=mcc, mnc=mnc,
+                                         lac=lac)
+                     for radio, mcc, mnc, lac in area_keys])
+    return imported, dropped, area_keys
+
+
+def bulk_import_stations(session, filename, fields,
+                         batch=OCID_IMPORT_BATCH):
+    """
+    Import the cells of a gzipped OpenCellID csv file, see
+    :func:`bulk_import_rows`.
+    """
+    with GzipFile(filename, 'rb') as zip_file:
+        return bulk_import_rows(
+            session, csv.reader(zip_file), fields, batch=batch)
+
+
+def import_ocid_rows(task, session, rows, batch=OCID_IMPORT_BATCH,
+                     skip=0, checkpoint=None):
+    start = time.time()
+    imported, dropped, area_keys = bulk_import_rows(
+        session, rows, CELL_FIELDS, batch=batch,
+        skip=skip, checkpoint=checkpoint)
+    duration = max(time.time() - start, 0.001)
+
+    stats_client = task.stats_client
+    stats_client.incr('items.import.ocid_cell.imported', imported)
+    stats_client.incr('items.import.ocid_cell.dropped', dropped)
+    stats_client.gauge('items.import.ocid_cell.rows_per_second',
+                       int((imported + dropped) / duration))
+
+    OCIDCellAreaRebuilder(task, session).rebuild(area_keys)
+    session.commit()
+
+
+def import_ocid_file(task, session, filename, batch=OCID_IMPORT_BATCH):
+    with GzipFile(filename, 'rb') as zip_file:
+        import_ocid_rows(task, session, csv.reader(zip_file), batch=batch)
+
+
+def import_ocid_stream(task, session, url, params, filename,
+                       batch=OCID_IMPORT_BATCH):
+    """
+    Import an OpenCellID file while it is being downloaded.
+
+    The progress is recorded in Redis after each batch, together with
+    a local copy of the downloaded data. If the import fails, the next
+    attempt for the same file only downloads the rest of the file and
+    skips the rows already imported.
+
+    Only one worker at a time may import a given file, as they would
+    otherwise write the same local copy and progress. Returns False if
+    the file is already being imported.
+    """
+    redis_client = task.redis_client
+    checkpoint_key = OCID_IMPORT_KEY % filename
+    lock = redis_client.lock(
+        checkpoint_key + ':lock', timeout=OCID_IMPORT_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        task.stats_client.incr('items.import.ocid_cell.busy')
+        return False
+
+    try:
+        _import_ocid_stream(task, session, url, params, filename,
+                            checkpoint_key, lock, batch=batch)
+    finally:
+        try:
+            lock.release()
+        except LockError:  # pragma: no cover
+            # the lock expired and another task might own it by now
+            pass
+    return True
+
+
+def _import_ocid_stream(task, session, url, params, filename,
+                        checkpoint_key, lock, batch=OCID_IMPORT_BATCH):
+    redis_client = task.redis_client
+    progress = redis_client.hgetall(checkpoint_key)
+    download = ResumableDownload(
+        url, os.path.join(OCID_DOWNLOAD_DIR, filename), params=params,
+        version=progress.get('version'))
+    download.start()
+
+    skip = 0
+    if download.resumed or progress.get('version') == download.version:
+        skip = int(progress.get('rows', 0))
+
+    extended = [time.time()]
+
+    def checkpoint(rows):
+        # The rows are committed, but the download runs ahead of them,
+        # so only the row count marks the progress. The next attempt
+        # reuses all of the local copy and skips the committed rows.
+        # Keep the lock for another full timeout, this fails if the
+        # lock expired in the meantime and another worker took over.
+        now = time.time()
+        lock.extend(now - extended[0])
+        extended[0] = now
+        pipe = redis_client.pipeline()
+        pipe.hmset(checkpoint_key, {
+            'rows': rows,
+            'version': download.version or '',
+        })
+        pipe.expire(checkpoint_key, OCID_IMPORT_EXPIRE)
+        pipe.execute()
+
+    try:
+        with ChunkPipe(download.chunks()) as chunks:
+            import_ocid_rows(task, session,
+                             csv.reader(iter_gzip_lines(chunks)),
+                             batch=batch, skip=skip, checkpoint=checkpoint)
+    finally:
+        download.close()
+
+    redis_client.delete(checkpoint_key)
+    download.remove()
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
@@ -250,13 +874,12 @@ def import_ocid_cells(self, filename=None, session=None):
     with self.db_session() as dbsession:
         if session is None:  # pragma: no cover
             session = dbsession
-        import_stations(session,
-                        filename,
-                        CELL_FIELDS)
+        import_ocid_file(self, session, filename)
 
 
 @celery_app.task(base=DatabaseTask, bind=True)
-def import_latest_ocid_cells(self, diff=True, filename=None, session=None):
+def import_latest_ocid_cells(self, diff=True, filename=None, session=None,
+                             pipelined=True, batch=OCID_IMPORT_BATCH):
     url = self.app.settings['ichnaea']['ocid_url']
     apikey = self.app.settings['ichnaea']['ocid_apikey']
     if filename is None:
@@ -265,6 +888,15 @@ def import_latest_ocid_cells(self, diff=True, filename=None, session=None):
             filename = prev_hour.strftime('cell_towers_diff-%Y%m%d%H.csv.gz')
         else:  # pragma: no cover
             filename = 'cell_towers.csv.gz'
+    params = {'apiKey': apikey, 'filename': filename}
+
+    if pipelined:
+        with self.db_session() as dbsession:
+            if session is None:  # pragma: no cover
+                session = dbsession
+            import_ocid_stream(self, session, url, params, filename,
+                               batch=batch)
+        return
 
     with closing(requests.get(url,
                               params={'apiKey': apikey,
@@ -280,6 +912,4 @@ def import_latest_ocid_cells(self, diff=True, filename=None, session=None):
             with self.db_session() as dbsession:
                 if session is None:  # pragma: no cover
                     session = dbsession
-                import_stations(session,
-                                path,
-                                CELL_FIELDS)
+                import_ocid_file(self, session, path)
@@ -1,22 +1,42 @@
+import BaseHTTPServer
 import boto
 import csv
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import UTC
 from contextlib import contextmanager
 from mock import MagicMock, patch
+from StringIO import StringIO
+import threading
+
+import numpy
 import requests_mock
 
+from ichnaea.async.config import (
+    CELL_SNAPSHOT_KEY,
+    DELETED_CELLS_KEY,
+    OCID_IMPORT_KEY,
+)
 from ichnaea.constants import CELL_MIN_ACCURACY
+from ichnaea.data.tasks import remove_cell
+from ichnaea.export.columnar import (
+    COLUMNS,
+    ColumnarWriter,
+    read_columns,
+)
 from ichnaea.export.tasks import (
+    bulk_import_stations,
     export_modified_cells,
     import_ocid_cells,
     import_latest_ocid_cells,
+    iter_modified_stations,
+    RADIO_EXPORT_VALUES,
     write_stations_to_csv,
-    make_cell_export_dict,
+    make_cell_export_row,
     selfdestruct_tempdir,
     CELL_COLUMNS,
+    OCID_DOWNLOAD_DIR,
     CELL_FIELDS,
     CELL_HEADER_DICT,
     GzipFile
@@ -27,7 +47,9 @@ from ichnaea.models import (
     OCIDCellArea,
     Radio,
 )
+from ichnaea.storage import LocalSink
 from ichnaea.tests.base import (
+    TestCase,
     CeleryTestCase,
     CeleryAppTestCase,
     FRANCE_MCC,
@@ -35,6 +57,56 @@ from ichnaea.tests.base import (
     PARIS_LAT,
     PARIS_LON,
 )
+from ichnaea import util
+
+
+class OCIDRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serve the server's data, supporting range requests and
+    # optionally breaking off the first response after some bytes.
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers)
+        data = server.data
+        start = 0
+        if self.headers.getheader('If-Range') == server.etag:
+            start = int(self.headers.getheader('Range')[6:-1])
+        body = data[start:]
+
+        if start:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+
+        if server.truncate:
+            body = body[:server.truncate]
+            server.truncate = None
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def ocid_http_server(data, truncate=None):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), OCIDRequestHandler)
+    server.data = data
+    server.etag = '"v1"'
+    server.truncate = truncate
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 @contextmanager
@@ -72,9 +144,10 @@ class TestExport(CeleryTestCase):
         with selfdestruct_tempdir() as temp_dir:
             path = os.path.join(temp_dir, 'export.csv.gz')
             cond = Cell.__table__.c.lat.isnot(None)
-            write_stations_to_csv(
-                session, Cell.__table__, CELL_COLUMNS, cond,
-                path, make_cell_export_dict, CELL_FIELDS)
+            with LocalSink(path) as sink:
+                write_stations_to_csv(
+                    session, Cell.__table__, CELL_COLUMNS, cond,
+                    sink, make_cell_export_row, CELL_FIELDS, batch=3)
 
             with GzipFile(path, 'rb') as gzip_file:
                 reader = csv.DictReader(gzip_file, CELL_FIELDS)
@@ -94,6 +167,41 @@ class TestExport(CeleryTestCase):
 
                 self.assertEqual(cells, exported_cells)
 
+    def test_export_keyset_pages(self):
+        session = self.session
+        keys = [
+            (Radio.gsm, 1, 2, 4, 5),
+            (Radio.gsm, 1, 2, 5, 1),
+            (Radio.gsm, 1, 3, 1, 1),
+            (Radio.gsm, 2, 1, 1, 1),
+            (Radio.umts, 1, 1, 1, 1),
+            (Radio.umts, 1, 1, 1, 2),
+            (Radio.lte, 1, 1, 1, 1),
+        ]
+        for radio, mcc, mnc, lac, cid in reversed(keys):
+            session.add(Cell(radio=radio, mcc=mcc, mnc=mnc, lac=lac,
+                             cid=cid, psc=-1, lat=1.0, lon=2.0))
+        session.commit()
+
+        with selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, 'export.csv.gz')
+            cond = Cell.__table__.c.lat.isnot(None)
+            with LocalSink(path) as sink:
+                write_stations_to_csv(
+                    session, Cell.__table__, CELL_COLUMNS, cond,
+                    sink, make_cell_export_row, CELL_FIELDS, batch=2)
+
+            with GzipFile(path, 'rb') as gzip_file:
+                rows = list(csv.reader(gzip_file))
+
+        self.assertEqual(rows[0], [CELL_HEADER_DICT[field]
+                                   for field in CELL_FIELDS])
+        self.assertEqual(
+            [tuple(row[:5]) for row in rows[1:]],
+            [(radio.name.upper(), str(mcc), str(mnc), str(lac), str(cid))
+             for radio, mcc, mnc, lac, cid in keys])
+        self.assertEqual(set([row[5] for row in rows[1:]]), set(['']))
+
     def test_hourly_export(self):
         session = self.session
         k = {'radio': Radio.gsm, 'mcc': 1, 'mnc': 2, 'lac': 4,
@@ -106,8 +214,8 @@ class TestExport(CeleryTestCase):
             export_modified_cells(bucket='localhost.bucket')
             pat = r'MLS-diff-cell-export-\d+-\d+-\d+T\d+0000\.csv\.gz'
             self.assertRegexpMatches(mock_key.key, pat)
-            method = mock_key.set_contents_from_filename
-            self.assertRegexpMatches(method.call_args[0][0], pat)
+            method = mock_key.set_contents_from_string
+            self.assertTrue(method.called)
 
     def test_daily_export(self):
         session = self.session
@@ -121,8 +229,223 @@ class TestExport(CeleryTestCase):
             export_modified_cells(bucket='localhost.bucket', hourly=False)
             pat = r'MLS-full-cell-export-\d+-\d+-\d+T000000\.csv\.gz'
             self.assertRegexpMatches(mock_key.key, pat)
-            method = mock_key.set_contents_from_filename
-            self.assertRegexpMatches(method.call_args[0][0], pat)
+            method = mock_key.set_contents_from_string
+            self.assertTrue(method.called)
+
+    def test_parallel_export(self):
+        session = self.session
+        for radio, mcc in ((Radio.gsm, 1), (Radio.gsm, 2), (Radio.lte, 1)):
+            for cid in range(1, 4):
+                session.add(Cell(radio=radio, mcc=mcc, mnc=2, lac=4, cid=cid,
+                                 lat=1.0, lon=2.0))
+        session.add(Cell(radio=Radio.umts, mcc=1, mnc=2, lac=4, cid=1,
+                         lat=None, lon=None))
+        session.commit()
+
+        exports = []
+        for parallel in (False, True):
+            with selfdestruct_tempdir() as temp_dir:
+                export_modified_cells(bucket='file://' + temp_dir,
+                                      hourly=False, parallel=parallel)
+                # only the final file is left, the shards are removed
+                paths = [os.path.join(root, name)
+                         for root, dirs, files in os.walk(temp_dir)
+                         for name in files]
+                self.assertEqual(len(paths), 1)
+                self.assertTrue(paths[0].startswith(
+                    os.path.join(temp_dir, 'export', 'MLS-full-cell-export')))
+                with GzipFile(paths[0], 'rb') as gzip_file:
+                    exports.append(gzip_file.read())
+
+        self.assertEqual(exports[0], exports[1])
+        rows = list(csv.reader(exports[1].splitlines()))
+        self.assertEqual(rows[0], [CELL_HEADER_DICT[field]
+                                   for field in CELL_FIELDS])
+        self.assertEqual(
+            [tuple(row[:5]) for row in rows[1:]],
+            [(radio, mcc, '2', '4', cid)
+             for radio, mcc in (('GSM', '1'), ('GSM', '2'), ('LTE', '1'))
+             for cid in ('1', '2', '3')])
+
+    def test_incremental_export(self):
+        session = self.session
+        redis_client = self.redis_client
+        old = util.utcnow() - timedelta(days=2)
+        k = {'mcc': 1, 'mnc': 2, 'lac': 4, 'lat': 1.0, 'lon': 2.0,
+             'created': old, 'modified': old}
+        for cid in range(1, 5):
+            session.add(Cell(radio=Radio.gsm, cid=cid, **k))
+        session.commit()
+
+        with selfdestruct_tempdir() as temp_dir:
+            bucket = 'file://' + temp_dir
+            # without a snapshot, a full table scan is done
+            export_modified_cells(
+                bucket=bucket, hourly=False, incremental=True)
+            snapshot = redis_client.hgetall(CELL_SNAPSHOT_KEY)
+            self.assertEqual(snapshot['time'], snapshot['scanned'])
+
+            # update, add, invalidate and remove cells
+            now = util.utcnow()
+            cells = session.query(Cell).order_by(Cell.cid).all()
+            cells[0].lat = 3.0
+            cells[0].modified = now
+            cells[1].lat = None
+            cells[1].modified = now
+            k.update({'created': now, 'modified': now})
+            session.add(Cell(radio=Radio.lte, cid=1, **k))
+            session.commit()
+            remove_cell.delay([Cell.to_hashkey(cells[2])])
+            self.assertEqual(redis_client.zcard(DELETED_CELLS_KEY), 1)
+
+            # pretend the last full table scan was an hour ago
+            scanned = int(snapshot['scanned']) - 3600
+            redis_client.hset(CELL_SNAPSHOT_KEY, 'scanned', scanned)
+            export_modified_cells(
+                bucket=bucket, hourly=False, incremental=True)
+            snapshot = redis_client.hgetall(CELL_SNAPSHOT_KEY)
+            self.assertEqual(int(snapshot['scanned']), scanned)
+
+            export_dir = os.path.join(temp_dir, 'export')
+            filename = os.listdir(export_dir)[0]
+            with GzipFile(os.path.join(export_dir, filename), 'rb') as fd:
+                incremental = fd.read()
+
+        # compare with the result of a full table scan
+        with selfdestruct_tempdir() as temp_dir:
+            export_modified_cells(bucket='file://' + temp_dir,
+                                  hourly=False, incremental=False)
+            export_dir = os.path.join(temp_dir, 'export')
+            filename = os.listdir(export_dir)[0]
+            with GzipFile(os.path.join(export_dir, filename), 'rb') as fd:
+                full = fd.read()
+
+        self.assertEqual(incremental, full)
+        rows = list(csv.reader(full.splitlines()))
+        self.assertEqual([(row[0], row[4], row[7]) for row in rows[1:]],
+                         [('GSM', '1', '3.0'), ('GSM', '4', '1.0'),
+                          ('LTE', '1', '1.0')])
+
+    def test_incremental_export_overlap(self):
+        session = self.session
+        redis_client = self.redis_client
+        old = util.utcnow() - timedelta(days=2)
+        k = {'radio': Radio.gsm, 'mcc': 1, 'mnc': 2, 'lac': 4,
+             'lat': 1.0, 'lon': 2.0, 'created': old, 'modified': old}
+        session.add(Cell(cid=1, **k))
+        session.commit()
+
+        with selfdestruct_tempdir() as temp_dir:
+            bucket = 'file://' + temp_dir
+            export_modified_cells(
+                bucket=bucket, hourly=False, incremental=True)
+            snapshot = redis_client.hgetall(CELL_SNAPSHOT_KEY)
+
+            # cells modified shortly before the previous export, but
+            # committed only after it, sorting before the older cell
+            modified = datetime.utcfromtimestamp(
+                int(snapshot['time']) - 60).replace(tzinfo=UTC)
+            k.update({'created': modified, 'modified': modified})
+            session.add(Cell(cid=3, **k))
+            k['modified'] = modified + timedelta(seconds=10)
+            session.add(Cell(cid=2, **k))
+            session.commit()
+
+            scanned = int(snapshot['scanned']) - 3600
+            redis_client.hset(CELL_SNAPSHOT_KEY, 'scanned', scanned)
+            with patch('ichnaea.export.tasks.iter_stations') as scan:
+                export_modified_cells(
+                    bucket=bucket, hourly=False, incremental=True)
+            self.assertFalse(scan.called)
+
+            export_dir = os.path.join(temp_dir, 'export')
+            filename = os.listdir(export_dir)[0]
+            with GzipFile(os.path.join(export_dir, filename), 'rb') as fd:
+                rows = list(csv.reader(fd.read().splitlines()))
+
+        self.assertEqual([row[4] for row in rows[1:]], ['1', '2', '3'])
+
+    def test_modified_sorted_runs(self):
+        session = self.session
+        now = util.utcnow()
+        k = {'radio': Radio.gsm, 'mcc': 1, 'mnc': 2,
+             'lat': 1.0, 'lon': 2.0, 'created': now}
+        # modified in the reverse of their key order
+        for i in range(11):
+            session.add(Cell(lac=i // 4, cid=i, modified=(
+                now - timedelta(seconds=i)), **k))
+        session.add(Cell(lac=5, cid=20, modified=now - timedelta(days=1),
+                         **k))
+        session.commit()
+
+        since = now - timedelta(hours=1)
+        for batch, run_size in ((3, 2), (4, 4), (100, 100)):
+            rows = list(iter_modified_stations(
+                session, Cell.__table__, CELL_COLUMNS, since,
+                make_cell_export_row, batch=batch, run_size=run_size))
+            self.assertEqual([row[4] for row in rows], range(11))
+
+    def test_columnar_export(self):
+        session = self.session
+        k = {'mcc': 1, 'mnc': 2, 'lac': 4, 'lat': 1.5, 'lon': 2.5}
+        session.add(Cell(radio=Radio.gsm, cid=1, psc=None, **k))
+        session.add(Cell(radio=Radio.umts, cid=70000, psc=12, range=500,
+                         total_measures=8, **k))
+        session.commit()
+
+        with selfdestruct_tempdir() as temp_dir:
+            export_modified_cells(bucket='file://' + temp_dir,
+                                  hourly=False, columnar=True)
+            export_dir = os.path.join(temp_dir, 'export')
+            filenames = sorted(os.listdir(export_dir))
+            self.assertEqual(len(filenames), 2)
+            self.assertTrue(filenames[0].endswith('.csv.gz'))
+            self.assertEqual(filenames[1],
+                             filenames[0][:-len('.csv.gz')] + '.mlsc')
+            with open(os.path.join(export_dir, filenames[1]), 'rb') as fd:
+                columns = read_columns(fd)
+
+        self.assertEqual(set(columns.keys()),
+                         set([name for name, dtype in COLUMNS]))
+        self.assertEqual(list(columns['radio']), [0, 2])
+        self.assertEqual(list(columns['cid']), [1, 70000])
+        self.assertEqual(list(columns['psc']), [-1, 12])
+        self.assertEqual(list(columns['lat']), [1.5, 1.5])
+        self.assertEqual(list(columns['lon']), [2.5, 2.5])
+        self.assertEqual(list(columns['range']), [0, 500])
+        self.assertEqual(list(columns['samples']), [0, 8])
+        self.assertTrue(columns['created'][0] > 1400000000)
+        self.assertEqual(columns['cid'].dtype, numpy.uint32)
+
+
+class TestColumnar(TestCase):
+
+    def _roundtrip(self, rows, **kw):
+        fd = StringIO()
+        writer = ColumnarWriter(fd, CELL_FIELDS, RADIO_EXPORT_VALUES, **kw)
+        writer.writerows(rows)
+        writer.close()
+        fd.seek(0)
+        return read_columns(fd)
+
+    def test_empty(self):
+        columns = self._roundtrip([])
+        self.assertEqual(len(columns['mcc']), 0)
+        self.assertEqual(columns['mcc'].dtype, numpy.uint16)
+
+    def test_chunks(self):
+        rows = [['LTE', '262', '1', '5', str(i), '', '-2.5', '1.25',
+                 '', '3', '1', '1406204196', '1406204197', '']
+                for i in range(10)]
+        columns = self._roundtrip(rows, chunk_rows=3)
+        self.assertEqual(list(columns['radio']), [3] * 10)
+        self.assertEqual(list(columns['cid']), range(10))
+        self.assertEqual(list(columns['psc']), [-1] * 10)
+        self.assertEqual(list(columns['lon']), [-2.5] * 10)
+        self.assertEqual(list(columns['updated']), [1406204197] * 10)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, read_columns, StringIO('MLSX'))
 
 
 class TestImport(CeleryAppTestCase):
@@ -194,8 +517,8 @@ class TestImport(CeleryAppTestCase):
     def test_local_import_delta(self):
         old_time = 1407000000
         new_time = 1408000000
-        old_date = datetime.fromtimestamp(old_time).replace(tzinfo=UTC)
-        new_date = datetime.fromtimestamp(new_time).replace(tzinfo=UTC)
+        old_date = datetime.utcfromtimestamp(old_time).replace(tzinfo=UTC)
+        new_date = datetime.utcfromtimestamp(new_time).replace(tzinfo=UTC)
 
         self.import_test_csv(time=old_time)
         cells = self.session.query(OCIDCell).all()
@@ -225,6 +548,47 @@ class TestImport(CeleryAppTestCase):
         self.assertEqual(
             self.session.query(OCIDCellArea).count(), len(lacs))
 
+    def test_bulk_import(self):
+        line = ('GSM,{mcc},{mnc},{lac},{cid},,{lon},{lat},'
+                '{range},1,1,{time},{time},')
+        lines = [
+            line.format(cid=1, lat=PARIS_LAT, lon=PARIS_LON, range=10,
+                        time=1407000000, **self.KEY),
+            line.format(cid=2, lat=95.0, lon=PARIS_LON, range=10,
+                        time=1407000000, **self.KEY),
+            line.format(cid=3, lat=PARIS_LAT, lon=PARIS_LON, range=12.5,
+                        time=1407000000, **self.KEY),
+            'FOO,1,2,3,4',
+            line.format(cid=1, lat=PARIS_LAT + 0.1, lon=PARIS_LON, range=20,
+                        time=1408000000, **self.KEY),
+        ]
+        with selfdestruct_tempdir() as d:
+            path = os.path.join(d, 'import.csv.gz')
+            with GzipFile(path, 'wb') as f:
+                f.write('\n'.join(lines))
+            imported, dropped, area_keys = bulk_import_stations(
+                self.session, path, CELL_FIELDS, batch=2)
+
+        self.assertEqual((imported, dropped), (3, 2))
+        self.assertEqual(len(area_keys), 1)
+
+        cells = self.session.query(OCIDCell).order_by(OCIDCell.cid).all()
+        self.assertEqual([cell.cid for cell in cells], [1, 3])
+        self.assertEqual(cells[0].lat, PARIS_LAT + 0.1)
+        self.assertEqual(cells[0].range, 20)
+        self.assertEqual(cells[0].created,
+                         datetime(2014, 8, 2, 17, 20, tzinfo=UTC))
+        self.assertEqual(cells[0].modified,
+                         datetime(2014, 8, 14, 7, 6, 40, tzinfo=UTC))
+        self.assertEqual(cells[1].range, 12)
+
+    def test_import_stats(self):
+        self.import_test_csv()
+        self.check_stats(
+            counter=[('items.import.ocid_cell.imported', 1, 9),
+                     ('items.import.ocid_cell.dropped', 1, 0)],
+            gauge=['items.import.ocid_cell.rows_per_second'])
+
     def test_local_import_latest_through_http(self):
         with self.get_test_csv() as path:
             with open(path, 'r') as f:
@@ -240,3 +604,67 @@ class TestImport(CeleryAppTestCase):
             (cell.radio, cell.mcc, cell.mnc, cell.lac) for cell in cells])
         self.assertEqual(
             self.session.query(OCIDCellArea).count(), len(lacs))
+
+    def test_import_latest_resumes(self):
+        filename = 'cell_towers_diff-test.csv.gz'
+        with self.get_test_csv(hi=31) as path:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        settings = self.celery_app.settings['ichnaea']
+        with ocid_http_server(data, truncate=len(data) // 2) as server:
+            url = 'http://127.0.0.1:%s/downloads/' % server.server_port
+            with patch.dict(settings, {'ocid_url': url}):
+                with self.assertRaises(Exception):
+                    import_latest_ocid_cells(
+                        filename=filename, session=self.session, batch=3)
+
+                progress = self.redis_client.hgetall(
+                    OCID_IMPORT_KEY % filename)
+                rows = int(progress['rows'])
+                self.assertTrue(0 < rows < 30)
+                self.assertEqual(rows % 3, 0)
+                self.assertEqual(progress['version'], '"v1"')
+                self.assertFalse('bytes' in progress)
+                self.assertEqual(self.session.query(OCIDCell).count(), rows)
+
+                import_latest_ocid_cells(
+                    filename=filename, session=self.session, batch=3)
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[0].getheader('Range'), None)
+        self.assertTrue(server.requests[1].getheader('Range'))
+
+        self.assertEqual(self.session.query(OCIDCell).count(), 30)
+        self.assertEqual(self.session.query(OCIDCellArea).count(), 1)
+        self.check_stats(
+            counter=[('items.import.ocid_cell.imported', 1, 30 - rows)])
+        self.assertFalse(self.redis_client.exists(OCID_IMPORT_KEY % filename))
+        self.assertFalse(
+            os.path.exists(os.path.join(OCID_DOWNLOAD_DIR, filename)))
+
+    def test_import_latest_busy(self):
+        filename = 'cell_towers_diff-test.csv.gz'
+        with self.get_test_csv(hi=31) as path:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        # another worker is importing the same file
+        lock = self.redis_client.lock(
+            OCID_IMPORT_KEY % filename + ':lock', timeout=60)
+        self.assertTrue(lock.acquire(blocking=False))
+
+        settings = self.celery_app.settings['ichnaea']
+        with ocid_http_server(data) as server:
+            url = 'http://127.0.0.1:%s/downloads/' % server.server_port
+            with patch.dict(settings, {'ocid_url': url}):
+                import_latest_ocid_cells(
+                    filename=filename, session=self.session, batch=3)
+                lock.release()
+                import_latest_ocid_cells(
+                    filename=filename, session=self.session, batch=3)
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(self.session.query(OCIDCell).count(), 30)
+        self.check_stats(
+            counter=[('items.import.ocid_cell.busy', 1)])
@@ -1,5 +1,6 @@
 import math
 from country_bounding_boxes import country_subunits_by_iso_code
+import numpy
 
 from ichnaea.models import constants
 
@@ -77,6 +78,27 @@ def distance(lat1, lon1, lat2, lon2):
     return d
 
 
+def distances(lats1, lons1, lats2, lons2):
+    """
+    Compute the distances in kilometers between the pairs of lat/longs
+    from the given arrays, using the same haversine calculation as
+    :func:`distance`.
+    """
+    dLon = numpy.radians(lons2 - lons1)
+    dLat = numpy.radians(lats2 - lats1)
+
+    lats1 = numpy.radians(lats1)
+    lats2 = numpy.radians(lats2)
+
+    a = numpy.sin(dLat / 2.0) * numpy.sin(dLat / 2.0) + \
+        numpy.cos(lats1) * \
+        numpy.cos(lats2) * \
+        numpy.sin(dLon / 2.0) * \
+        numpy.sin(dLon / 2.0)
+    c = 2 * numpy.arcsin(numpy.minimum(1, numpy.sqrt(a)))
+    return EARTH_RADIUS * c
+
+
 def centroid(points):
     """
     Compute the centroid (average lat and lon) from a set of points
@@ -111,6 +133,22 @@ def location_is_in_country(lat, lon, country, margin=0):
     return False
 
 
+def locations_are_in_country(lats, lons, country, margin=0):
+    """
+    Return a boolean array telling whether or not each lat, lon pair
+    from the two given arrays is inside one of the country subunits
+    associated with a given alpha2 country code.
+
+    """
+    inside = numpy.zeros(len(lats), dtype=bool)
+    with numpy.errstate(invalid='ignore'):
+        for c in country_subunits_by_iso_code(country):
+            (lon1, lat1, lon2, lat2) = c.bbox
+            inside |= ((lon1 - margin <= lons) & (lons <= lon2 + margin) &
+                       (lat1 - margin <= lats) & (lats <= lat2 + margin))
+    return inside
+
+
 def bound(low, value, high):
     """
     If value is between low and high, return value.
@@ -9,6 +9,7 @@ from ichnaea.models.backup import (  # NOQA
 )
 from ichnaea.models.cell import (  # NOQA
     Cell,
+    CellAggregate,
     CellArea,
     CellBlacklist,
     OCIDCell,
@@ -35,6 +36,7 @@ from ichnaea.models.observation import (  # NOQA
 )
 from ichnaea.models.wifi import (  # NOQA
     Wifi,
+    WifiAggregate,
     WifiBlacklist,
 )
 
@@ -0,0 +1,558 @@
+"""
+Column oriented validation of observations.
+
+The colander schemas validate one observation at a time, spending
+most of their time in per-node dispatch and exception handling.
+The validators in this module use the very same schema nodes as
+their source of truth for types, ranges and default values, but
+apply the checks to whole columns of values using NumPy masks.
+"""
+
+from collections import defaultdict
+
+import colander
+import mobile_codes
+import numpy
+
+from ichnaea import geocalc
+from ichnaea.models import constants
+from ichnaea.models.cell import Radio
+from ichnaea.models.schema import DefaultNode
+
+# keys rejected by the INVALID_WIFI_REGEX
+INVALID_WIFI_KEYS = ['0' * 12, 'f' * 12, constants.WIFI_TEST_KEY]
+
+
+def _objects(column):
+    # Return the column as a one dimensional array of Python objects.
+    # Comparisons, arithmetic and conversions on such arrays apply the
+    # Python operations to each value, from within NumPy.
+    array = numpy.empty(len(column), dtype=object)
+    array[:] = column
+    return array
+
+
+def _of_type(array, *types):
+    # Mask of the values whose type is exactly one of the given types.
+    return numpy.array(map(frozenset(types).__contains__, map(type, array)),
+                       dtype=bool)
+
+
+def _missing(array):
+    # Mask of the values a colander number node treats as missing.
+    null = colander.null
+    return (array == null) | (~array.astype(bool) & (array != 0))
+
+
+def _integers(column):
+    # Convert a column into integers, like calling int on each value.
+    # Returns a list of the integers, using colander.null for values
+    # which can't be converted, and a mask of those.
+    array = _objects(column)
+    invalid = numpy.zeros(len(array), dtype=bool)
+    try:
+        return array.astype(numpy.int64).tolist(), invalid
+    except (OverflowError, TypeError, ValueError):
+        pass
+    values = array.tolist()
+    for i, value in enumerate(values):
+        try:
+            values[i] = int(value)
+        except (TypeError, ValueError):
+            values[i] = colander.null
+            invalid[i] = True
+    return values, invalid
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except OverflowError:
+        return numpy.inf if value > 0 else -numpy.inf
+
+
+def _timestamps(column):
+    # Convert a column of integer strings into a list of integers,
+    # treating missing values as zero. Returns the list and a mask
+    # of the invalid values.
+    null = colander.null
+    values = [0 if value is null or value == '' else value
+              for value in column]
+    invalid = numpy.zeros(len(values), dtype=bool)
+    try:
+        return numpy.array(values).astype(numpy.int64).tolist(), invalid
+    except (OverflowError, ValueError):
+        pass
+    for i, value in enumerate(values):
+        try:
+            values[i] = int(value)
+        except (OverflowError, ValueError):
+            values[i] = 0
+            invalid[i] = True
+    return values, invalid
+
+
+class ColumnBatch(object):
+    """
+    The state of one batch of rows during validation.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.valid = numpy.ones(size, dtype=bool)
+        self.dropped = defaultdict(int)
+        self.values = {}
+        self.numbers = {}
+
+    def drop(self, mask, reason):
+        mask = mask & self.valid
+        count = int(mask.sum())
+        if count:
+            self.dropped[reason] += count
+            self.valid &= ~mask
+
+    def valid_columns(self, names):
+        """
+        Return a list of columns of the valid rows, one for each of
+        the given names.
+        """
+        valid = numpy.flatnonzero(self.valid)
+        return [[self.values[name][i] for i in valid] for name in names]
+
+    def rows(self):
+        names = list(self.values.keys())
+        rows = []
+        for i in numpy.flatnonzero(self.valid):
+            rows.append(dict([(name, self.values[name][i])
+                              for name in names]))
+        return rows
+
+
+class ColumnValidator(object):
+    """
+    A ColumnValidator validates columns of values with the same result
+    as validating each row with the given schema.
+
+    Rows failing validation are dropped and counted by reason: ``key``
+    for the station key fields, ``position`` for lat/lon, ``report``
+    for the remaining report fields and ``country`` for positions
+    outside of the country of the station.
+    """
+
+    key_fields = ()
+    position_fields = ('lat', 'lon')
+    extra_fields = ()  # fields only used while preparing the columns
+    prepared_fields = ()  # fields fully validated while preparing them
+    cached_fields = ('created', 'time')
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.fields = schema.fields
+
+    @property
+    def column_names(self):
+        return ([node.name for node in self.schema.children] +
+                list(self.extra_fields))
+
+    def columns(self, entries):
+        """
+        Transform a list of entry dicts into a dict of columns, using
+        :data:`colander.null` for missing values.
+        """
+        null = colander.null
+        return dict([(name, [entry.get(name, null) for entry in entries])
+                     for name in self.column_names])
+
+    def reason(self, name):
+        if name in self.key_fields:
+            return 'key'
+        if name in self.position_fields:
+            return 'position'
+        return 'report'
+
+    def validate(self, columns):
+        """
+        Validate a dict of equal length columns.
+
+        Returns a list of validated dicts, one for each valid row,
+        and a dict of drop counts by reason.
+        """
+        batch = self.validate_batch(columns)
+        return batch.rows(), dict(batch.dropped)
+
+    def validate_batch(self, columns):
+        """
+        Validate a dict of equal length columns and return the
+        :class:`ColumnBatch` holding the validated values.
+        """
+        size = max([len(column) for column in columns.values()] or [0])
+        columns = dict([(name, list(columns.get(
+            name, [colander.null] * size))) for name in self.column_names])
+        batch = ColumnBatch(size)
+        self.prepare(batch, columns)
+
+        reasons = ('key', 'position', 'report')
+        nodes = sorted([node for node in self.schema.children
+                        if node.name not in self.prepared_fields],
+                       key=lambda node: reasons.index(self.reason(node.name)))
+        for node in nodes:
+            column = columns[node.name]
+            # exact type check, custom types like the RadioType
+            # subclass colander.Integer
+            if type(node.typ) in (colander.Float, colander.Integer):
+                invalid = self.validate_number(batch, node, column)
+            else:
+                invalid = self.validate_object(batch, node, column)
+            batch.drop(invalid, self.reason(node.name))
+
+        self.validator(batch)
+        return batch
+
+    def prepare(self, batch, columns):
+        # Modify the raw columns like the schema does before
+        # deserializing them.
+        pass
+
+    def validator(self, batch):
+        # Apply the schema validator to the validated columns.
+        pass
+
+    def validate_number(self, batch, node, column):
+        converted = self.convert_numbers(batch, node, column)
+        if converted is None:
+            converted = self.convert_values(batch, node, column)
+        values, present, invalid, numbers = converted
+
+        if isinstance(node.validator, colander.Range):
+            with numpy.errstate(invalid='ignore'):
+                if node.validator.min is not None:
+                    invalid |= present & (numbers < node.validator.min)
+                if node.validator.max is not None:
+                    invalid |= present & (numbers > node.validator.max)
+            present &= ~invalid
+
+        missing = ~present
+        if isinstance(node, DefaultNode):
+            invalid[:] = False
+        elif node.missing is colander.required:
+            invalid |= missing
+
+        if node.missing is not colander.required:
+            for i in numpy.flatnonzero(missing):
+                values[i] = node.missing
+            numbers[missing] = node.missing
+
+        batch.values[node.name] = values
+        batch.numbers[node.name] = numbers
+        return invalid
+
+    def convert_numbers(self, batch, node, column):
+        # Convert a whole column in one go. NumPy converts each present
+        # value like the schema node does, via int or float. Returns
+        # None if any value fails to convert or doesn't fit into a
+        # 64 bit number, so the values can be looked at one by one.
+        array = _objects(column)
+        try:
+            present = ~_missing(array)
+        except Exception:
+            return None
+        dtype = numpy.float64
+        if type(node.typ) is colander.Integer:
+            dtype = numpy.int64
+        parsed = numpy.zeros(batch.size, dtype=dtype)
+        try:
+            parsed[present] = array[present].astype(dtype)
+        except (OverflowError, TypeError, ValueError):
+            return None
+        invalid = numpy.zeros(batch.size, dtype=bool)
+        return (parsed.tolist(), present, invalid,
+                parsed.astype(numpy.float64))
+
+    def convert_values(self, batch, node, column):
+        num = node.typ.num
+        values = [None] * batch.size
+        present = numpy.zeros(batch.size, dtype=bool)
+        invalid = numpy.zeros(batch.size, dtype=bool)
+        numbers = numpy.zeros(batch.size, dtype=numpy.float64)
+        for i in numpy.flatnonzero(batch.valid):
+            value = column[i]
+            if value is colander.null or (value != 0 and not value):
+                continue
+            try:
+                value = num(value)
+            except Exception:
+                invalid[i] = True
+                continue
+            values[i] = value
+            present[i] = True
+            numbers[i] = _as_float(value)
+        return values, present, invalid, numbers
+
+    def validate_object(self, batch, node, column):
+        cache = node.name in self.cached_fields
+        deserialized = {}
+        values = [None] * batch.size
+        invalid = numpy.zeros(batch.size, dtype=bool)
+        for i in numpy.flatnonzero(batch.valid):
+            value = column[i]
+            if cache and value in deserialized:
+                result = deserialized[value]
+            else:
+                try:
+                    result = node.deserialize(value)
+                except colander.Invalid:
+                    result = colander.required
+                if cache:
+                    deserialized[value] = result
+            if result is colander.required:
+                invalid[i] = True
+            else:
+                values[i] = result
+
+        batch.values[node.name] = values
+        return invalid
+
+
+class CellColumnValidator(ColumnValidator):
+    """
+    A column validator for
+    :class:`ichnaea.models.observation.ValidCellObservationSchema`.
+    """
+
+    key_fields = ('radio', 'mcc', 'mnc', 'lac', 'cid', 'psc')
+    cached_fields = ('created', 'radio', 'time')
+
+    def prepare(self, batch, columns):
+        null = colander.null
+        asu = _objects(columns['asu'])
+        signal = _objects(columns['signal'])
+        # Sometimes the asu and signal fields are swapped
+        swapped = ((numpy.where(asu == null, 0, asu) < -1) &
+                   (numpy.where(signal == null, None, signal) == 0))
+        swapped = swapped.astype(bool)
+        signal[swapped] = asu[swapped]
+        asu[swapped] = self.fields['asu'].missing
+        columns['asu'] = asu.tolist()
+        columns['signal'] = signal.tolist()
+
+        self.prepare_key(batch, columns)
+
+    def prepare_key(self, batch, columns):
+        null = colander.null
+        radio = _objects(columns['radio'])
+        lac = _objects(columns['lac'])
+        cid = _objects(columns['cid'])
+
+        # deserialize and validate the distinct radio values early
+        radio_node = self.fields['radio']
+        radios = dict([(value, radio_node.deserialize(value))
+                       for value in set(radio[radio != null])])
+        radio = _objects(map(radios.get, columns['radio']))
+        invalid = ~_of_type(radio, Radio)
+
+        # If the cell id >= 65536 then it must be a umts tower
+        cid_values = numpy.where(cid == null, 0, cid)
+        umts = ~invalid & (cid_values >= 65536) & (radio == Radio.gsm)
+        radio[umts.astype(bool)] = Radio.umts
+
+        # Treat cid=65535 without a valid lac as an unspecified value
+        unspecified = ((numpy.where(lac == null, 0, lac) == 0) &
+                       (numpy.where(cid == null, None, cid) == 65535))
+        cid[~invalid & unspecified.astype(bool)] = self.fields['cid'].missing
+
+        columns['radio'] = radio.tolist()
+        columns['cid'] = cid.tolist()
+        batch.drop(invalid, 'key')
+
+    def validator(self, batch):
+        self.validate_key(batch)
+
+        mcc = batch.numbers['mcc']
+        lat = batch.numbers['lat']
+        lon = batch.numbers['lon']
+        inside = numpy.zeros(batch.size, dtype=bool)
+        for code in numpy.unique(mcc[batch.valid]):
+            rows = batch.valid & (mcc == code)
+            for country in mobile_codes.mcc(str(int(code))):
+                inside |= rows & geocalc.locations_are_in_country(
+                    lat, lon, country.alpha2, 1)
+        batch.drop(~inside, 'country')
+
+    def validate_key(self, batch):
+        radio = numpy.array([int(value) if value is not None else -1
+                             for value in batch.values['radio']])
+        mcc = batch.numbers['mcc']
+        mnc = batch.numbers['mnc']
+        lac = batch.numbers['lac']
+        cid = batch.numbers['cid']
+        lac_missing = lac == self.fields['lac'].missing
+        cid_missing = cid == self.fields['cid'].missing
+        psc_missing = batch.numbers['psc'] == self.fields['psc'].missing
+
+        cdma = radio == int(Radio.cdma)
+        gsm_family = numpy.in1d(
+            radio, [int(value) for value in Radio._gsm_family()])
+
+        invalid = ~numpy.in1d(mcc, sorted(constants.ALL_VALID_MCCS))
+        invalid |= cdma & (lac_missing | cid_missing)
+        invalid |= gsm_family & (mnc > 999)
+        invalid |= (lac_missing | cid_missing) & psc_missing
+        invalid |= cdma & (cid > constants.MAX_CID_CDMA)
+        invalid |= (radio == int(Radio.lte)) & (cid > constants.MAX_CID_LTE)
+        invalid |= gsm_family & (lac > constants.MAX_LAC_GSM_UMTS_LTE)
+        batch.drop(invalid, 'key')
+
+
+class OCIDCellColumnValidator(CellColumnValidator):
+    """
+    A column validator for
+    :class:`ichnaea.models.cell.ValidOCIDCellSchema`, accepting the
+    string values of the OpenCellID csv files.
+
+    The created and modified columns hold integer unix timestamps,
+    which are validated as such, rather than converted into datetimes.
+    """
+
+    cached_fields = ('changeable', 'radio')
+    prepared_fields = ('created', 'modified')
+
+    def prepare(self, batch, columns):
+        null = colander.null
+        # OpenCellID uses upper case radio names
+        radio = _objects(columns['radio'])
+        lowered = dict([(value, value.lower())
+                        for value in set(radio[radio != null])])
+        lowered[null] = null
+        columns['radio'] = map(lowered.get, columns['radio'])
+
+        # The key preparation compares the lac and cid numerically,
+        # both fall back to their missing values if they are invalid
+        for name in ('lac', 'cid'):
+            columns[name], invalid = _integers(columns[name])
+
+        # The range is sometimes given as a float
+        values = _objects(columns['range'])
+        present = ((values != null) & (values != '')).astype(bool)
+        invalid = self.prepare_range(values, present)
+        columns['range'] = values.tolist()
+        batch.drop(invalid, 'report')
+
+        for name in self.prepared_fields:
+            values, invalid = _timestamps(columns[name])
+            batch.values[name] = values
+            batch.drop(invalid, 'report')
+
+        self.prepare_key(batch, columns)
+
+    def prepare_range(self, values, present):
+        # Replace the present values by int(float(value)) in place,
+        # returns a mask of the values which can't be converted.
+        invalid = numpy.zeros(len(values), dtype=bool)
+        try:
+            floats = values[present].astype(numpy.float64)
+        except (TypeError, ValueError):
+            floats = None
+        if (floats is not None and numpy.isfinite(floats).all() and
+                (numpy.abs(floats) < 2 ** 63).all()):
+            values[present] = floats.astype(numpy.int64).tolist()
+            return invalid
+        for i in numpy.flatnonzero(present):
+            try:
+                values[i] = int(float(values[i]))
+            except ValueError:
+                invalid[i] = True
+        return invalid
+
+    def validator(self, batch):
+        # OpenCellID cells aren't checked against country borders.
+        self.validate_key(batch)
+
+
+class WifiColumnValidator(ColumnValidator):
+    """
+    A column validator for
+    :class:`ichnaea.models.observation.ValidWifiObservationSchema`.
+    """
+
+    key_fields = ('key', )
+    extra_fields = ('frequency', 'signalToNoiseRatio')
+    cached_fields = ('created', 'key', 'time')
+
+    def prepare(self, batch, columns):
+        null = colander.null
+        invalid = ~_objects(columns['key']).astype(bool)
+        rows = numpy.flatnonzero(~invalid)
+
+        channel = _objects(columns['channel'])
+        numbers = numpy.where(channel == null, 0, channel)[rows]
+        try:
+            numbers = numbers.astype(numpy.int64)
+        except OverflowError:
+            numbers = _objects([int(value) for value in numbers])
+        # if no explicit channel was given, calculate
+        calculate = rows[~((constants.MIN_WIFI_CHANNEL < numbers) &
+                           (numbers < constants.MAX_WIFI_CHANNEL))]
+        freq = _objects(columns['frequency'])[calculate]
+        freq = numpy.where(freq == null, 0, freq)
+        # 2.4 GHz band
+        band = ((2411 < freq) & (freq < 2473)).astype(bool)
+        channel[calculate[band]] = (freq[band] - 2407) // 5
+        # 5 GHz band
+        other = ~band
+        band = other & ((5169 < freq) & (freq < 5826)).astype(bool)
+        channel[calculate[band]] = (freq[band] - 5000) // 5
+        channel[calculate[other & ~band]] = self.fields['channel'].missing
+        columns['channel'] = channel.tolist()
+
+        # map external name to internal
+        snr = _objects(columns['snr'])
+        values = snr[rows]
+        external = rows[(values == null) | _of_type(values, type(None))]
+        ratio = _objects(columns['signalToNoiseRatio'])[external]
+        snr[external] = numpy.where(ratio == null, 0, ratio)
+        columns['snr'] = snr.tolist()
+
+        batch.drop(invalid, 'key')
+
+    def validate_object(self, batch, node, column):
+        if node.name == 'key':
+            invalid = self.validate_keys(batch, node, column)
+            if invalid is not None:
+                return invalid
+        return ColumnValidator.validate_object(self, batch, node, column)
+
+    def validate_keys(self, batch, node, column):
+        # Validate the wifi keys of the valid rows like the key node does,
+        # using NumPy's string functions. Returns None if any key isn't
+        # a plain string NumPy can hold unchanged.
+        rows = numpy.flatnonzero(batch.valid)
+        keys = _objects(column)[rows]
+        if not _of_type(keys, str, unicode).all():
+            return None
+        lengths = numpy.array(map(len, keys), dtype=numpy.int64)
+        try:
+            keys = keys.astype(numpy.unicode_)
+        except UnicodeDecodeError:
+            return None
+        if len(keys) and (numpy.char.str_len(keys) != lengths).any():
+            # NumPy strips trailing null characters
+            return None
+        for char in ':-.':
+            keys = numpy.char.replace(keys, char, '')
+        keys = numpy.char.lower(keys)
+
+        # exactly twelve hex digits, looking at the code points
+        invalid = numpy.char.str_len(keys) != 12
+        points = keys.astype('U12').view(numpy.uint32).reshape(-1, 12)
+        hex_digits = (((points >= ord('0')) & (points <= ord('9'))) |
+                      ((points >= ord('a')) & (points <= ord('f'))))
+        invalid |= ~hex_digits.all(axis=1)
+        invalid |= numpy.in1d(keys, INVALID_WIFI_KEYS)
+
+        values = [None] * batch.size
+        for i, key in zip(rows[~invalid].tolist(), keys[~invalid].tolist()):
+            values[i] = key
+        batch.values[node.name] = values
+        result = numpy.zeros(batch.size, dtype=bool)
+        result[rows[invalid]] = True
+        return result
@@ -33,6 +33,7 @@ from ichnaea.models.schema import (
 )
 from ichnaea.models.station import (
     BaseStationMixin,
+    StationAggregateMixin,
     StationMixin,
     StationBlacklistMixin,
     ValidStationSchema,
@@ -332,3 +333,11 @@ class CellBlacklist(CellKeyMixin, StationBlacklistMixin, _Model):
     _indices = (
         PrimaryKeyConstraint('radio', 'mcc', 'mnc', 'lac', 'cid'),
     )
+
+
+class CellAggregate(CellKeyMixin, StationAggregateMixin, _Model):
+    __tablename__ = 'cell_aggregate'
+
+    _indices = (
+        PrimaryKeyConstraint('radio', 'mcc', 'mnc', 'lac', 'cid'),
+    )
@@ -21,6 +21,10 @@ from ichnaea.models.base import (
     PositionMixin,
     ValidationMixin,
 )
+from ichnaea.models.batch import (
+    CellColumnValidator,
+    WifiColumnValidator,
+)
 from ichnaea.models.cell import (
     CellKey,
     CellKeyPsc,
@@ -134,6 +138,31 @@ class ObservationMixin(CreationMixin, BigIdMixin, Report):
             return None
         return cls(**validated)
 
+    @classmethod
+    def validate_columns(cls, columns):
+        """
+        Validate a dict of columns, for example ``{'lat': [...],
+        'lon': [...]}``, with the same result as calling
+        :meth:`validate` for each row.
+
+        Returns a list of validated dicts, one for each valid row,
+        and a dict of drop counts by reason.
+        """
+        return cls._column_validator(cls._valid_schema()).validate(columns)
+
+    @classmethod
+    def create_batch(cls, entries):
+        """
+        Create observations for a list of entry dicts, validating
+        them in one batch.
+
+        Returns a list of observations, one for each valid entry,
+        and a dict of drop counts by reason.
+        """
+        validator = cls._column_validator(cls._valid_schema())
+        rows, dropped = validator.validate(validator.columns(entries))
+        return [cls(**row) for row in rows], dropped
+
 
 class ValidCellLookupSchema(ValidCellKeySchema):
     """A schema which validates the fields in a cell lookup."""
@@ -201,6 +230,7 @@ class CellObservation(ObservationMixin, CellReport, _Model):
         Index('cell_measure_created_idx', 'created'),
         Index('cell_measure_key_idx', 'radio', 'mcc', 'mnc', 'lac', 'cid'),
     )
+    _column_validator = CellColumnValidator
     _valid_schema = ValidCellObservationSchema
 
 
@@ -280,4 +310,5 @@ class WifiObservation(ObservationMixin, WifiReport, _Model):
         Index('wifi_measure_key_idx', 'key'),
         Index('wifi_measure_key_created_idx', 'key', 'created'),
     )
+    _column_validator = WifiColumnValidator
     _valid_schema = ValidWifiObservationSchema
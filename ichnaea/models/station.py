@@ -38,6 +38,22 @@ class StationMixin(BaseStationMixin):
     new_measures = Column(Integer(unsigned=True))
 
 
+class StationAggregateMixin(object):
+    # Running sums and extents of the new observations of a station,
+    # which haven't been merged into the station position yet.
+
+    new_measures = Column(Integer(unsigned=True))
+
+    lat_sum = Column(Double(asdecimal=False))
+    lon_sum = Column(Double(asdecimal=False))
+
+    max_lat = Column(Double(asdecimal=False))
+    min_lat = Column(Double(asdecimal=False))
+
+    max_lon = Column(Double(asdecimal=False))
+    min_lon = Column(Double(asdecimal=False))
+
+
 class StationBlacklistMixin(object):
 
     time = Column(DateTime)
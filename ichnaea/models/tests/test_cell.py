@@ -1,3 +1,6 @@
+import colander
+
+from ichnaea.models.batch import OCIDCellColumnValidator
 from ichnaea.models.cell import (
     Cell,
     CellArea,
@@ -12,6 +15,7 @@ from ichnaea.tests.base import (
     GB_LON,
     GB_MCC,
     GB_MNC,
+    TestCase,
 )
 
 
@@ -98,6 +102,37 @@ class TestOCIDCell(DBTestCase):
         self.assertAlmostEqual(result.max_lon, GB_LON + 0.02727469, 7)
 
 
+class TestOCIDCellBatchValidation(TestCase):
+
+    def test_validate_columns(self):
+        fields = ['radio', 'mcc', 'mnc', 'lac', 'cid', 'psc', 'lat', 'lon',
+                  'range', 'created', 'modified']
+        base = ['GSM', str(GB_MCC), str(GB_MNC), '1234', '23456', '',
+                str(GB_LAT), str(GB_LON), '10', '1408604686', '1408604687']
+        rows = [
+            base,
+            base[:4] + ['70000'] + base[5:8] + ['12.5'] + base[9:],
+            ['LTE'] + base[1:3] + ['', '65535', '12'] + base[6:9] + ['', ''],
+            ['FOO'] + base[1:],
+            base[:6] + ['95.0'] + base[7:],
+            base[:9] + ['abc'] + base[10:],
+        ]
+        columns = dict(zip(fields, [list(column) for column in zip(*rows)]))
+        columns['changeable'] = [colander.null] * len(rows)
+
+        validator = OCIDCellColumnValidator(OCIDCell._valid_schema())
+        batch = validator.validate_batch(columns)
+        self.assertEqual(dict(batch.dropped),
+                         {'key': 1, 'position': 1, 'report': 1})
+
+        names = ['radio', 'lac', 'cid', 'psc', 'range', 'created', 'modified']
+        self.assertEqual(list(zip(*batch.valid_columns(names))), [
+            (Radio.gsm, 1234, 23456, -1, 10, 1408604686, 1408604687),
+            (Radio.umts, 1234, 70000, -1, 12, 1408604686, 1408604687),
+            (Radio.lte, 0, 0, 12, 10, 0, 0),
+        ])
+
+
 class TestOCIDCellArea(DBTestCase):
 
     def test_fields(self):
@@ -1,5 +1,7 @@
 import uuid
 
+import colander
+
 from ichnaea.models import (
     CellObservation,
     Radio,
@@ -10,7 +12,10 @@ from ichnaea.tests.base import (
     GB_LAT,
     GB_LON,
     GB_MCC,
+    TestCase,
+    USA_MCC,
 )
+from ichnaea import util
 
 
 class TestCellObservation(DBTestCase):
@@ -56,3 +61,75 @@ class TestWifiObservation(DBTestCase):
         self.assertEqual(result.key, key)
         self.assertEqual(result.channel, 5)
         self.assertEqual(result.signal, -45)
+
+
+class BatchValidationTest(TestCase):
+
+    def check_batch(self, model, entries, dropped):
+        now = util.utcnow()
+        report_id = uuid.uuid1()
+        for entry in entries:
+            entry.update(created=now, report_id=report_id)
+
+        expected = [model.validate(entry.copy()) for entry in entries]
+        expected = [value for value in expected if value is not None]
+
+        columns = dict([(name, [entry.get(name, colander.null)
+                                for entry in entries])
+                        for name in set().union(*entries)])
+        rows, result = model.validate_columns(columns)
+        self.assertEqual(rows, expected)
+        self.assertEqual(result, dropped)
+
+        observations, result = model.create_batch(entries)
+        self.assertEqual(len(observations), len(expected))
+        self.assertEqual(result, dropped)
+
+
+class TestCellBatchValidation(BatchValidationTest):
+
+    def test_validate_columns(self):
+        cell = dict(radio=Radio.gsm, mcc=GB_MCC, mnc=5,
+                    lat=GB_LAT, lon=GB_LON)
+        entries = [
+            dict(cell, lac=12345, cid=23456, asu=26, signal=-61),
+            dict(cell, lac='12345', cid=70000, asu=-70, signal=0),
+            dict(cell, radio='lte', lac=1, cid=2, psc=3, ta=100),
+            dict(cell, radio=Radio.cdma, lac=1, cid=70000),
+            dict(cell, radio='foo', lac=1, cid=2),
+            dict(cell, lac=65535, cid=65535),
+            dict(cell, psc=10, accuracy=-1, heading='abc'),
+            dict(cell, lac=1, cid=2, lat=95.0),
+            dict(cell, lac=1, cid=2, mcc=USA_MCC),
+        ]
+        self.check_batch(CellObservation, entries,
+                         {'key': 3, 'position': 1, 'country': 1})
+
+
+class TestWifiBatchValidation(BatchValidationTest):
+
+    def test_validate_columns(self):
+        wifi = dict(lat=GB_LAT, lon=GB_LON)
+        entries = [
+            dict(wifi, key='3680873e9b83', channel=5, signal=-45),
+            dict(wifi, key='36:80:87:3E:9B:84', frequency=5180, snr=None,
+                 signalToNoiseRatio=40),
+            dict(wifi, key='3680873e9b85', frequency=2412, signal=-250),
+            dict(wifi, key='00000000000', channel=5),
+            dict(wifi, key='zz80873e9b83'),
+            dict(wifi, key='3680873e9b86', lat='abc'),
+            dict(wifi, key='3680873e9b87', time='abc'),
+        ]
+        self.check_batch(WifiObservation, entries,
+                         {'key': 2, 'position': 1, 'report': 1})
+
+    def test_validate_mixed_columns(self):
+        wifi = dict(lat=GB_LAT, lon=GB_LON)
+        entries = [
+            dict(wifi, key=u'36-80-87-3e-9b-83', channel='11'),
+            dict(wifi, key='3680873e9b84', channel=5.0, frequency='5180'),
+            dict(wifi, key='3680873e9b85', channel=2 ** 70),
+            dict(wifi, key='3680873e9b86\x00'),
+            dict(wifi, key='ffffffffffff'),
+        ]
+        self.check_batch(WifiObservation, entries, {'key': 2})
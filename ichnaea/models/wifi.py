@@ -2,6 +2,7 @@ import colander
 from sqlalchemy import (
     Column,
     Index,
+    PrimaryKeyConstraint,
     String,
     UniqueConstraint,
 )
@@ -21,6 +22,7 @@ from ichnaea.models.schema import (
     FieldSchema,
 )
 from ichnaea.models.station import (
+    StationAggregateMixin,
     StationMixin,
     StationBlacklistMixin,
     ValidStationSchema,
@@ -100,3 +102,11 @@ class WifiBlacklist(WifiMixin, StationBlacklistMixin, _Model):
     _indices = (
         UniqueConstraint('key', name='wifi_blacklist_key_unique'),
     )
+
+
+class WifiAggregate(WifiKeyMixin, StationAggregateMixin, _Model):
+    __tablename__ = 'wifi_aggregate'
+
+    _indices = (
+        PrimaryKeyConstraint('key'),
+    )
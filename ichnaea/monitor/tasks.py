@@ -1,6 +1,9 @@
+import time
+
 from sqlalchemy import func
 
 from ichnaea.async.app import celery_app
+from ichnaea.async.config import QUEUE_LENGTH_KEY
 from ichnaea.async.task import DatabaseTask
 from ichnaea.models import (
     ApiKey,
@@ -97,9 +100,39 @@ def monitor_queue_length(self):
     try:
         redis_client = self.app.redis_client
         stats_client = self.stats_client
+        # the data queues are sorted sets, scored by the time
+        # each item was first queued
+        data_queues = set(self.app.data_queues.values())
+        now = time.time()
         for name in self.app.all_queues:
-            result[name] = value = redis_client.llen(name)
+            if name in data_queues:
+                result[name] = value = redis_client.zcard(name)
+                oldest = redis_client.zrange(name, 0, 0, withscores=True)
+                age = 0
+                if oldest:
+                    age = max(int((now - oldest[0][1]) * 1000), 0)
+                stats_client.gauge('queue.%s_age' % name, age)
+            else:
+                result[name] = value = redis_client.llen(name)
             stats_client.gauge('queue.' + name, value)
+        for station_type, names in self.app.insert_queues.items():
+            # partition skew, the largest partition relative to the
+            # average partition size, in percent
+            lengths = [result[name] for name in names]
+            total = sum(lengths)
+            skew = 100
+            if total:
+                skew = int(round(max(lengths) * len(lengths) * 100.0 / total))
+            stats_client.gauge(
+                'queue.queue_insert_%s_skew' % station_type, skew)
+        if result:
+            # cache the lengths for the admission control in the web tier,
+            # expire them if this task stops running
+            pipe = redis_client.pipeline()
+            pipe.delete(QUEUE_LENGTH_KEY)
+            pipe.hmset(QUEUE_LENGTH_KEY, result)
+            pipe.expire(QUEUE_LENGTH_KEY, 300)
+            pipe.execute()
     except Exception:  # pragma: no cover
         # Log but ignore the exception
         self.raven_client.captureException()
@@ -1,6 +1,8 @@
 from datetime import timedelta
 from random import randint
+import time
 
+from ichnaea.async.config import QUEUE_LENGTH_KEY
 from ichnaea.models import ApiKey
 from ichnaea.monitor.tasks import (
     monitor_api_key_limits,
@@ -118,12 +120,50 @@ class TestMonitorTasks(CeleryTestCase):
         for name in self.celery_app.all_queues:
             data[name] = randint(1, 10)
 
+        data_queues = self.celery_app.data_queues.values()
+        queued = time.time() - 60
         for k, v in data.items():
-            self.redis_client.lpush(k, *range(v))
+            if k in data_queues:
+                args = []
+                for i in range(v):
+                    args.extend([queued + i, i])
+                self.redis_client.zadd(k, *args)
+            else:
+                self.redis_client.lpush(k, *range(v))
 
         result = monitor_queue_length.delay().get()
 
         self.check_stats(
-            gauge=[('queue.' + k, 1, v) for k, v in data.items()],
+            gauge=[('queue.' + k, 1, v) for k, v in data.items()] +
+                  [('queue.%s_age' % k, 1) for k in data_queues],
         )
+        # the oldest queued item is about a minute old
+        ages = [msg.split('|')[0].split(':')[1]
+                for msg in self.stats_client.msgs
+                if msg.startswith('queue.') and '_age:' in msg]
+        self.assertTrue(ages)
+        for age in ages:
+            self.assertAlmostEqual(int(age), 60000, -4)
         self.assertEqual(result, data)
+
+        cached = self.redis_client.hgetall(QUEUE_LENGTH_KEY)
+        self.assertEqual(
+            dict([(k, int(v)) for k, v in cached.items()]), data)
+
+    def test_monitor_insert_queue_skew(self):
+        insert_queues = self.celery_app.insert_queues
+        all_queues = self.celery_app.all_queues
+        names = ['queue_insert_wifi_0', 'queue_insert_wifi_1']
+        self.celery_app.insert_queues = {'wifi': names}
+        self.celery_app.all_queues = set(names)
+        try:
+            self.redis_client.lpush(names[0], *range(3))
+            self.redis_client.lpush(names[1], *range(1))
+            monitor_queue_length.delay().get()
+        finally:
+            self.celery_app.insert_queues = insert_queues
+            self.celery_app.all_queues = all_queues
+
+        self.check_stats(
+            gauge=[('queue.queue_insert_wifi_skew', 1, 150)],
+        )
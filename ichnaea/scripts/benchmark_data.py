@@ -0,0 +1,284 @@
+"""
+Benchmark the data pipeline against synthetic observation streams.
+
+Run for example via:
+
+    python -m ichnaea.scripts.benchmark_data --initdb --observations=100000
+
+Each round inserts a stream of synthetic cell and wifi observations via
+the insert tasks, updates the positions of all stations with new
+observations via the location update tasks and recomputes the queued
+cell areas via the area scan task. All tasks run in eager mode, inside
+this process. Observations are spread over the stations with a Zipf
+like distribution, so a few stations get most of them, and a share of
+the stations moves far away in every round after the first.
+
+The station, observation and area tables are emptied at the start,
+so this should only ever be used against a dedicated benchmark
+database and Redis instance.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy
+from sqlalchemy import event
+
+from ichnaea.async.app import celery_app
+from ichnaea.async.config import (
+    STATION_BACKLOG_KEY,
+    init_worker,
+)
+from ichnaea.config import read_config
+from ichnaea.data.tasks import (
+    insert_measures_cell,
+    insert_measures_wifi,
+    location_update_cell,
+    location_update_wifi,
+    scan_areas,
+)
+from ichnaea.db import (
+    Database,
+    db_worker_session,
+)
+from ichnaea.log import (
+    DebugRavenClient,
+    DebugStatsClient,
+)
+from ichnaea.models import (
+    Cell,
+    CellAggregate,
+    CellArea,
+    CellBlacklist,
+    CellObservation,
+    Radio,
+    Wifi,
+    WifiAggregate,
+    WifiBlacklist,
+    WifiObservation,
+)
+from ichnaea.scripts import initdb
+
+# Paris, as all observations need to be inside the country of
+# the cell networks
+MCC = 208
+LAT = 48.8568
+LON = 2.3508
+# Distance in degrees moving stations are moved by, about 220 km
+MOVE_DELTA = 2.0
+
+TABLES = [model.__table__ for model in (
+    Cell, CellAggregate, CellArea, CellBlacklist, CellObservation,
+    Wifi, WifiAggregate, WifiBlacklist, WifiObservation)]
+
+
+class QueryCounter(object):
+    """
+    Count the statements sent to the database.
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'after_cursor_execute', self)
+
+    def __call__(self, *args, **kw):
+        self.count += 1
+
+
+class Stage(object):
+    """
+    Collect the item counts, query counts and latencies of the
+    task calls of one benchmark stage.
+    """
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.queries = []
+        self.latencies = []
+
+    def run(self, counter, function):
+        queries = counter.count
+        start = time.time()
+        result = function()
+        self.latencies.append(time.time() - start)
+        self.queries.append(counter.count - queries)
+        return result
+
+    def report(self):
+        if not self.latencies:
+            return '%s: no tasks' % self.name
+        duration = sum(self.latencies)
+        latencies = numpy.array(self.latencies) * 1000.0
+        return ('%s: %d %s in %.1f seconds (%d/s), %d tasks, '
+                '%.1f queries/task, latency ms p50 %.1f p90 %.1f p99 %.1f' % (
+                    self.name, self.items, self.unit, duration,
+                    self.items / max(duration, 0.001), len(self.latencies),
+                    numpy.mean(self.queries),
+                    numpy.percentile(latencies, 50),
+                    numpy.percentile(latencies, 90),
+                    numpy.percentile(latencies, 99)))
+
+
+class Stations(object):
+    """
+    Synthetic stations with a home position each, some of which
+    move away from it.
+    """
+
+    def __init__(self, station_type, number, moving, random):
+        self.station_type = station_type
+        self.random = random
+        self.number = number
+        self.lats = LAT + random.uniform(-0.5, 0.5, number)
+        self.lons = LON + random.uniform(-0.5, 0.5, number)
+        self.moving = random.random_sample(number) < moving
+        self.noise = 0.001 if station_type == 'wifi' else 0.005
+        # Zipf like observation weights, independent of station order
+        weights = 1.0 / numpy.arange(1, number + 1) ** 1.1
+        random.shuffle(weights)
+        self.weights = weights / weights.sum()
+
+    def key(self, index):
+        if self.station_type == 'wifi':
+            return {'key': '%012x' % (0xa82066000000 + index)}
+        return {
+            'radio': int(Radio.gsm),
+            'mcc': MCC,
+            'mnc': 1 + index % 3,
+            'lac': 1 + index // 50,
+            'cid': 1 + index,
+        }
+
+    def observations(self, number, moved):
+        random = self.random
+        indices = random.choice(self.number, number, p=self.weights)
+        lats = self.lats[indices] + random.normal(0, self.noise, number)
+        lons = self.lons[indices] + random.normal(0, self.noise, number)
+        if moved:
+            lats -= self.moving[indices] * MOVE_DELTA
+        for index, lat, lon in zip(indices.tolist(), lats.tolist(),
+                                   lons.tolist()):
+            entry = self.key(index)
+            entry.update({'lat': lat, 'lon': lon, 'accuracy': 10})
+            yield entry
+
+
+def reset(db, redis_client):
+    with db_worker_session(db) as session:
+        for table in TABLES:
+            session.execute('TRUNCATE TABLE %s' % table.name)
+        session.commit()
+    keys = [celery_app.data_queues['cell_area_update']]
+    keys.extend([STATION_BACKLOG_KEY % name for name in ('cell', 'wifi')])
+    redis_client.delete(*keys)
+
+
+def insert(stage, counter, task, entries, batch):
+    for i in range(0, len(entries), batch):
+        chunk = entries[i:i + batch]
+        stage.run(counter, lambda: task.delay(chunk).get())
+        stage.items += len(chunk)
+
+
+def update(stage, counter, task, batch):
+    # Returns the number of moving stations.
+    moving = 0
+    while True:
+        stations, moved = stage.run(counter, lambda: task.delay(
+            min_new=1, max_new=1000000, batch=batch).get())
+        stage.items += stations
+        moving += moved
+        if stations < batch:
+            break
+    return moving
+
+
+def scan(stage, counter, batch):
+    while True:
+        areas = stage.run(counter, lambda: scan_areas.delay(batch).get())
+        stage.items += areas
+        if not areas:
+            break
+
+
+def main(argv, _db_rw=None, _redis_client=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description='Benchmark the data pipeline.')
+
+    parser.add_argument('--initdb', action='store_true',
+                        help='Create the database schema first.')
+    parser.add_argument('--observations', default=100000, type=int,
+                        help='How many observations per round and type?')
+    parser.add_argument('--stations', default=10000, type=int,
+                        help='How many stations per type?')
+    parser.add_argument('--moving', default=0.01, type=float,
+                        help='Which share of the stations moves?')
+    parser.add_argument('--rounds', default=2, type=int,
+                        help='How many rounds of observations?')
+    parser.add_argument('--insert-batch', default=100, type=int,
+                        help='How many observations per insert task?')
+    parser.add_argument('--update-batch', default=100, type=int,
+                        help='How many stations per location update?')
+    parser.add_argument('--area-batch', default=100, type=int,
+                        help='How many areas per area scan?')
+    parser.add_argument('--aggregates', action='store_true',
+                        help='Keep running station aggregates.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Seed of the synthetic observations.')
+
+    args = parser.parse_args(argv[1:])
+
+    if args.initdb:  # pragma: no cover
+        initdb.main([argv[0], '--initdb'])
+
+    conf = read_config()
+    if _db_rw:
+        db = _db_rw
+    else:  # pragma: no cover
+        db = Database(conf.get('ichnaea', 'db_master'))
+
+    celery_app.conf.CELERY_ALWAYS_EAGER = True
+    celery_app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+    init_worker(celery_app, conf, _db_rw=db,
+                _raven_client=DebugRavenClient(),
+                _redis_client=_redis_client,
+                _stats_client=DebugStatsClient())
+    celery_app.station_aggregates = args.aggregates
+    reset(db, celery_app.redis_client)
+    counter = QueryCounter(db.engine)
+
+    random = numpy.random.RandomState(args.seed)
+    stages = []
+    types = [
+        ('cell', insert_measures_cell, location_update_cell),
+        ('wifi', insert_measures_wifi, location_update_wifi),
+    ]
+    for name, insert_task, update_task in types:
+        stations = Stations(name, args.stations, args.moving, random)
+        observations = Stage(name + ' insert', 'observations')
+        updates = Stage(name + ' update', 'stations')
+        areas = Stage(name + ' area', 'areas')
+        moving = 0
+        for i in range(args.rounds):
+            entries = list(stations.observations(args.observations, i > 0))
+            insert(observations, counter, insert_task,
+                   entries, args.insert_batch)
+            moving += update(updates, counter, update_task,
+                             args.update_batch)
+            if name == 'cell':
+                scan(areas, counter, args.area_batch)
+        stages.extend([observations, updates])
+        if name == 'cell':
+            stages.append(areas)
+        print('%s: %d of %d stations moved, %d detected as moving' % (
+            name, stations.moving.sum(), stations.number, moving))
+
+    for stage in stages:
+        print(stage.report())
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
@@ -0,0 +1,129 @@
+"""
+Benchmark the full cell export against a large cell table.
+
+Run for example via:
+
+    python -m ichnaea.scripts.benchmark_export --populate --rows=10000000
+
+The ``--populate`` option fills the cell table of the configured
+database with synthetic cells, so this should only ever be used
+against a dedicated benchmark database.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from ichnaea.config import read_config
+from ichnaea.db import (
+    Database,
+    db_worker_session,
+)
+from ichnaea.export.tasks import (
+    CELL_COLUMNS,
+    CELL_FIELDS,
+    make_cell_export_row,
+    selfdestruct_tempdir,
+    write_stations_to_csv,
+)
+from ichnaea.models import (
+    Cell,
+    Radio,
+)
+from ichnaea.storage import LocalSink
+from ichnaea import util
+
+RADIOS = (Radio.gsm, Radio.umts, Radio.lte)
+
+
+def synthetic_cells(rows, batch=10000):
+    """
+    Generate batches of synthetic cell dicts, with distinct keys
+    spread over many networks and areas.
+    """
+    now = util.utcnow()
+    cells = []
+    for i in xrange(rows):
+        cid, rest = i % 1000, i // 1000
+        lac, rest = rest % 1000, rest // 1000
+        mnc, rest = rest % 100, rest // 100
+        cells.append({
+            'radio': RADIOS[rest % len(RADIOS)],
+            'mcc': 1 + rest // len(RADIOS),
+            'mnc': mnc,
+            'lac': lac + 1,
+            'cid': cid + 1,
+            'psc': -1,
+            'lat': (i % 17000) / 100.0 - 85.0,
+            'lon': (i % 35000) / 100.0 - 175.0,
+            'range': i % 5000,
+            'total_measures': i % 100,
+            'created': now,
+            'modified': now,
+        })
+        if len(cells) == batch:
+            yield cells
+            cells = []
+    if cells:
+        yield cells
+
+
+def populate(db, rows):
+    ins = Cell.__table__.insert().prefix_with('IGNORE')
+    with db_worker_session(db) as session:
+        for cells in synthetic_cells(rows):
+            session.execute(ins, cells)
+            session.commit()
+
+
+def export(db, path, batch):
+    cond = Cell.__table__.c.lat.isnot(None)
+    with db_worker_session(db) as session:
+        with LocalSink(path) as sink:
+            write_stations_to_csv(session, Cell.__table__, CELL_COLUMNS,
+                                  cond, sink, make_cell_export_row,
+                                  CELL_FIELDS, batch=batch)
+
+
+def main(argv, _db_rw=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description='Benchmark the full cell export.')
+
+    parser.add_argument('--populate', action='store_true',
+                        help='Fill the cell table with synthetic cells.')
+    parser.add_argument('--rows', default=10000000, type=int,
+                        help='How many synthetic cells to create?')
+    parser.add_argument('--batch', default=10000, type=int,
+                        help='How many rows to query at once?')
+
+    args = parser.parse_args(argv[1:])
+
+    conf = read_config()
+    if _db_rw:
+        db = _db_rw
+    else:  # pragma: no cover
+        db = Database(conf.get('ichnaea', 'db_master'))
+
+    if args.populate:
+        start = time.time()
+        populate(db, args.rows)
+        print('Populated %s rows in %.1f seconds.' % (
+            args.rows, time.time() - start))
+
+    with db_worker_session(db) as session:
+        total = session.query(Cell).filter(Cell.lat.isnot(None)).count()
+
+    with selfdestruct_tempdir() as temp_dir:
+        path = os.path.join(temp_dir, 'export.csv.gz')
+        start = time.time()
+        export(db, path, args.batch)
+        duration = time.time() - start
+        size = os.path.getsize(path)
+
+    print('Exported %s rows in %.1f seconds (%d rows/s), %.1f MB.' % (
+        total, duration, total / max(duration, 0.001), size / 1048576.0))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
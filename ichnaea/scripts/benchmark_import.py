@@ -0,0 +1,105 @@
+"""
+Benchmark the OpenCellID import against a synthetic cell file.
+
+Run for example via:
+
+    python -m ichnaea.scripts.benchmark_import --rows=1000000
+
+Each importer starts out with an empty ocid_cell table, which is
+emptied again afterwards, so this should only ever be used against
+a dedicated benchmark database.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from ichnaea.config import read_config
+from ichnaea.db import (
+    Database,
+    db_worker_session,
+)
+from ichnaea.export.tasks import (
+    CELL_FIELDS,
+    GzipFile,
+    bulk_import_stations,
+    import_stations,
+    selfdestruct_tempdir,
+)
+from ichnaea.models import OCIDCell
+from ichnaea.models.constants import ALL_VALID_MCCS
+
+MCCS = sorted(ALL_VALID_MCCS)[:20]
+RADIOS = ('GSM', 'UMTS', 'LTE')
+
+
+def write_synthetic_file(path, rows):
+    """
+    Write a gzipped csv file of synthetic cells in the OpenCellID
+    format, with distinct keys spread over many networks and areas.
+    """
+    now = int(time.time())
+    line = '%s,%s,%s,%s,%s,,%.6f,%.6f,%s,%s,1,%s,%s,\n'
+    with GzipFile(path, 'wb') as fd:
+        for i in xrange(rows):
+            cid, rest = i % 1000, i // 1000
+            lac, rest = rest % 1000, rest // 1000
+            fd.write(line % (
+                RADIOS[rest % len(RADIOS)], MCCS[rest % len(MCCS)], rest % 100,
+                lac + 1, cid + 1,
+                (i % 35000) / 100.0 - 175.0, (i % 17000) / 100.0 - 85.0,
+                i % 5000, i % 100, now - i % 86400, now))
+
+
+def truncate(db):
+    with db_worker_session(db) as session:
+        session.execute('TRUNCATE TABLE %s' % OCIDCell.__tablename__)
+        session.commit()
+
+
+def run_import(db, function, path):
+    truncate(db)
+    try:
+        start = time.time()
+        with db_worker_session(db) as session:
+            function(session, path, CELL_FIELDS)
+        return time.time() - start
+    finally:
+        truncate(db)
+
+
+def main(argv, _db_rw=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description='Benchmark the OpenCellID import.')
+
+    parser.add_argument('--rows', default=1000000, type=int,
+                        help='How many synthetic cells to import?')
+    parser.add_argument('--skip-rows', action='store_true',
+                        help='Skip the row by row importer.')
+
+    args = parser.parse_args(argv[1:])
+
+    conf = read_config()
+    if _db_rw:
+        db = _db_rw
+    else:  # pragma: no cover
+        db = Database(conf.get('ichnaea', 'db_master'))
+
+    importers = [('bulk', bulk_import_stations)]
+    if not args.skip_rows:
+        importers.append(('row by row', import_stations))
+
+    with selfdestruct_tempdir() as temp_dir:
+        path = os.path.join(temp_dir, 'cell_towers.csv.gz')
+        write_synthetic_file(path, args.rows)
+
+        for name, function in importers:
+            duration = run_import(db, function, path)
+            print('Imported %s rows %s in %.1f seconds (%d rows/s).' % (
+                args.rows, name, duration,
+                args.rows / max(duration, 0.001)))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
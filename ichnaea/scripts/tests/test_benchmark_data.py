@@ -0,0 +1,49 @@
+from StringIO import StringIO
+
+from mock import patch
+
+from ichnaea.models import (
+    Cell,
+    Wifi,
+)
+from ichnaea.scripts.benchmark_data import main
+from ichnaea.tests.base import CeleryTestCase
+
+
+class TestBenchmarkData(CeleryTestCase):
+
+    def test_main(self):
+        argv = [
+            'bin/benchmark_data',
+            '--stations=20',
+            '--observations=200',
+            '--rounds=2',
+        ]
+        try:
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                main(argv,
+                     _db_rw=self.db_rw,
+                     _redis_client=self.redis_client)
+        finally:
+            # restore the worker setup of the test case
+            self.setup_celery()
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertTrue(lines[0].startswith('cell: '))
+        self.assertTrue(lines[1].startswith('wifi: '))
+        self.assertTrue(lines[0].endswith('detected as moving'))
+        self.assertTrue(
+            lines[2].startswith('cell insert: 400 observations in '))
+        self.assertTrue(lines[3].startswith('cell update: '))
+        self.assertTrue(lines[4].startswith('cell area: '))
+        self.assertTrue(
+            lines[5].startswith('wifi insert: 400 observations in '))
+        self.assertTrue(lines[6].startswith('wifi update: '))
+        for line in lines[2:]:
+            self.assertTrue('queries/task' in line, line)
+
+        cells = self.session.query(Cell).count()
+        wifis = self.session.query(Wifi).count()
+        self.assertTrue(0 < cells <= 20)
+        self.assertTrue(0 < wifis <= 20)
@@ -0,0 +1,27 @@
+from StringIO import StringIO
+
+from mock import patch
+
+from ichnaea.models import Cell
+from ichnaea.scripts.benchmark_export import main
+from ichnaea.tests.base import DBTestCase
+
+
+class TestBenchmarkExport(DBTestCase):
+
+    def test_main(self):
+        argv = [
+            'bin/benchmark_export',
+            '--populate',
+            '--rows=30',
+            '--batch=7',
+        ]
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(argv, _db_rw=self.db_rw)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('Populated 30 rows in '))
+        self.assertTrue(lines[1].startswith('Exported 30 rows in '))
+        self.assertTrue(lines[1].endswith(' MB.'))
+        self.assertEqual(self.session.query(Cell).count(), 30)
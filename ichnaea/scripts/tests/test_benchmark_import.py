@@ -0,0 +1,26 @@
+from StringIO import StringIO
+
+from mock import patch
+
+from ichnaea.models import OCIDCell
+from ichnaea.scripts.benchmark_import import main
+from ichnaea.tests.base import DBTestCase
+
+
+class TestBenchmarkImport(DBTestCase):
+
+    def test_main(self):
+        argv = [
+            'bin/benchmark_import',
+            '--rows=30',
+        ]
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(argv, _db_rw=self.db_rw)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('Imported 30 rows bulk in '))
+        self.assertTrue(
+            lines[1].startswith('Imported 30 rows row by row in '))
+        # the table is emptied after each importer
+        self.assertEqual(self.session.query(OCIDCell).count(), 0)
@@ -0,0 +1,86 @@
+from functools import wraps
+import random
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from redis import ConnectionError
+
+from ichnaea.async.config import (
+    INSERT_QUEUE_PREFIX,
+    QUEUE_LENGTH_KEY,
+)
+
+# queues filled by the submit APIs, their tasks expire after six hours
+SUBMIT_QUEUES = ('celery_incoming', 'celery_insert', 'celery_reports')
+
+# seconds after which clients should retry a rejected submission
+RETRY_AFTER = 300
+
+
+def configure_admission(app_config):
+    max_queue = int(app_config.get('ichnaea', 'submit_max_queue') or 0)
+    priority_keys = app_config.get('ichnaea', 'submit_priority_keys') or ''
+    priority_keys = [key.strip() for key in priority_keys.split(',')
+                     if key.strip()]
+    return AdmissionControl(max_queue=max_queue, priority_keys=priority_keys)
+
+
+class AdmissionControl(object):
+    """
+    Decide whether or not to accept new submissions, based on the
+    queue lengths cached in Redis by the queue length monitor task.
+
+    Up to half of ``max_queue`` all submissions are accepted. Above
+    that, submissions by API keys without priority are sampled with
+    a linearly decreasing rate, reaching zero at ``max_queue``. Above
+    ``max_queue`` all submissions are rejected.
+    """
+
+    def __init__(self, max_queue=0, priority_keys=(), _random=None):
+        self.max_queue = max_queue
+        self.sample_queue = max_queue // 2
+        self.priority_keys = frozenset(priority_keys)
+        self.random = _random or random.random
+
+    def queue_length(self, redis_client):
+        try:
+            lengths = redis_client.hgetall(QUEUE_LENGTH_KEY)
+        except ConnectionError:  # pragma: no cover
+            return 0
+        lengths = [int(value) for name, value in lengths.items()
+                   if (name in SUBMIT_QUEUES or
+                       name.startswith(INSERT_QUEUE_PREFIX))]
+        return max(lengths or [0])
+
+    def admit(self, redis_client, api_key):
+        if not self.max_queue:
+            return True
+
+        length = self.queue_length(redis_client)
+        if length <= self.sample_queue:
+            return True
+        if length > self.max_queue:
+            return False
+        if api_key in self.priority_keys:
+            return True
+
+        rate = (float(self.max_queue - length) /
+                (self.max_queue - self.sample_queue))
+        return self.random() < rate
+
+
+def check_admission(func_name):
+    def c(func):
+        @wraps(func)
+        def closure(request, *args, **kwargs):
+            registry = request.registry
+            api_key = request.GET.get('key', None)
+
+            if not registry.admission.admit(registry.redis_client, api_key):
+                registry.stats_client.incr('%s.admission_rejected' % func_name)
+                result = HTTPServiceUnavailable()
+                result.headers['Retry-After'] = str(RETRY_AFTER)
+                return result
+
+            return func(request, *args, **kwargs)
+        return closure
+    return c
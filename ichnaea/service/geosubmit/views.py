@@ -8,6 +8,7 @@ from pyramid.httpexceptions import (
 from pytz import utc
 from redis import ConnectionError
 
+from ichnaea.service.admission import check_admission
 from ichnaea.service.base import check_api_key
 from ichnaea.service.base_submit import BaseSubmitter
 from ichnaea.service.error import JSONParseError
@@ -165,6 +166,7 @@ class GeoSubmitter(BaseSubmitter):
         return reports
 
 
+@check_admission('geosubmit')
 @check_api_key('geosubmit')
 def geosubmit_view(request):
     submitter = GeoSubmitter(request)
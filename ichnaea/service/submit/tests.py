@@ -14,7 +14,9 @@ from ichnaea.models import (
     Radio,
     WifiObservation,
 )
+from ichnaea.async.config import QUEUE_LENGTH_KEY
 from ichnaea.customjson import dumps
+from ichnaea.service.admission import AdmissionControl
 from ichnaea.service.error import preprocess_request
 from ichnaea.tests.base import (
     CeleryAppTestCase,
@@ -433,6 +435,21 @@ class TestSubmit(CeleryAppTestCase):
             counter=['submit.unknown_api_key',
                      ('submit.api_key.invalidkey', 0)])
 
+    def test_admission_rejected(self):
+        registry = self.app.app.registry
+        admission = registry.admission
+        registry.admission = AdmissionControl(max_queue=10)
+        self.redis_client.hmset(QUEUE_LENGTH_KEY, {'celery_insert': 11})
+        try:
+            res = self.app.post_json(
+                '/v1/submit?key=test',
+                {"items": [{"lat": 12.3, "lon": 23.4}]},
+                status=503)
+        finally:
+            registry.admission = admission
+        self.assertEqual(res.headers['Retry-After'], '300')
+        self.check_stats(counter=['submit.admission_rejected'])
+
     def test_error_no_mapping(self):
         app = self.app
         res = app.post_json('/v1/submit', [1], status=400)
@@ -10,6 +10,7 @@ from pyramid.httpexceptions import (
 from redis import ConnectionError
 
 from ichnaea.service.error import JSONError
+from ichnaea.service.admission import check_admission
 from ichnaea.service.base import check_api_key
 from ichnaea.service.base_submit import BaseSubmitter
 from ichnaea.service.submit.schema import SubmitSchema
@@ -133,6 +134,7 @@ class Submitter(BaseSubmitter):
         return reports
 
 
+@check_admission('submit')
 @check_api_key('submit', error_on_invalidkey=False)
 def submit_view(request):
     submitter = Submitter(request)
@@ -0,0 +1,72 @@
+from ichnaea.async.config import QUEUE_LENGTH_KEY
+from ichnaea.config import DummyConfig
+from ichnaea.service.admission import (
+    AdmissionControl,
+    configure_admission,
+)
+from ichnaea.tests.base import (
+    RedisIsolation,
+    TestCase,
+)
+
+
+class TestAdmissionControl(TestCase, RedisIsolation):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAdmissionControl, cls).setup_redis()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestAdmissionControl, cls).teardown_redis()
+
+    def tearDown(self):
+        self.cleanup_redis()
+
+    def _set_lengths(self, **lengths):
+        self.redis_client.hmset(QUEUE_LENGTH_KEY, lengths)
+
+    def test_configure(self):
+        admission = configure_admission(DummyConfig({'ichnaea': {
+            'submit_max_queue': '1000',
+            'submit_priority_keys': 'key_a, key_b',
+        }}))
+        self.assertEqual(admission.max_queue, 1000)
+        self.assertEqual(admission.sample_queue, 500)
+        self.assertEqual(admission.priority_keys,
+                         frozenset(['key_a', 'key_b']))
+
+    def test_disabled(self):
+        self._set_lengths(celery_insert=1000)
+        admission = AdmissionControl()
+        self.assertTrue(admission.admit(self.redis_client, None))
+
+    def test_no_lengths(self):
+        admission = AdmissionControl(max_queue=100)
+        self.assertEqual(admission.queue_length(self.redis_client), 0)
+        self.assertTrue(admission.admit(self.redis_client, None))
+
+    def test_queue_length(self):
+        self._set_lengths(celery_insert=10, celery_reports=30,
+                          queue_insert_wifi_0=20, celery_export=100)
+        admission = AdmissionControl(max_queue=100)
+        self.assertEqual(admission.queue_length(self.redis_client), 30)
+
+    def test_sample(self):
+        self._set_lengths(celery_insert=75)
+        admission = AdmissionControl(
+            max_queue=100, priority_keys=['key_a'], _random=lambda: 0.4)
+        self.assertTrue(admission.admit(self.redis_client, 'key_a'))
+        self.assertTrue(admission.admit(self.redis_client, None))
+
+        admission = AdmissionControl(
+            max_queue=100, priority_keys=['key_a'], _random=lambda: 0.6)
+        self.assertTrue(admission.admit(self.redis_client, 'key_a'))
+        self.assertFalse(admission.admit(self.redis_client, 'key_b'))
+
+    def test_shed(self):
+        self._set_lengths(celery_incoming=101)
+        admission = AdmissionControl(
+            max_queue=100, priority_keys=['key_a'], _random=lambda: 0.0)
+        self.assertFalse(admission.admit(self.redis_client, 'key_a'))
+        self.assertFalse(admission.admit(self.redis_client, None))
@@ -0,0 +1,224 @@
+"""
+Streaming sinks for exported and archived files.
+
+A sink is a write-only file-like object, which computes the size and
+SHA1 digest of the written data on the fly. The S3 sink uploads the
+data in parts as they fill, so no complete local copy of the file
+is ever needed. The local sink writes into a directory and is used
+in tests and for installations without S3.
+"""
+
+from cStringIO import StringIO
+import hashlib
+import os
+
+import boto
+
+# Size of the parts of a S3 multipart upload, S3 requires at least 5 MB
+PART_SIZE = 16 * 2 ** 20
+# Size of the chunks in which stored files are read
+READ_SIZE = 2 ** 20
+# Prefix of storage locations referring to a local directory
+LOCAL_PREFIX = 'file://'
+
+
+def configure_storage(location):
+    """
+    Return a storage for the given location, either a local
+    directory prefixed by ``file://`` or the name of a S3 bucket.
+    """
+    if location.startswith(LOCAL_PREFIX):
+        return LocalStorage(location[len(LOCAL_PREFIX):])
+    return S3Storage(location)
+
+
+class Sink(object):
+    """
+    A Sink is a write-only file-like object. If the sink is used as
+    a context manager, the written file is discarded on exceptions.
+    """
+
+    mode = 'wb'
+    closed = False
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
+        self.sha = hashlib.sha1()
+
+    @property
+    def digest(self):
+        return self.sha.digest()
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        self._write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close()
+
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self._abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write(self, data):  # pragma: no cover
+        raise NotImplementedError()
+
+    def _close(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    def _abort(self):  # pragma: no cover
+        raise NotImplementedError()
+
+
+class LocalSink(Sink):
+    """
+    A sink writing into a local file, which is only moved into
+    its final place once the sink is closed.
+    """
+
+    def __init__(self, path):
+        super(LocalSink, self).__init__(os.path.basename(path))
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.fd = open(self.tmp_path, 'wb')
+
+    def _write(self, data):
+        self.fd.write(data)
+
+    def _close(self):
+        self.fd.close()
+        os.rename(self.tmp_path, self.path)
+
+    def _abort(self):
+        self.fd.close()
+        os.remove(self.tmp_path)
+
+
+class S3Sink(Sink):
+    """
+    A sink uploading into a S3 key. Data is buffered in memory until
+    a part is filled, at which point a multipart upload is started or
+    continued. Files smaller than one part are uploaded in one request.
+    """
+
+    def __init__(self, bucket, key_name, part_size=PART_SIZE,
+                 reduced_redundancy=False):
+        super(S3Sink, self).__init__(os.path.basename(key_name))
+        self.bucket = bucket
+        self.key_name = key_name
+        self.part_size = part_size
+        self.reduced_redundancy = reduced_redundancy
+        self.buffer = StringIO()
+        self.upload = None
+        self.parts = 0
+
+    def _write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload is None:
+            self.upload = self.bucket.initiate_multipart_upload(
+                self.key_name, reduced_redundancy=self.reduced_redundancy)
+        self.parts += 1
+        self.buffer.seek(0)
+        self.upload.upload_part_from_file(self.buffer, self.parts)
+        self.buffer = StringIO()
+
+    def _close(self):
+        if self.upload is None:
+            key = boto.s3.key.Key(self.bucket)
+            key.key = self.key_name
+            key.set_contents_from_string(
+                self.buffer.getvalue(),
+                reduced_redundancy=self.reduced_redundancy)
+            return
+        if self.buffer.tell():
+            self._upload_part()
+        self.upload.complete_upload()
+
+    def _abort(self):
+        if self.upload is not None:
+            self.upload.cancel_upload()
+
+
+class LocalStorage(object):
+    """
+    A storage keeping files in a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key_name):
+        return os.path.join(self.root, *key_name.split('/'))
+
+    def sink(self, key_name, reduced_redundancy=False):
+        return LocalSink(self.path(key_name))
+
+    def read(self, key_name):
+        with open(self.path(key_name), 'rb') as fd:
+            while True:
+                data = fd.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def delete(self, key_names):
+        for key_name in key_names:
+            os.remove(self.path(key_name))
+
+
+class S3Storage(object):
+    """
+    A storage keeping files in a S3 bucket.
+    """
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            conn = boto.connect_s3()
+            self._bucket = conn.get_bucket(self.bucket_name, validate=False)
+        return self._bucket
+
+    def sink(self, key_name, reduced_redundancy=False):
+        return S3Sink(self.bucket, key_name,
+                      reduced_redundancy=reduced_redundancy)
+
+    def read(self, key_name):
+        key = self.bucket.get_key(key_name)
+        while True:
+            data = key.read(READ_SIZE)
+            if not data:
+                break
+            yield data
+        key.close()
+
+    def delete(self, key_names):
+        if key_names:
+            self.bucket.delete_keys(key_names)
@@ -324,6 +324,7 @@ class CeleryIsolation(object):
         del cls.celery_app.all_queues
         del cls.celery_app.data_queues
         del cls.celery_app.export_queues
+        del cls.celery_app.insert_queues
         del cls.celery_app.settings
         del cls.celery_app
 
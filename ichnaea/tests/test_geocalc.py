@@ -1,6 +1,9 @@
+import numpy
+
 from ichnaea.geocalc import (
     _radius_cache,
     distance,
+    distances,
     maximum_country_radius,
 )
 from ichnaea.geocalc import (
@@ -52,6 +55,18 @@ class TestDistance(TestCase):
         sdelta = "%0.4f" % delta
         self.assertEqual(sdelta, '8901.7476')
 
+    def test_distances(self):
+        points = [
+            (44.0337065, -79.4908184, 44.0347065, -79.4918184),
+            (90.0, 0.0, -90.0, 0.0),
+            (-100.0, -186.0, 0.0, 0.0),
+            (51.5, -0.1, 51.5, -0.1),
+        ]
+        lats1, lons1, lats2, lons2 = numpy.array(points).T
+        deltas = distances(lats1, lons1, lats2, lons2)
+        for delta, point in zip(deltas, points):
+            self.assertAlmostEqual(delta, distance(*point), 9)
+
 
 class TestMaximumRadius(TestCase):
 
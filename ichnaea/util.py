@@ -6,7 +6,10 @@ from webob.response import gzip_app_iter
 
 
 def encode_gzip(data):
-    # based on webob.response.Response.encode_content
+    # based on webob.response.Response.encode_content,
+    # accepts a string or an iterable of string chunks
+    if isinstance(data, basestring):
+        data = [data]
     return ''.join(gzip_app_iter(data))
 
 
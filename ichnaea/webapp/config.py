@@ -16,6 +16,7 @@ from ichnaea.log import (
     configure_stats,
 )
 from ichnaea.service import configure_service
+from ichnaea.service.admission import configure_admission
 
 
 def main(global_config, app_config, init=False,
@@ -54,6 +55,8 @@ def main(global_config, app_config, init=False,
         app_config.get('ichnaea', 'geoip_db_path'), raven_client=raven_client,
         _client=_geoip_db)
 
+    registry.admission = configure_admission(app_config)
+
     config.add_tween('ichnaea.db.db_tween_factory', under=EXCVIEW)
     config.add_tween('ichnaea.log.log_tween_factory', under=EXCVIEW)
     config.add_request_method(db_rw_session, property=True)
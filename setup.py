@@ -19,6 +19,7 @@ requires = [
     'gunicorn',
     'iso3166',
     'mobile-codes',
+    'numpy',
     'PyMySQL',
     'pyramid',
     'pyramid-chameleon',